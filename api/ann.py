@@ -0,0 +1,155 @@
+"""An inverted file (IVF) index for approximate nearest-neighbour search.
+
+Rows are bucketed by their nearest k-means centroid. A search only scores the
+rows of the `nprobe` buckets whose centroids are closest to the query, so its
+cost grows with the square root of the corpus instead of linearly. Vectors are
+assumed unit length, so inner product is cosine similarity.
+"""
+import logging
+import numpy as np
+import numpy.typing as npt
+import os
+from typing import List
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Below this many rows an exact scan is about as fast, so no index is built.
+ANN_MIN_ROWS = 20_000
+# Buckets probed per query. More probes trade latency for recall.
+DEFAULT_NPROBE = 16
+# The index is retrained once the corpus outgrows the one it was trained on by
+# this factor, since its buckets grow unbalanced.
+RETRAIN_GROWTH = 4
+
+_KMEANS_ITERATIONS = 10
+# k-means trains on a sample of this many rows per centroid.
+_SAMPLE_ROWS_PER_LIST = 64
+# Rows assigned to centroids at a time.
+_ASSIGN_BLOCK_ROWS = 1 << 16
+
+Matrix = npt.NDArray[np.float32]
+
+
+class IVFIndex:
+  """Maps each row of a vector matrix to one of `nlist` buckets."""
+
+  def __init__(
+      self,
+      centroids: Matrix,
+      assignments: npt.NDArray[np.int32],
+      trained_rows: int,
+  ) -> None:
+    self._centroids = centroids
+    self._assignments = assignments
+    self._trained_rows = trained_rows
+    self._lists: List[npt.NDArray[np.int64]] | None = None
+
+  @property
+  def size(self) -> int:
+    return len(self._assignments)
+
+  @property
+  def nlist(self) -> int:
+    return len(self._centroids)
+
+  def needs_retraining(self, rows: int) -> bool:
+    return rows > RETRAIN_GROWTH * self._trained_rows
+
+  @classmethod
+  def train(cls, vectors: Matrix, *, seed: int = 0) -> "IVFIndex":
+    """Clusters `vectors` with spherical k-means into about sqrt(n) lists."""
+    rng = np.random.default_rng(seed)
+    nlist = max(1, int(np.sqrt(len(vectors))))
+    sample_size = min(len(vectors), nlist * _SAMPLE_ROWS_PER_LIST)
+    sample = np.asarray(
+        vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(_KMEANS_ITERATIONS):
+      labels = np.argmax(sample @ centroids.T, axis=1)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, labels, sample)
+      norms = np.linalg.norm(sums, axis=1, keepdims=True)
+      # Empty clusters keep their old centroid.
+      centroids = np.where(
+          norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    index = cls(centroids, np.empty(0, dtype=np.int32), len(vectors))
+    index.add(vectors)
+    _logger.info(
+        f"Trained an IVF index of {nlist} lists on {len(vectors)} rows")
+    return index
+
+  def add(self, vectors: Matrix) -> None:
+    """Assigns `vectors`, the rows following the indexed ones, to buckets."""
+    labels = [
+        np.argmax(
+            vectors[start:start + _ASSIGN_BLOCK_ROWS] @ self._centroids.T,
+            axis=1).astype(np.int32)
+        for start in range(0, len(vectors), _ASSIGN_BLOCK_ROWS)
+    ]
+    self._assignments = np.concatenate([self._assignments, *labels])
+    self._lists = None
+
+  def truncate(self, rows: int) -> None:
+    self._assignments = self._assignments[:rows]
+    self._lists = None
+
+  def search(
+      self,
+      vectors: Matrix,
+      query_vector: Matrix,
+      alive: npt.NDArray[np.bool_],
+      top_k: int,
+      nprobe: int = DEFAULT_NPROBE,
+  ) -> tuple[List[int], List[float]]:
+    """The `top_k` alive rows of `vectors` closest to `query_vector`."""
+    centroid_scores = self._centroids @ query_vector
+    nprobe = min(nprobe, self.nlist)
+    probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+    lists = self._get_lists()
+    # Sorted, so the rows are read from disk in order.
+    candidates = np.sort(np.concatenate([lists[i] for i in probed]))
+    # Rows past `alive` were added after the caller took its snapshot.
+    candidates = candidates[candidates < len(alive)]
+    candidates = candidates[alive[candidates]]
+    if len(candidates) == 0 or top_k <= 0:
+      return [], []
+    scores = vectors[candidates] @ query_vector
+    k = min(top_k, len(candidates))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best], kind="stable")]
+    return ([int(row) for row in candidates[best]],
+            [float(score) for score in scores[best]])
+
+  def save(self, path: str) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+      np.savez(
+          f,
+          centroids=self._centroids,
+          assignments=self._assignments,
+          trained_rows=np.array(self._trained_rows))
+    os.replace(tmp_path, path)
+
+  @classmethod
+  def load(cls, path: str) -> "IVFIndex | None":
+    try:
+      with np.load(path) as data:
+        return cls(
+            data["centroids"],
+            data["assignments"],
+            int(data["trained_rows"]))
+    except FileNotFoundError:
+      return None
+
+  def _get_lists(self) -> List[npt.NDArray[np.int64]]:
+    if self._lists is None:
+      order = np.argsort(self._assignments, kind="stable")
+      bounds = np.searchsorted(
+          self._assignments[order], np.arange(self.nlist + 1))
+      self._lists = [
+          order[bounds[i]:bounds[i + 1]] for i in range(self.nlist)]
+    return self._lists
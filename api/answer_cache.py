@@ -0,0 +1,84 @@
+"""Caches the answers of a stack to questions it was already asked.
+
+A question hits the cache if it was asked before, up to case and whitespace.
+There is no fuzzy matching: questions that differ only in a product code or an
+error string are near neighbours in any embedding, and must not share answers.
+For the same reason punctuation is kept, so "AB-12" and "AB 12" differ.
+Entries are only valid for the corpus version they were answered from (see
+`BaseRag.corpus_version`), so any upload or clear of the corpus drops them.
+"""
+from collections import OrderedDict
+import logging
+from pydantic import BaseModel
+import threading
+from typing import List
+from .base_rag import AttributedAnswer
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Answers kept per stack, least recently used first out.
+MAX_CACHED_ANSWERS = 256
+
+
+class AnswerCacheStats(BaseModel):
+  hits: int = 0
+  misses: int = 0
+  invalidations: int = 0
+  size: int = 0
+
+
+def normalize(question: str) -> str:
+  return " ".join(question.lower().split())
+
+
+class AnswerCache:
+  """The answers of one stack, by normalized question."""
+
+  def __init__(self) -> None:
+    self._lock = threading.Lock()
+    self._entries: OrderedDict[str, List[AttributedAnswer]] = OrderedDict()
+    self._version: int | None = None
+    self._stats = AnswerCacheStats()
+
+  def get(self, question: str, version: int) -> List[AttributedAnswer] | None:
+    key = normalize(question)
+    with self._lock:
+      self._check_version(version)
+      answers = self._entries.get(key)
+      if answers is None:
+        self._stats.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self._stats.hits += 1
+    _logger.info(f"Answering {question!r} from the cache")
+    return answers
+
+  def put(
+      self, question: str, version: int, answers: List[AttributedAnswer]
+  ) -> None:
+    key = normalize(question)
+    with self._lock:
+      self._check_version(version)
+      if version != self._version:
+        return  # Answered from a corpus that has changed since.
+      self._entries[key] = answers
+      self._entries.move_to_end(key)
+      while len(self._entries) > MAX_CACHED_ANSWERS:
+        self._entries.popitem(last=False)
+
+  def stats(self) -> AnswerCacheStats:
+    with self._lock:
+      return self._stats.model_copy(update={"size": len(self._entries)})
+
+  def _check_version(self, version: int) -> None:
+    # Versions only grow, so an older one is from a request that started
+    # before the corpus changed.
+    if self._version is None or version > self._version:
+      if self._entries:
+        self._stats.invalidations += 1
+      self._entries.clear()
+      self._version = version
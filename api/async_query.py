@@ -0,0 +1,502 @@
+"""Async building blocks for the RAG stacks.
+
+LlamaIndex's `aquery` paths call the synchronous retrievers, synthesizers and
+query transforms under the hood, which would block the event loop. These
+helpers await every hop instead: LLM hops go through `LLM.acomplete`, and only
+the Google retriever and AQA hops, which have no async client in LlamaIndex,
+are run in a worker thread one hop at a time.
+"""
+import asyncio
+from llama_index.core import BaseRetriever
+from llama_index.indices.utils import default_format_node_batch_fn
+from llama_index.llm_predictor.base import BaseLLMPredictor
+from llama_index.llms.base import LLM
+from llama_index.postprocessor import LLMRerank
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.prompts.base import BasePromptTemplate
+from llama_index.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.response.schema import Response
+from llama_index.response_synthesizers import BaseSynthesizer
+from llama_index.schema import (
+    MetadataMode,
+    NodeWithScore,
+    QueryBundle,
+    TextNode,
+)
+import logging
+import re
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Sequence,
+    Tuple,
+    TypeAlias,
+)
+from .base_rag import AttributedAnswer, ConversationEvent
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Bullets or numbering such as "-", "*", "1." or "2)" in front of a line.
+_LIST_MARKER = re.compile(r"^\s*(?:[-*]|\d+[.)])\s*")
+# A line of `LLMRerank`'s answer, such as "Doc: 2, Relevance: 7".
+_CHOICE_LINE = re.compile(r":\s*(\d+)\s*,[^:]*:\s*(-?\d+(?:\.\d+)?)")
+# The top of the 1 to 10 relevance scale `LLMRerank`'s prompt asks for.
+_MAX_RELEVANCE = 10.0
+# How `arerank` merges the scores of its batches.
+RerankMerge: TypeAlias = Literal["score", "tournament"]
+# Called with each sub-question and its answer as soon as it is answered.
+StepCallback: TypeAlias = Callable[[QueryBundle, Response], Awaitable[None]]
+
+
+async def aretrieve(
+    retriever: BaseRetriever, query_bundle: QueryBundle
+) -> List[NodeWithScore]:
+  return await asyncio.to_thread(retriever.retrieve, query_bundle)
+
+
+async def asynthesize(
+    response_synthesizer: BaseSynthesizer,
+    query_bundle: QueryBundle,
+    nodes: List[NodeWithScore],
+    additional_source_nodes: Sequence[NodeWithScore] | None = None,
+) -> Response:
+  response = await asyncio.to_thread(
+      lambda: response_synthesizer.synthesize(
+          query_bundle,
+          nodes,
+          additional_source_nodes=additional_source_nodes))
+  assert isinstance(response, Response)
+  return response
+
+
+async def astream_synthesize(
+    llm: LLM,
+    query_bundle: QueryBundle,
+    nodes: List[NodeWithScore],
+    additional_source_nodes: Sequence[NodeWithScore] | None = None,
+) -> AsyncIterator[str]:
+  """Streams an answer from `nodes` as `llm` generates it.
+
+  `asynthesize` asks Google's AQA model, which has no streaming RPC, so its
+  answer only arrives once complete. This prompts `llm` through
+  `astream_complete` instead, and yields each chunk of text.
+  """
+  context_str = "\n\n".join(
+      node.node.get_content(metadata_mode=MetadataMode.LLM)
+      for node in [*(additional_source_nodes or []), *nodes])
+  prompt = DEFAULT_TEXT_QA_PROMPT.format(
+      context_str=context_str, query_str=query_bundle.query_str)
+  async for response in await llm.astream_complete(prompt):
+    if response.delta:
+      yield response.delta
+
+
+async def astream_answer(
+    llm: LLM,
+    query_bundle: QueryBundle,
+    nodes: List[NodeWithScore],
+    record: Callable[[Response], Iterable[AttributedAnswer]],
+    additional_source_nodes: Sequence[NodeWithScore] | None = None,
+) -> AsyncIterator[ConversationEvent]:
+  """Streams `astream_synthesize` as `delta` events, then `answer` events.
+
+  `record` turns the full response into the stack's answers, as for a
+  response of `asynthesize`. Every one of `nodes` counts as cited, so they
+  have no score, as AQA marks the passages it attributes. There is no
+  answerable probability.
+  """
+  text = ""
+  async for delta in astream_synthesize(
+      llm, query_bundle, nodes, additional_source_nodes):
+    text += delta
+    yield ConversationEvent(event="delta", text=delta)
+  response = Response(
+      response=text,
+      source_nodes=[NodeWithScore(node=node.node) for node in nodes])
+  for answer in record(response):
+    yield ConversationEvent(event="answer", answer=answer)
+
+
+async def arerank(
+    reranker: LLMRerank,
+    nodes: List[NodeWithScore],
+    query_bundle: QueryBundle,
+    *,
+    batch_size: int | None = None,
+    max_concurrency: int = 1,
+    merge: RerankMerge = "score",
+) -> List[NodeWithScore]:
+  """Same as `LLMRerank.postprocess_nodes` but awaits the LLM.
+
+  The candidates are split into even batches of at most `batch_size` (the
+  reranker's `choice_batch_size` by default), scored `max_concurrency`
+  batches at a time. Each node scores its absolute 1 to 10 relevance over
+  10, so scores compare across batches. With `merge="score"` all batches are
+  merged by score. With `merge="tournament"` the top nodes of each batch
+  advance to another round until they fit in a single batch, so the final
+  order comes from one prompt.
+  """
+  llm_predictor = reranker.service_context.llm_predictor
+  batch_size = batch_size or reranker.choice_batch_size
+  semaphore = asyncio.Semaphore(max_concurrency)
+
+  async def score(batch: List[NodeWithScore]) -> List[NodeWithScore]:
+    batch_nodes = [node.node for node in batch]
+    async with semaphore:
+      raw_response = await llm_predictor.apredict(
+          reranker.choice_select_prompt,
+          context_str=default_format_node_batch_fn(batch_nodes),
+          query_str=query_bundle.query_str,
+      )
+    choices = _parse_choices(raw_response, len(batch_nodes))
+    if not choices:
+      _logger.warning(f"Ignoring unparsable rerank answer {raw_response!r}")
+      return []
+    return _sort_by_score([
+        NodeWithScore(
+            node=batch_nodes[choice - 1],
+            score=min(max(relevance / _MAX_RELEVANCE, 0.0), 1.0))
+        for choice, relevance in choices
+    ])
+
+  candidates = nodes
+  while True:
+    batches = _split_evenly(candidates, batch_size)
+    scored = await asyncio.gather(*[score(batch) for batch in batches])
+    if merge == "score" or len(batches) <= 1:
+      break
+    winners = [node for batch in scored for node in batch[:reranker.top_n]]
+    if len(winners) >= len(candidates):
+      # Nothing was eliminated, so another round would not converge.
+      break
+    candidates = winners
+
+  results = _sort_by_score([node for batch in scored for node in batch])
+  return results[:reranker.top_n]
+
+
+def _split_evenly(
+    nodes: List[NodeWithScore], batch_size: int
+) -> List[List[NodeWithScore]]:
+  """As few batches of at most `batch_size` as possible, of even sizes.
+
+  Splitting 6 nodes by 5 gives batches of 3 and 3 rather than 5 and 1, so no
+  node is rated alone.
+  """
+  batch_count = -(-len(nodes) // batch_size)
+  quotient, remainder = divmod(len(nodes), max(batch_count, 1))
+  batches = []
+  start = 0
+  for i in range(batch_count):
+    end = start + quotient + (1 if i < remainder else 0)
+    batches.append(nodes[start:end])
+    start = end
+  return batches
+
+
+def _parse_choices(
+    answer: str, num_choices: int
+) -> List[Tuple[int, float]]:
+  """The 1-based choices of a rerank answer, with their relevance.
+
+  Unlike `default_parse_choice_select_answer_fn`, lines that are malformed,
+  out of range or repeated are skipped rather than raising or misindexing.
+  """
+  choices: Dict[int, float] = {}
+  for line in answer.splitlines():
+    match = _CHOICE_LINE.search(line)
+    if match is None:
+      continue
+    choice = int(match.group(1))
+    if 1 <= choice <= num_choices and choice not in choices:
+      choices[choice] = float(match.group(2))
+  return list(choices.items())
+
+
+async def apostprocess(
+    postprocessors: Sequence[BaseNodePostprocessor],
+    nodes: List[NodeWithScore],
+    query_bundle: QueryBundle,
+    *,
+    batch_size: int | None = None,
+    max_concurrency: int = 1,
+    merge: RerankMerge = "score",
+) -> List[NodeWithScore]:
+  """Applies `postprocessors` in order.
+
+  `LLMRerank` goes through `arerank` with the given batching. The other
+  postprocessors are local and cheap, so they run inline.
+  """
+  for postprocessor in postprocessors:
+    if isinstance(postprocessor, LLMRerank):
+      nodes = await arerank(
+          postprocessor,
+          nodes,
+          query_bundle,
+          batch_size=batch_size,
+          max_concurrency=max_concurrency,
+          merge=merge)
+    else:
+      nodes = postprocessor.postprocess_nodes(nodes, query_bundle)
+  return nodes
+
+
+def _sort_by_score(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+  return sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)
+
+
+async def ahyde(
+    llm_predictor: BaseLLMPredictor,
+    hyde_prompt: BasePromptTemplate,
+    query_bundle: QueryBundle,
+) -> QueryBundle:
+  """Same as `HyDEQueryTransform` but awaits the LLM."""
+  hypothetical_doc = await llm_predictor.apredict(
+      hyde_prompt, context_str=query_bundle.query_str)
+  return QueryBundle(
+      query_str=query_bundle.query_str,
+      custom_embedding_strs=[hypothetical_doc, *query_bundle.embedding_strs],
+  )
+
+
+async def astep_decompose(
+    llm_predictor: BaseLLMPredictor,
+    step_decompose_prompt: BasePromptTemplate,
+    query_bundle: QueryBundle,
+    *,
+    prev_reasoning: str,
+    index_summary: str,
+) -> QueryBundle:
+  """Same as `StepDecomposeQueryTransform` but awaits the LLM."""
+  new_query_str = await llm_predictor.apredict(
+      step_decompose_prompt,
+      prev_reasoning=f"\n{prev_reasoning}" if prev_reasoning else "None",
+      query_str=query_bundle.query_str,
+      context_str=index_summary,
+  )
+  return QueryBundle(
+      query_str=new_query_str,
+      custom_embedding_strs=query_bundle.custom_embedding_strs,
+  )
+
+
+class _Steps:
+  """Answered sub-questions, accumulated like `MultiStepQueryEngine` does."""
+
+  def __init__(self) -> None:
+    self.prev_reasoning = ""
+    self.text_chunks: List[str] = []
+    self.source_nodes: List[NodeWithScore] = []
+    self.metadata: Dict[str, Any] = {"sub_qa": [], "step_timings": []}
+
+  def add(
+      self, query_bundle: QueryBundle, response: Response, seconds: float
+  ) -> None:
+    _logger.info(f"Answered {query_bundle.query_str!r} in {seconds:.2f}s")
+    self.text_chunks.append(
+        f"\nQuestion: {query_bundle.query_str}\n"
+        f"Answer: {response!s}")
+    self.source_nodes.extend(response.source_nodes)
+    self.metadata["sub_qa"].append((query_bundle.query_str, response))
+    self.metadata["step_timings"].append(
+        {"question": query_bundle.query_str, "seconds": seconds})
+    self.prev_reasoning += f"- {query_bundle.query_str}\n- {response!s}\n"
+
+  def result(
+      self,
+  ) -> Tuple[List[NodeWithScore], List[NodeWithScore], Dict[str, Any]]:
+    nodes = [
+        NodeWithScore(node=TextNode(text=text)) for text in self.text_chunks]
+    return nodes, self.source_nodes, self.metadata
+
+
+async def amulti_step_query(
+    query_bundle: QueryBundle,
+    *,
+    llm_predictor: BaseLLMPredictor,
+    step_decompose_prompt: BasePromptTemplate,
+    index_summary: str,
+    num_steps: int,
+    stop_fn: Callable[[Dict[str, Any]], bool],
+    aquery_step: Callable[[QueryBundle], Awaitable[Response]],
+    on_step: StepCallback | None = None,
+) -> Tuple[List[NodeWithScore], List[NodeWithScore], Dict[str, Any]]:
+  """Same as `MultiStepQueryEngine._query_multistep` but awaits every hop.
+
+  Returns:
+    The sub-question/answer nodes to synthesize from, the source nodes of all
+    the sub-answers and the response metadata, which includes the time taken
+    by each step under `step_timings`.
+  """
+  steps = _Steps()
+  await _arun_sequential_steps(
+      steps,
+      query_bundle,
+      llm_predictor=llm_predictor,
+      step_decompose_prompt=step_decompose_prompt,
+      index_summary=index_summary,
+      num_steps=num_steps,
+      stop_fn=stop_fn,
+      aquery_step=aquery_step,
+      on_step=on_step)
+  return steps.result()
+
+
+async def aparallel_multi_step_query(
+    query_bundle: QueryBundle,
+    *,
+    llm_predictor: BaseLLMPredictor,
+    decompose_prompt: BasePromptTemplate,
+    step_decompose_prompt: BasePromptTemplate,
+    index_summary: str,
+    num_steps: int,
+    max_concurrency: int,
+    stop_fn: Callable[[Dict[str, Any]], bool],
+    aquery_step: Callable[[QueryBundle], Awaitable[Response]],
+    on_step: StepCallback | None = None,
+) -> Tuple[List[NodeWithScore], List[NodeWithScore], Dict[str, Any]]:
+  """Like `amulti_step_query`, but answers independent sub-questions at once.
+
+  `decompose_prompt` asks for the sub-questions that do not depend on each
+  other's answers, given `query_str`, `context_str` and `max_questions`.
+  They are answered concurrently, at most `max_concurrency` at a time. Any
+  remaining steps then run sequentially like `amulti_step_query`, for the
+  follow-up questions that do depend on those answers.
+  """
+  steps = _Steps()
+
+  start = time.perf_counter()
+  sub_questions = await _adecompose_query(
+      llm_predictor,
+      decompose_prompt,
+      query_bundle,
+      index_summary=index_summary,
+      max_questions=num_steps)
+  steps.metadata["decompose_seconds"] = time.perf_counter() - start
+
+  semaphore = asyncio.Semaphore(max_concurrency)
+
+  async def answer(sub_question: QueryBundle) -> Tuple[Response, float]:
+    async with semaphore:
+      start = time.perf_counter()
+      response = await aquery_step(sub_question)
+      seconds = time.perf_counter() - start
+    if on_step is not None:
+      await on_step(sub_question, response)
+    return response, seconds
+
+  answers = await asyncio.gather(*[answer(q) for q in sub_questions])
+  for sub_question, (response, seconds) in zip(sub_questions, answers):
+    steps.add(sub_question, response, seconds)
+
+  await _arun_sequential_steps(
+      steps,
+      query_bundle,
+      llm_predictor=llm_predictor,
+      step_decompose_prompt=step_decompose_prompt,
+      index_summary=index_summary,
+      num_steps=num_steps - len(sub_questions),
+      stop_fn=stop_fn,
+      aquery_step=aquery_step,
+      on_step=on_step)
+  return steps.result()
+
+
+async def _arun_sequential_steps(
+    steps: _Steps,
+    query_bundle: QueryBundle,
+    *,
+    llm_predictor: BaseLLMPredictor,
+    step_decompose_prompt: BasePromptTemplate,
+    index_summary: str,
+    num_steps: int,
+    stop_fn: Callable[[Dict[str, Any]], bool],
+    aquery_step: Callable[[QueryBundle], Awaitable[Response]],
+    on_step: StepCallback | None,
+) -> None:
+  for _ in range(num_steps):
+    step_query_bundle = await astep_decompose(
+        llm_predictor,
+        step_decompose_prompt,
+        query_bundle,
+        prev_reasoning=steps.prev_reasoning,
+        index_summary=index_summary)
+    if stop_fn({"query_bundle": step_query_bundle}):
+      break
+
+    start = time.perf_counter()
+    step_response = await aquery_step(step_query_bundle)
+    seconds = time.perf_counter() - start
+    if on_step is not None:
+      await on_step(step_query_bundle, step_response)
+    steps.add(step_query_bundle, step_response, seconds)
+
+
+async def _adecompose_query(
+    llm_predictor: BaseLLMPredictor,
+    decompose_prompt: BasePromptTemplate,
+    query_bundle: QueryBundle,
+    *,
+    index_summary: str,
+    max_questions: int,
+) -> List[QueryBundle]:
+  raw_response = await llm_predictor.apredict(
+      decompose_prompt,
+      query_str=query_bundle.query_str,
+      context_str=index_summary,
+      max_questions=str(max_questions),
+  )
+  sub_questions: List[str] = []
+  for line in raw_response.splitlines():
+    question = _LIST_MARKER.sub("", line).strip()
+    if question == "" or question.lower() == "none":
+      continue
+    if question not in sub_questions:
+      sub_questions.append(question)
+  return [QueryBundle(question) for question in sub_questions[:max_questions]]
+
+
+async def astream_steps(
+    astream: Callable[[StepCallback], AsyncIterator[ConversationEvent]],
+) -> AsyncIterator[ConversationEvent]:
+  """Streams the events of `astream`, with a `step` event for each step.
+
+  `astream` reports its steps through the callback it is given. Its failure
+  is raised once the events before it are streamed.
+  """
+  # None once `astream` is done.
+  events: asyncio.Queue[ConversationEvent | None] = asyncio.Queue()
+
+  async def on_step(query_bundle: QueryBundle, response: Response) -> None:
+    await events.put(ConversationEvent(
+        event="step",
+        text=query_bundle.query_str,
+        answer=AttributedAnswer(answer=str(response)),
+    ))
+
+  async def run() -> None:
+    try:
+      async for event in astream(on_step):
+        await events.put(event)
+    finally:
+      await events.put(None)
+
+  task = asyncio.create_task(run())
+  try:
+    while (event := await events.get()) is not None:
+      yield event
+    await task
+  finally:
+    # A no-op once answered; stops the work if the client went away early.
+    task.cancel()
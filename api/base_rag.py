@@ -1,14 +1,23 @@
 from abc import ABC, abstractmethod
+import asyncio
 import google.ai.generativelanguage as genai
+from llama_index.llms.base import LLM
 from llama_index.response_synthesizers.google.generativeai import (
     GoogleTextSynthesizer,
 )
+import logging
 from openai._types import FileContent
 from pydantic import BaseModel
-from typing import Iterable
+import time
+from typing import AsyncIterator, Iterable, List, Literal, NamedTuple, Sequence
 from .llms import Gemini, PaLM
 
 
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
 TEMPERATURE = 0.2
 ANSWER_STYLE = genai.GenerateAnswerRequest.AnswerStyle.ABSTRACTIVE
 SAFETY_SETTING = [
@@ -25,6 +34,12 @@ SAFETY_SETTING = [
 ]
 # Maximum number of passage to use to answer questions.
 PASSAGE_COUNT = 3
+# How many files of one add_files call are ingested at the same time.
+MAX_CONCURRENT_FILES = 4
+# How many file names list_file_page returns by default.
+FILE_PAGE_SIZE = 100
+# The most file names list_file_page returns at once.
+MAX_FILE_PAGE_SIZE = 1000
 
 
 class AttributedAnswer(BaseModel):
@@ -33,6 +48,40 @@ class AttributedAnswer(BaseModel):
     score: float | None = None
 
 
+class NewFile(NamedTuple):
+    filename: str
+    content: FileContent
+    content_type: str
+
+
+class FileStatus(BaseModel):
+    filename: str
+    ok: bool
+    error: str | None = None
+    seconds: float
+
+
+class FilePage(BaseModel):
+    filenames: List[str]
+    # Where the next page starts, or None if this is the last one.
+    next_cursor: str | None = None
+
+
+class ConversationEvent(BaseModel):
+    """One event of a streamed conversation turn.
+
+    `step` events report intermediate reasoning (`text` is the sub-question
+    and `answer` its answer), `delta` events carry answer text as soon as it
+    is available, and a trailing `answer` event carries each full answer with
+    its citations and score. If answering fails midway, a final `error` event
+    carries the reason in `text` instead.
+    """
+
+    event: Literal["step", "delta", "answer", "error"]
+    text: str | None = None
+    answer: AttributedAnswer | None = None
+
+
 class BaseRag(BaseModel, ABC):
     @classmethod
     @abstractmethod
@@ -41,19 +90,135 @@ class BaseRag(BaseModel, ABC):
     @abstractmethod
     async def list_files(self) -> Iterable[str]: ...
 
+    async def list_file_page(
+        self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+    ) -> FilePage:
+        """The file names after `cursor`, at most `limit` of them.
+
+        This pages through `list_files` by position, so it still lists every
+        file each time. Stacks that can do better override it.
+        """
+        filenames = sorted(await self.list_files())
+        start = int(cursor) if cursor is not None else 0
+        end = start + limit
+        return FilePage(
+            filenames=filenames[start:end],
+            next_cursor=str(end) if end < len(filenames) else None,
+        )
+
     @abstractmethod
     async def add_file(
         self, *, filename: str, content: FileContent, content_type: str
     ) -> None: ...
 
+    async def add_files(self, files: Sequence[NewFile]) -> List[FileStatus]:
+        """Adds `files` concurrently, `MAX_CONCURRENT_FILES` at a time.
+
+        A file that fails does not fail the others; check the status of each.
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+
+        async def add_one(file: NewFile) -> FileStatus:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await self.add_file(
+                        filename=file.filename,
+                        content=file.content,
+                        content_type=file.content_type,
+                    )
+                except Exception as e:
+                    _logger.warning(
+                        f"Failed to add {file.filename}", exc_info=True)
+                    return FileStatus(
+                        filename=file.filename,
+                        ok=False,
+                        error=str(e),
+                        seconds=time.perf_counter() - start,
+                    )
+                return FileStatus(
+                    filename=file.filename,
+                    ok=True,
+                    seconds=time.perf_counter() - start,
+                )
+
+        return list(await asyncio.gather(*[add_one(file) for file in files]))
+
     @abstractmethod
     async def clear_files(self) -> None: ...
 
+    def corpus_version(self) -> int | None:
+        """Changes whenever the files this stack answers from change.
+
+        Answers are only cached for stacks that have one, and whose answers
+        do not depend on the earlier turns of the conversation.
+        """
+        return None
+
     @abstractmethod
     async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]: ...
 
+    async def stream_conversation(
+        self, message: str
+    ) -> AsyncIterator[ConversationEvent]:
+        """Same as `add_conversation`, as events of `_astream_conversation`.
+
+        If answering fails midway, the events so far are followed by an
+        `error` event.
+        """
+        try:
+            async for event in self._astream_conversation(message):
+                yield event
+        except Exception as e:
+            _logger.warning(f"Cannot answer {message!r}", exc_info=True)
+            yield ConversationEvent(event="error", text=str(e))
+
+    async def _astream_conversation(
+        self, message: str
+    ) -> AsyncIterator[ConversationEvent]:
+        """Streams the answers of `add_conversation` once they are complete.
+
+        Stacks that answer with an LLM override this to stream its text.
+        """
+        for answer in await self.add_conversation(message):
+            yield ConversationEvent(event="delta", text=answer.answer)
+            yield ConversationEvent(event="answer", answer=answer)
+
+    def record_turn(
+        self, message: str, answers: Iterable[AttributedAnswer]
+    ) -> None:
+        """Records a turn that was answered without the stack, from a cache.
+
+        Only stacks with a `corpus_version` have their answers cached.
+        """
+
     @abstractmethod
-    async def clear_conversation(self) -> None: ...
+    async def start_conversation(self) -> None:
+        """Starts a new conversation.
+
+        Must replace the conversation state rather than mutate it, as
+        `new_session` copies share the state of the stack they came from.
+        """
+
+    def close_conversation(self) -> None:
+        """Releases what the conversation holds beyond the stack itself,
+        such as the turns it spilled to disk."""
+
+    async def clear_conversation(self) -> None:
+        self.close_conversation()
+        await self.start_conversation()
+
+    async def new_session(self) -> "BaseRag":
+        """A copy of this stack for another conversation.
+
+        The copy is shallow, so the store, index, LLMs and synthesizer are
+        shared. Only the conversation is reset, by `start_conversation`.
+        The conversation of this stack is left open, as it is not the
+        copy's to close.
+        """
+        session = self.model_copy()
+        await session.start_conversation()
+        return session
 
 
 def build_response_synthesizer() -> GoogleTextSynthesizer:
@@ -64,6 +229,18 @@ def build_response_synthesizer() -> GoogleTextSynthesizer:
     )
 
 
+def with_completion_cache(llm: LLM) -> LLM:
+    """`llm`, memoizing its completions if it can.
+
+    For prompts that repeat and whose completion may as well repeat too, such
+    as query decomposition, HyDE and reranking, even above the temperature
+    up to which completions are memoized by default.
+    """
+    if isinstance(llm, (Gemini, PaLM)) and not llm.cache_completions:
+        return llm.copy(update={"cache_completions": True})
+    return llm
+
+
 def build_gemini_pro() -> Gemini:
     return Gemini(model_name="models/gemini-pro")
 
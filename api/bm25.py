@@ -0,0 +1,110 @@
+"""Okapi BM25 scoring on the CPU.
+
+`BM25Rerank` reorders retrieved nodes by term overlap with the query. It is
+cheap enough to run on every query, so it can pre-filter the candidates before
+`LLMRerank` sees them, or replace the LLM round trip altogether.
+"""
+from collections import Counter
+from llama_index.bridge.pydantic import Field
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+import numpy as np
+import numpy.typing as npt
+import re
+from typing import List, Optional, Sequence
+
+
+DEFAULT_K1 = 1.5
+DEFAULT_B = 0.75
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+  return _TOKEN.findall(text.lower())
+
+
+def bm25_scores(
+    query: str,
+    documents: Sequence[str],
+    *,
+    k1: float = DEFAULT_K1,
+    b: float = DEFAULT_B,
+) -> npt.NDArray[np.float64]:
+  """Scores each of `documents` against `query`.
+
+  The document frequencies come from `documents` themselves, so the scores are
+  only comparable within one call.
+  """
+  terms = sorted(set(tokenize(query)))
+  if not documents or not terms:
+    return np.zeros(len(documents))
+
+  counts = [Counter(tokenize(document)) for document in documents]
+  # tf[i, j] is how often terms[j] occurs in documents[i].
+  tf = np.array(
+      [[count[term] for term in terms] for count in counts],
+      dtype=np.float64)
+  lengths = np.array(
+      [sum(count.values()) for count in counts], dtype=np.float64)
+
+  df = np.count_nonzero(tf, axis=0)
+  idf = np.log1p((len(documents) - df + 0.5) / (df + 0.5))
+  norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+  scores: npt.NDArray[np.float64] = (
+      tf * (k1 + 1) / (tf + norm[:, np.newaxis])) @ idf
+  return scores
+
+
+class BM25Rerank(BaseNodePostprocessor):
+  """Keeps the `top_n` nodes with the best BM25 score.
+
+  With `lexical_weight` below 1 the BM25 score is blended with the retriever's
+  similarity score, each min-max normalized over the candidates.
+  """
+  top_n: int = Field(description="Number of nodes to keep.")
+  lexical_weight: float = Field(
+      default=1.0, description="Weight of BM25 against the retriever score.")
+  k1: float = Field(default=DEFAULT_K1)
+  b: float = Field(default=DEFAULT_B)
+
+  @classmethod
+  def class_name(cls) -> str:
+    return "BM25Rerank"
+
+  def _postprocess_nodes(
+      self,
+      nodes: List[NodeWithScore],
+      query_bundle: Optional[QueryBundle] = None,
+  ) -> List[NodeWithScore]:
+    if query_bundle is None:
+      raise ValueError("Missing query bundle.")
+    if not nodes:
+      return []
+
+    scores = _normalize(bm25_scores(
+        query_bundle.query_str,
+        [node.node.get_content() for node in nodes],
+        k1=self.k1,
+        b=self.b))
+    if self.lexical_weight < 1 and all(
+        node.score is not None for node in nodes):
+      similarities = _normalize(
+          np.array([node.score for node in nodes], dtype=np.float64))
+      scores = (self.lexical_weight * scores
+                + (1 - self.lexical_weight) * similarities)
+
+    # Stable, so ties keep the retriever's order.
+    order = np.argsort(-scores, kind="stable")[:self.top_n]
+    return [
+        NodeWithScore(node=nodes[i].node, score=float(scores[i]))
+        for i in order
+    ]
+
+
+def _normalize(scores: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+  spread = scores.max() - scores.min()
+  if spread == 0:
+    return np.zeros_like(scores)
+  normalized: npt.NDArray[np.float64] = (scores - scores.min()) / spread
+  return normalized
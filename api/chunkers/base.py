@@ -1 +1,24 @@
+import hashlib
+
+
 MAX_CHUNK_SIZE = 2000
+# Google's Semantic Retriever takes ids of up to 40 lowercase letters, digits
+# and dashes.
+_ID_LENGTH = 40
+
+
+def document_id(filename: str) -> str:
+  """A stable id for the document uploaded as `filename`.
+
+  Uploading a new version of a file then updates the same document.
+  """
+  return _hash(filename)
+
+
+def chunk_id(text: str) -> str:
+  """Content address of a chunk, so an unchanged chunk keeps its id."""
+  return _hash(" ".join(text.split()))
+
+
+def _hash(text: str) -> str:
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()[:_ID_LENGTH]
@@ -1,8 +1,8 @@
+from itertools import islice
 from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
 import logging
 from typing import Iterable, List, TypeAlias
-import uuid
-from .base import MAX_CHUNK_SIZE
+from .base import chunk_id, document_id, MAX_CHUNK_SIZE
 
 
 _logger = logging.getLogger(__name__)
@@ -11,13 +11,38 @@ _logger.addHandler(logging.StreamHandler())
 
 
 Section: TypeAlias = List[str]
-Stack: TypeAlias = List[Section]
+
+
+class Level:
+  """A header with its body lines, as one level of the header stack.
+
+  Ancestors stop growing once a subsection is pushed on top of them, so the
+  context they give their subsections is joined and truncated only once.
+  """
+  __slots__ = ("section", "depth", "context", "_child_context")
+
+  def __init__(self, header: str, depth: int, context: str | None) -> None:
+    self.section: Section = [header]
+    self.depth = depth
+    # The truncated ancestor sections, or None at the top level.
+    self.context = context
+    self._child_context: str | None = None
+
+  def child_context(self) -> str:
+    if self._child_context is None:
+      text = "\n".join(self.section)[:MAX_CHUNK_SIZE]
+      self._child_context = (
+          text if self.context is None else f"{self.context}\n{text}")
+    return self._child_context
+
+
+Stack: TypeAlias = List[Level]
 
 
 def chunk_markdown(
     filename: str, content: Iterable[bytes]
 ) -> Iterable[TextNode]:
-  doc_id = str(uuid.uuid4())
+  doc_id = document_id(filename)
   stack: Stack = []
   for raw_line in content:
     line = raw_line.decode('utf-8').strip()
@@ -34,71 +59,52 @@ def chunk_markdown(
 def stack_to_text_node(
     stack: Stack, *, filename: str, doc_id: str
 ) -> Iterable[TextNode]:
-  context_sections = stack[:-1]
-  last_section = stack[-1]
-
-  context = "\n".join(
-      ["\n".join(section)[:MAX_CHUNK_SIZE] for section in context_sections]
+  last_level = stack[-1]
+  context = last_level.context or ""
+  # Validating the pydantic models dominates chunking, so the source is built
+  # once. TextNode copies it on validation.
+  source = RelatedNodeInfo(
+      node_id=doc_id,
+      metadata={"file_name": filename},
   )
-  for chunk in chunk_section(last_section):
+  for chunk in chunk_section(last_level.section):
+    text = f"{context}\n{chunk}"
     yield TextNode(
-        text="\n".join([context, chunk]),
-        relationships={
-            NodeRelationship.SOURCE: RelatedNodeInfo(
-                node_id=doc_id,
-                metadata={"file_name": filename},
-            )
-        },
+        id_=chunk_id(text),
+        text=text,
+        relationships={NodeRelationship.SOURCE: source},
     )
 
 
 def chunk_section(section: Section) -> Iterable[str]:
-  text: List[str] = [section[0]]
-  text_len = sum([len(line) for line in text])
-  for line in section[1:]:
+  header = section[0]
+  text: List[str] = [header]
+  text_len = len(header)
+  for line in islice(section, 1, None):
     line_len = len(line)
     if text_len + line_len < MAX_CHUNK_SIZE:
       text.append(line)
       text_len += line_len
       continue
     yield "\n".join(text)[:MAX_CHUNK_SIZE]
-    text = [section[0], line]
-    text_len = sum([len(line) for line in text])
-  if len(text) > 0:
-    yield "\n".join(text)[:MAX_CHUNK_SIZE]
+    text = [header, line]
+    text_len = len(header) + line_len
+  yield "\n".join(text)[:MAX_CHUNK_SIZE]
 
 
 def add_to_stack(stack: Stack, line: str) -> None:
   assert line.startswith("#")
   line_depth = compute_header_depth(line)
 
-  while True:
-    if len(stack) == 0:
-      stack.append([line])
-      break
-
-    section = stack[-1]
-    header = section[0]
-
-    assert header.startswith("#")
-    header_depth = compute_header_depth(header)
-
-    if line_depth > header_depth:
-      stack.append([line])
-      return
-
+  while len(stack) > 0 and stack[-1].depth >= line_depth:
     del stack[-1]
 
+  context = stack[-1].child_context() if len(stack) > 0 else None
+  stack.append(Level(line, line_depth, context))
 
-def compute_header_depth(header: str) -> int:
-  count = 0
-  for char in header:
-    if char == '#':
-        count += 1
-    else:
-        break
-  return count
 
+def compute_header_depth(header: str) -> int:
+  return len(header) - len(header.lstrip("#"))
 
 
 def add_to_last_section(stack: Stack, line: str) -> None:
@@ -106,5 +112,4 @@ def add_to_last_section(stack: Stack, line: str) -> None:
   if len(stack) == 0:
     return
 
-  last_section = stack[-1]
-  last_section.append(line)
+  stack[-1].section.append(line)
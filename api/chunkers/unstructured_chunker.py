@@ -1,24 +1,41 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+import logging
+import multiprocessing
 from openai._types import FileContent
-from tempfile import SpooledTemporaryFile
-from typing import Iterable
-import uuid
+import os
+import shutil
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+import threading
+from typing import Iterable, List
 from unstructured.partition.auto import partition  # type: ignore
-from .base import MAX_CHUNK_SIZE
+from .base import chunk_id, document_id, MAX_CHUNK_SIZE
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Partitioning PDFs and images is CPU bound, so it runs in worker processes
+# instead of holding the GIL of the server. This also caps how many
+# partitions run at once.
+MAX_CONCURRENT_PARTITIONS = max(1, (os.cpu_count() or 1) // 2)
 
 
 def chunk_unstructured(
     filename: str, content: FileContent, content_type: str
 ) -> Iterable[TextNode]:
     assert isinstance(content, SpooledTemporaryFile)
-    elements = partition(file=content, content_type=content_type)
-    text_chunks = [" ".join(str(el).split()) for el in elements]
+    text_chunks = _partition_in_pool(filename, content, content_type)
 
-    doc_id = str(uuid.uuid4())
+    doc_id = document_id(filename)
 
     for chunk in text_chunks:
         for chunklet in split_chunk(chunk):
             yield TextNode(
+                id_=chunk_id(chunklet),
                 text=chunklet,
                 relationships={
                     NodeRelationship.SOURCE: RelatedNodeInfo(
@@ -34,3 +51,55 @@ def split_chunk(chunk: str) -> Iterable[str]:
     while i < len(chunk):
         yield chunk[i:i+MAX_CHUNK_SIZE]
         i += MAX_CHUNK_SIZE
+
+
+def _partition_in_pool(
+    filename: str, content: SpooledTemporaryFile[bytes], content_type: str
+) -> List[str]:
+    # Hand the worker a path rather than pickling the whole upload. Keep the
+    # extension in case partition falls back to it to detect the file type.
+    _, extension = os.path.splitext(filename)
+    with NamedTemporaryFile(suffix=extension) as spilled:
+        content.seek(0)
+        shutil.copyfileobj(content, spilled)
+        spilled.flush()
+        pool = _get_pool()
+        try:
+            return pool.submit(
+                _partition_file, spilled.name, content_type).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for memory. Start afresh next time.
+            _reset_pool(pool)
+            raise
+
+
+def _partition_file(path: str, content_type: str) -> List[str]:
+    """Runs in a worker process."""
+    elements = partition(filename=path, content_type=content_type)
+    return [" ".join(str(el).split()) for el in elements]
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _logger.info(
+                f"Starting {MAX_CONCURRENT_PARTITIONS} partition workers.")
+            # The server is multithreaded, so fork is unsafe.
+            _pool = ProcessPoolExecutor(
+                max_workers=MAX_CONCURRENT_PARTITIONS,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
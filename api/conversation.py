@@ -0,0 +1,151 @@
+"""Bounded conversation histories.
+
+The stacks record every turn of a conversation, but nothing reads old turns
+back while answering. A `ConversationHistory` keeps only the latest turns, up
+to `MAX_TURNS` and `MAX_BYTES`, as slim records that cite chunks by id rather
+than copying their text. If `RAG_CONVERSATION_DIR` is set, the turns pushed
+out are appended to a JSON lines file there instead of being dropped, until
+the conversation is closed and the file deleted.
+"""
+from collections import deque
+import json
+import logging
+import os
+import threading
+from typing import Deque, Iterator, Sequence, Tuple
+import uuid
+from .base_rag import AttributedAnswer
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+MAX_TURNS = 50
+MAX_BYTES = 256 * 1024
+CONVERSATION_DIR = os.environ.get("RAG_CONVERSATION_DIR")
+
+
+class Turn:
+  __slots__ = ("question", "answer", "citation_ids", "score")
+
+  def __init__(
+      self,
+      question: str,
+      answer: str,
+      citation_ids: Tuple[str, ...],
+      score: float | None,
+  ) -> None:
+    self.question = question
+    self.answer = answer
+    self.citation_ids = citation_ids
+    self.score = score
+
+  def size(self) -> int:
+    return (len(self.question) + len(self.answer)
+            + sum(len(chunk_id) for chunk_id in self.citation_ids))
+
+  def to_json(self) -> str:
+    return json.dumps({
+        "question": self.question,
+        "answer": self.answer,
+        "citation_ids": self.citation_ids,
+        "score": self.score,
+    })
+
+  @classmethod
+  def from_json(cls, line: str) -> "Turn":
+    data = json.loads(line)
+    return cls(
+        question=data["question"],
+        answer=data["answer"],
+        citation_ids=tuple(data["citation_ids"]),
+        score=data["score"])
+
+
+class ConversationHistory:
+  """The latest turns of one conversation, oldest first."""
+
+  def __init__(
+      self,
+      *,
+      max_turns: int = MAX_TURNS,
+      max_bytes: int = MAX_BYTES,
+      spill_dir: str | None = CONVERSATION_DIR,
+  ) -> None:
+    self._lock = threading.Lock()
+    self._turns: Deque[Turn] = deque()
+    self._bytes = 0
+    self._max_turns = max_turns
+    self._max_bytes = max_bytes
+    self._spill_path = (
+        None if spill_dir is None
+        else os.path.join(spill_dir, f"{uuid.uuid4().hex}.jsonl"))
+
+  def __len__(self) -> int:
+    with self._lock:
+      return len(self._turns)
+
+  def __iter__(self) -> Iterator[Turn]:
+    with self._lock:
+      return iter(list(self._turns))
+
+  def append(
+      self,
+      question: str,
+      answer: AttributedAnswer,
+      citation_ids: Sequence[str],
+  ) -> None:
+    turn = Turn(
+        question=question,
+        answer=answer.answer,
+        citation_ids=tuple(citation_ids),
+        score=answer.score)
+    with self._lock:
+      self._turns.append(turn)
+      self._bytes += turn.size()
+      evicted = []
+      # The latest turn is kept even if it alone is too large.
+      while len(self._turns) > 1 and (
+          len(self._turns) > self._max_turns or self._bytes > self._max_bytes):
+        old = self._turns.popleft()
+        self._bytes -= old.size()
+        evicted.append(old)
+      if evicted and self._spill_path is not None:
+        self._spill(evicted)
+
+  def close(self) -> None:
+    """Deletes the spilled turns. Turns pushed out later are dropped."""
+    with self._lock:
+      spill_path, self._spill_path = self._spill_path, None
+    if spill_path is None:
+      return
+    try:
+      os.remove(spill_path)
+    except FileNotFoundError:
+      pass
+    except OSError:
+      _logger.warning(f"Could not delete {spill_path}", exc_info=True)
+
+  def spilled(self) -> Iterator[Turn]:
+    """The turns pushed out to disk so far, oldest first."""
+    if self._spill_path is None:
+      return
+    try:
+      with open(self._spill_path, "r", encoding="utf-8") as f:
+        for line in f:
+          yield Turn.from_json(line)
+    except FileNotFoundError:
+      return
+
+  def _spill(self, turns: Sequence[Turn]) -> None:
+    assert self._spill_path is not None
+    try:
+      os.makedirs(os.path.dirname(self._spill_path), exist_ok=True)
+      with open(self._spill_path, "a", encoding="utf-8") as f:
+        f.writelines(turn.to_json() + "\n" for turn in turns)
+    except OSError:
+      _logger.warning(
+          f"Dropping {len(turns)} turns that could not be written to "
+          f"{self._spill_path}", exc_info=True)
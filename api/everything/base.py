@@ -1,44 +1,70 @@
 import asyncio
 from llama_index import (
     LLMPredictor,
-    ServiceContext,
     VectorStoreIndex,
 )
+from llama_index.core import BaseRetriever
 from llama_index.llms.base import LLM
-from llama_index.query_engine import RetrieverQueryEngine
-import llama_index.vector_stores.google.generativeai.genai_extension as genaix
-from llama_index.vector_stores.google.generativeai import (
-    GoogleVectorStore,
-    google_service_context,
-)
-from llama_index.indices.query.base import BaseQueryEngine
-from llama_index.indices.query.query_transform.base import (
-    StepDecomposeQueryTransform,
-)
-from llama_index.postprocessor import LLMRerank
+from llama_index.vector_stores.google.generativeai import google_service_context
+from llama_index.postprocessor.types import BaseNodePostprocessor
 from llama_index.prompts.base import PromptTemplate
-from llama_index.query_engine.multistep_query_engine import (
-    MultiStepQueryEngine,
-)
 from llama_index.response.schema import Response
-from llama_index.retrievers import VectorIndexRetriever
-from llama_index.schema import QueryBundle
+from llama_index.response_synthesizers.google.generativeai import (
+    GoogleTextSynthesizer,
+)
+from llama_index.schema import BaseNode, NodeWithScore, QueryBundle
 import logging
 from openai._types import FileContent
-from pydantic import BaseModel, PrivateAttr
+from pydantic import PrivateAttr
 from tempfile import SpooledTemporaryFile
-from typing import Any, cast, Dict, Iterable, List, Literal
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    cast,
+    Dict,
+    Iterable,
+    List,
+    Tuple,
+)
+from ..async_query import (
+    amulti_step_query,
+    apostprocess,
+    aretrieve,
+    astream_answer,
+    asynthesize,
+    astream_steps,
+    StepCallback,
+)
 from ..base_rag import (
     AttributedAnswer,
     BaseRag,
+    ConversationEvent,
+    FILE_PAGE_SIZE,
+    FilePage,
     build_response_synthesizer,
     PASSAGE_COUNT,
+    with_completion_cache,
 )
 from ..chunkers import chunk_markdown, chunk_unstructured
+from ..conversation import ConversationHistory
+from .. import ingest
+from ..local_store import (
+    AnyVectorStore,
+    build_retriever,
+    create_vector_store,
+    open_vector_store,
+)
 from ..reranker.base import (
-    CHOICE_BATCH_SIZE,
+    build_rerankers,
+    HYBRID_OVER_RETRIEVE_FACTOR,
+    HYBRID_RETRIEVAL,
     OVER_RETRIEVE_FACTOR,
+    RERANK_BATCH_SIZE,
+    RERANK_CONCURRENCY,
+    RERANK_MERGE,
 )
+from ..retrieval_cache import CachedRetriever
 
 
 _logger = logging.getLogger(__name__)
@@ -46,12 +72,9 @@ _logger.setLevel(logging.INFO)
 _logger.addHandler(logging.StreamHandler())
 
 
-class ConversationMessage(BaseModel):
-  role: Literal["assistant", "user"]
-  message: AttributedAnswer
-
-
 DEFAULT_CORPUS_ID = "ltsang-markdown"
+STEP_COUNT = 6
+_INDEX_SUMMARY = "Ask me anything."
 _STEP_DECOMPOSE_QUERY_TRANSFORM_TMPL = (
     "The original question is as follows: {query_str}\n"
     "We have an opportunity to answer some, or all of the question from a "
@@ -110,15 +133,21 @@ _STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT = PromptTemplate(
   _STEP_DECOMPOSE_QUERY_TRANSFORM_TMPL)
 
 class EverythingBaseRag(BaseRag):
-  _store: GoogleVectorStore = PrivateAttr()
-  _query_engine: BaseQueryEngine = PrivateAttr()
+  _store: AnyVectorStore = PrivateAttr()
+  _retriever: BaseRetriever = PrivateAttr()
+  _rerankers: List[BaseNodePostprocessor] = PrivateAttr()
+  _response_synthesizer: GoogleTextSynthesizer = PrivateAttr()
+  _llm_predictor: LLMPredictor = PrivateAttr()
+  # Streams the answers of `stream_conversation`.
+  _llm: LLM = PrivateAttr()
 
-  conversation: List[ConversationMessage] = []
+  _conversation: ConversationHistory = PrivateAttr(
+      default_factory=ConversationHistory)
 
   def __init__(
       self,
       *,
-      store: GoogleVectorStore,
+      store: AnyVectorStore,
       llm: LLM
    ) -> None:
     super().__init__()
@@ -127,34 +156,22 @@ class EverythingBaseRag(BaseRag):
         vector_store=store,
         service_context=google_service_context)
     response_synthesizer = build_response_synthesizer()
-    reranker = LLMRerank(
-        top_n=PASSAGE_COUNT,
-        choice_batch_size=CHOICE_BATCH_SIZE,
-        service_context=ServiceContext.from_defaults(llm=llm),
-    )
+    rerankers = build_rerankers(llm)
 
-    single_step_query_engine = RetrieverQueryEngine.from_args(
-      retriever=VectorIndexRetriever(
-          index=index,
-          similarity_top_k=PASSAGE_COUNT * OVER_RETRIEVE_FACTOR,
-      ),
-      response_synthesizer=response_synthesizer,
-      node_postprocessors=[reranker],
-    )
-    step_decompose_transform = StepDecomposeQueryTransform(
-        LLMPredictor(llm=llm),
-        step_decompose_query_prompt=_STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT,
-        verbose=True)
-    query_engine = MultiStepQueryEngine(
-        query_engine=single_step_query_engine,
-        query_transform=step_decompose_transform,
-        response_synthesizer=response_synthesizer,
-        index_summary="Ask me anything.",
-        stop_fn=_stop_fn,
-        num_steps=6)
+    retriever = CachedRetriever(
+        build_retriever(
+            index,
+            similarity_top_k=PASSAGE_COUNT * OVER_RETRIEVE_FACTOR,
+            hybrid_top_k=(PASSAGE_COUNT * HYBRID_OVER_RETRIEVE_FACTOR
+                          if HYBRID_RETRIEVAL else None)),
+        version=lambda: ingest.corpus_version(store.corpus_id))
 
     self._store = store
-    self._query_engine = query_engine
+    self._retriever = retriever
+    self._rerankers = rerankers
+    self._response_synthesizer = response_synthesizer
+    self._llm_predictor = LLMPredictor(llm=with_completion_cache(llm))
+    self._llm = llm
 
   @classmethod
   async def create(
@@ -170,7 +187,7 @@ class EverythingBaseRag(BaseRag):
       cls, *, corpus_id: str, display_name: str, llm: LLM
   ) -> BaseRag:
     return cls(
-      store=GoogleVectorStore.create_corpus(
+      store=create_vector_store(
           corpus_id=corpus_id,
           display_name=display_name),
       llm=llm)
@@ -183,18 +200,21 @@ class EverythingBaseRag(BaseRag):
   @classmethod
   def _get(cls, *, corpus_id: str, llm: LLM) -> BaseRag:
     return cls(
-        store=GoogleVectorStore.from_corpus(corpus_id=corpus_id),
+        store=open_vector_store(corpus_id=corpus_id),
         llm=llm)
 
   async def list_files(self) -> Iterable[str]:
     return await asyncio.to_thread(lambda: self._list_files())
 
   def _list_files(self) -> Iterable[str]:
-    return [
-        document.display_name or "?"
-        for document in genaix.list_documents(
-            corpus_id=self._store.corpus_id)
-    ]
+    return ingest.list_files(ingest.get_corpus(self._store)).filenames
+
+  async def list_file_page(
+      self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+  ) -> FilePage:
+    return await asyncio.to_thread(
+        lambda: ingest.list_files(
+            ingest.get_corpus(self._store), cursor=cursor, limit=limit))
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
@@ -210,28 +230,84 @@ class EverythingBaseRag(BaseRag):
   ) -> None:
     assert isinstance(content, SpooledTemporaryFile)
 
+    chunk: Callable[[], Iterable[BaseNode]]
     match content_type:
       case "text/markdown":
-        self._store.add(list(chunk_markdown(filename, content)))
+        chunk = lambda: chunk_markdown(filename, content)
       case _:
-        self._store.add(list(chunk_unstructured(filename, content, content_type)))
+        chunk = lambda: chunk_unstructured(filename, content, content_type)
+    ingest.add_file(
+        corpus=ingest.get_corpus(self._store),
+        filename=filename,
+        content=content,
+        chunk=chunk)
 
   async def clear_files(self) -> None:
-    return await asyncio.to_thread(lambda: self._clear_files())
+    await ingest.aclear_corpus(ingest.get_corpus(self._store))
 
-  def _clear_files(self) -> None:
-    for document in genaix.list_documents(corpus_id=self._store.corpus_id):
-      genaix.delete_document(
-          corpus_id=self._store.corpus_id, document_id=document.document_id
-      )
+  def corpus_version(self) -> int | None:
+    return ingest.corpus_version(self._store.corpus_id)
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    return await asyncio.to_thread(lambda: self._add_conversation(message))
-
-  def _add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    response = self._query_engine.query(message)
-    assert isinstance(response, Response)
-
+    return await self._aadd_conversation(message)
+
+  async def _aadd_conversation(self, message: str) -> Iterable[AttributedAnswer]:
+    query_bundle = QueryBundle(message)
+    nodes, source_nodes, metadata = await self._amulti_step_query(query_bundle)
+    response = await asynthesize(
+        self._response_synthesizer, query_bundle, nodes, source_nodes)
+    response.metadata = metadata
+    return self._record_conversation(message, response)
+
+  async def _astream_conversation(
+      self, message: str
+  ) -> AsyncIterator[ConversationEvent]:
+    async for event in astream_steps(
+        lambda on_step: self._astream_answer(message, on_step=on_step)):
+      yield event
+
+  async def _astream_answer(
+      self, message: str, *, on_step: StepCallback
+  ) -> AsyncIterator[ConversationEvent]:
+    query_bundle = QueryBundle(message)
+    nodes, source_nodes, _ = await self._amulti_step_query(
+        query_bundle, on_step=on_step)
+    async for event in astream_answer(
+        self._llm,
+        query_bundle,
+        nodes,
+        lambda response: self._record_conversation(message, response),
+        source_nodes):
+      yield event
+
+  async def _amulti_step_query(
+      self, query_bundle: QueryBundle, *, on_step: StepCallback | None = None
+  ) -> Tuple[List[NodeWithScore], List[NodeWithScore], Dict[str, Any]]:
+    return await amulti_step_query(
+        query_bundle,
+        llm_predictor=self._llm_predictor,
+        step_decompose_prompt=_STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT,
+        index_summary=_INDEX_SUMMARY,
+        num_steps=STEP_COUNT,
+        stop_fn=_stop_fn,
+        aquery_step=self._aquery_step,
+        on_step=on_step)
+
+  async def _aquery_step(self, query_bundle: QueryBundle) -> Response:
+    retrieved_nodes = await aretrieve(self._retriever, query_bundle)
+    reranked_nodes = await apostprocess(
+        self._rerankers,
+        retrieved_nodes,
+        query_bundle,
+        batch_size=RERANK_BATCH_SIZE,
+        max_concurrency=RERANK_CONCURRENCY,
+        merge=RERANK_MERGE)
+    return await asynthesize(
+        self._response_synthesizer, query_bundle, reranked_nodes)
+
+  def _record_conversation(
+      self, message: str, response: Response
+  ) -> Iterable[AttributedAnswer]:
     assistant_message = AttributedAnswer(
         answer=response.response or '',
         citations=[node.text
@@ -239,25 +315,26 @@ class EverythingBaseRag(BaseRag):
         score=_get_answerable_probability(response),
     )
 
-    self.conversation.extend(
-        [
-            ConversationMessage(
-                role="user",
-                message=AttributedAnswer(
-                    answer=message,
-                ),
-            ),
-            ConversationMessage(
-                role="assistant",
-                message=assistant_message,
-            ),
-        ]
+    self._conversation.append(
+        message,
+        assistant_message,
+        citation_ids=[node.node_id
+                      for node in response.source_nodes if node.score is None],
     )
 
     return [assistant_message]
 
-  async def clear_conversation(self) -> None:
-      self.conversation = []
+  def record_turn(
+      self, message: str, answers: Iterable[AttributedAnswer]
+  ) -> None:
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory()
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
 
 
 def _get_answerable_probability(response: Response) -> float | None:
@@ -1,30 +1,45 @@
 import asyncio
+from collections import OrderedDict
 import logging
 from llama_index import VectorStoreIndex
-from llama_index.indices.query.base import BaseQueryEngine
-from llama_index.indices.query.query_transform import HyDEQueryTransform
+from llama_index.core import BaseRetriever
 from llama_index.llm_predictor import LLMPredictor
 from llama_index.llms.base import LLM
-from llama_index.query_engine.transform_query_engine import (
-    TransformQueryEngine,
-)
+from llama_index.prompts.default_prompts import DEFAULT_HYDE_PROMPT
 from llama_index.response.schema import Response
-import llama_index.vector_stores.google.generativeai.genai_extension as genaix
-from llama_index.vector_stores.google.generativeai import (
-    GoogleVectorStore,
-    google_service_context,
+from llama_index.response_synthesizers.google.generativeai import (
+    GoogleTextSynthesizer,
 )
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.google.generativeai import google_service_context
 from openai._types import FileContent
-from pydantic import BaseModel, PrivateAttr
+from pydantic import PrivateAttr
 from tempfile import SpooledTemporaryFile
-from typing import Iterable, List, Literal
+import threading
+from typing import AsyncIterator, Iterable, List, NamedTuple, Tuple
+from ..async_query import ahyde, aretrieve, astream_answer, asynthesize
+from ..answer_cache import normalize
 from ..base_rag import (
     AttributedAnswer,
     BaseRag,
+    ConversationEvent,
+    FILE_PAGE_SIZE,
+    FilePage,
     build_gemini_pro,
-    build_response_synthesizer
+    build_response_synthesizer,
+    with_completion_cache,
 )
 from ..chunkers import chunk_unstructured
+from ..conversation import ConversationHistory
+from .. import ingest
+from ..lexical import reciprocal_rank_fusion
+from ..local_store import (
+    AnyVectorStore,
+    create_vector_store,
+    embed_query,
+    LocalVectorStore,
+    open_vector_store,
+)
 
 
 _logger = logging.getLogger(__name__)
@@ -33,36 +48,63 @@ _logger.addHandler(logging.StreamHandler())
 
 
 DEFAULT_CORPUS_ID = "ltsang-unstructured"
+SIMILARITY_TOP_K = 5
+# Hypothetical documents kept, by normalized question.
+HYDE_CACHE_SIZE = 512
+# Also retrieves for the plain question, while the hypothetical document is
+# generated and retrieved for, and fuses both rankings. The plain retrieval
+# then adds no latency: a query still waits for one LLM call and one
+# retrieval.
+HYDE_PARALLEL = True
+
+
+class _HypotheticalDocument(NamedTuple):
+  text: str
+  # Of the document and the question, as `embed_query` averages them.
+  embedding: List[float]
+
 
+_hypothetical_documents: OrderedDict[str, _HypotheticalDocument] = (
+    OrderedDict())
+_hypothetical_documents_lock = threading.Lock()
+_hyde_predictor: LLMPredictor | None = None
+_hyde_predictor_lock = threading.Lock()
 
-class ConversationMessage(BaseModel):
-  role: Literal["assistant", "user"]
-  message: AttributedAnswer
+
+def _get_hyde_predictor() -> LLMPredictor:
+  """The predictor of every HyDE stack, built once."""
+  global _hyde_predictor
+  with _hyde_predictor_lock:
+    if _hyde_predictor is None:
+      _hyde_predictor = LLMPredictor(with_completion_cache(build_gemini_pro()))
+    return _hyde_predictor
 
 
 class HydeBaseRag(BaseRag):
-  _store: GoogleVectorStore = PrivateAttr()
-  _query_engine: BaseQueryEngine = PrivateAttr()
+  _store: AnyVectorStore = PrivateAttr()
+  _retriever: BaseRetriever = PrivateAttr()
+  _response_synthesizer: GoogleTextSynthesizer = PrivateAttr()
+  _hyde_predictor: LLMPredictor = PrivateAttr()
+  # Streams the answers of `stream_conversation`.
+  _llm: LLM = PrivateAttr()
 
-  conversation: List[ConversationMessage] = []
+  _conversation: ConversationHistory = PrivateAttr(
+      default_factory=ConversationHistory)
 
-  def __init__(self, *, store: GoogleVectorStore, llm: LLM) -> None:
+  def __init__(self, *, store: AnyVectorStore, llm: LLM) -> None:
     super().__init__()
 
     index = VectorStoreIndex.from_vector_store(
         vector_store=store,
         service_context=google_service_context)
     response_synthesizer = build_response_synthesizer()
-    query_engine = index.as_query_engine(
-        similarity_top_k=5,
-        response_synthesizer=response_synthesizer)
-
-    hyde = HyDEQueryTransform(
-        llm_predictor=LLMPredictor(build_gemini_pro()))
-    hyde_query_engine = TransformQueryEngine(query_engine, hyde)
+    retriever = index.as_retriever(similarity_top_k=SIMILARITY_TOP_K)
 
     self._store = store
-    self._query_engine = hyde_query_engine
+    self._retriever = retriever
+    self._response_synthesizer = response_synthesizer
+    self._hyde_predictor = _get_hyde_predictor()
+    self._llm = llm
 
   @classmethod
   async def create(
@@ -78,7 +120,7 @@ class HydeBaseRag(BaseRag):
       cls, *, corpus_id: str, display_name: str, llm: LLM
   ) -> BaseRag:
     return cls(
-      store=GoogleVectorStore.create_corpus(
+      store=create_vector_store(
           corpus_id=corpus_id,
           display_name=display_name),
       llm=llm)
@@ -91,18 +133,21 @@ class HydeBaseRag(BaseRag):
   @classmethod
   def _get(cls, *, corpus_id: str, llm: LLM) -> BaseRag:
     return cls(
-        store=GoogleVectorStore.from_corpus(corpus_id=corpus_id),
+        store=open_vector_store(corpus_id=corpus_id),
         llm=llm)
 
   async def list_files(self) -> Iterable[str]:
     return await asyncio.to_thread(lambda: self._list_files())
 
   def _list_files(self) -> Iterable[str]:
-    return [
-        document.display_name or "?"
-        for document in genaix.list_documents(
-            corpus_id=self._store.corpus_id)
-    ]
+    return ingest.list_files(ingest.get_corpus(self._store)).filenames
+
+  async def list_file_page(
+      self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+  ) -> FilePage:
+    return await asyncio.to_thread(
+        lambda: ingest.list_files(
+            ingest.get_corpus(self._store), cursor=cursor, limit=limit))
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
@@ -117,24 +162,96 @@ class HydeBaseRag(BaseRag):
       self, *, filename: str, content: FileContent, content_type: str
   ) -> None:
     assert isinstance(content, SpooledTemporaryFile)
-    self._store.add(list(chunk_unstructured(filename, content, content_type)))
+    ingest.add_file(
+        corpus=ingest.get_corpus(self._store),
+        filename=filename,
+        content=content,
+        chunk=lambda: chunk_unstructured(filename, content, content_type))
 
   async def clear_files(self) -> None:
-    return await asyncio.to_thread(lambda: self._clear_files())
+    await ingest.aclear_corpus(ingest.get_corpus(self._store))
 
-  def _clear_files(self) -> None:
-    for document in genaix.list_documents(corpus_id=self._store.corpus_id):
-      genaix.delete_document(
-          corpus_id=self._store.corpus_id, document_id=document.document_id
-      )
+  def corpus_version(self) -> int | None:
+    return ingest.corpus_version(self._store.corpus_id)
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    return await asyncio.to_thread(lambda: self._add_conversation(message))
+    return await self._aadd_conversation(message)
 
-  def _add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    response = self._query_engine.query(message)
-    assert isinstance(response, Response)
+  async def _aadd_conversation(self, message: str) -> Iterable[AttributedAnswer]:
+    query_bundle, nodes = await self._aretrieve(message)
+    response = await asynthesize(
+        self._response_synthesizer, query_bundle, nodes)
+    return self._record_conversation(message, response)
 
+  async def _astream_conversation(
+      self, message: str
+  ) -> AsyncIterator[ConversationEvent]:
+    query_bundle, nodes = await self._aretrieve(message)
+    async for event in astream_answer(
+        self._llm,
+        query_bundle,
+        nodes,
+        lambda response: self._record_conversation(message, response)):
+      yield event
+
+  async def _aretrieve(
+      self, message: str
+  ) -> Tuple[QueryBundle, List[NodeWithScore]]:
+    plain_bundle = QueryBundle(message)
+    if not isinstance(self._store, LocalVectorStore):
+      # The store embeds the question itself, so a hypothetical document
+      # would retrieve the same nodes.
+      query_bundle = plain_bundle
+      nodes = await aretrieve(self._retriever, plain_bundle)
+    elif not HYDE_PARALLEL:
+      query_bundle = await self._ahyde(plain_bundle)
+      nodes = await aretrieve(self._retriever, query_bundle)
+    else:
+      plain_task = asyncio.create_task(
+          aretrieve(self._retriever, plain_bundle))
+      try:
+        query_bundle = await self._ahyde(plain_bundle)
+        hyde_nodes = await aretrieve(self._retriever, query_bundle)
+        plain_nodes = await plain_task
+      finally:
+        # A no-op once retrieved; stops waiting for it if HyDE failed.
+        plain_task.cancel()
+      nodes = reciprocal_rank_fusion(
+          [hyde_nodes, plain_nodes], top_k=SIMILARITY_TOP_K)
+    return query_bundle, nodes
+
+  async def _ahyde(self, query_bundle: QueryBundle) -> QueryBundle:
+    """Same as `ahyde`, but memoized per normalized question.
+
+    Only for local stores, the only ones that search by the embedding the
+    bundle carries.
+    """
+    key = normalize(query_bundle.query_str)
+    with _hypothetical_documents_lock:
+      document = _hypothetical_documents.get(key)
+      if document is not None:
+        _hypothetical_documents.move_to_end(key)
+    if document is None:
+      hyde_bundle = await ahyde(
+          self._hyde_predictor, DEFAULT_HYDE_PROMPT, query_bundle)
+      assert hyde_bundle.custom_embedding_strs is not None
+      document = _HypotheticalDocument(
+          text=hyde_bundle.custom_embedding_strs[0],
+          embedding=embed_query(hyde_bundle.custom_embedding_strs))
+      with _hypothetical_documents_lock:
+        _hypothetical_documents[key] = document
+        while len(_hypothetical_documents) > HYDE_CACHE_SIZE:
+          _hypothetical_documents.popitem(last=False)
+
+    return QueryBundle(
+        query_str=query_bundle.query_str,
+        custom_embedding_strs=[document.text, query_bundle.query_str],
+        embedding=document.embedding,
+    )
+
+  def _record_conversation(
+      self, message: str, response: Response
+  ) -> Iterable[AttributedAnswer]:
     assistant_message = AttributedAnswer(
         answer=response.response or '',
         citations=[node.text
@@ -142,25 +259,26 @@ class HydeBaseRag(BaseRag):
         score=_get_answerable_probability(response),
     )
 
-    self.conversation.extend(
-        [
-            ConversationMessage(
-                role="user",
-                message=AttributedAnswer(
-                    answer=message,
-                ),
-            ),
-            ConversationMessage(
-                role="assistant",
-                message=assistant_message,
-            ),
-        ]
+    self._conversation.append(
+        message,
+        assistant_message,
+        citation_ids=[node.node_id
+                      for node in response.source_nodes if node.score is None],
     )
 
     return [assistant_message]
 
-  async def clear_conversation(self) -> None:
-      self.conversation = []
+  def record_turn(
+      self, message: str, answers: Iterable[AttributedAnswer]
+  ) -> None:
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory()
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
 
 
 def _get_answerable_probability(response: Response) -> float | None:
@@ -0,0 +1,539 @@
+"""Incremental uploads to corpora.
+
+The chunkers give documents a stable id per file name and chunks a content
+address (see `api.chunkers.base`). `add_file` then only creates the chunks a
+document does not have yet and deletes the ones it no longer has. A local
+manifest remembers the content hash of every uploaded file, so re-uploading
+an unchanged file does not even partition it. Every synced document is also
+indexed in the corpus' `api.lexical.InvertedIndex`.
+
+`aclear_corpus` deletes documents in bulk.
+
+`list_files` pages through the manifest rather than the corpus. The corpus is
+only listed the first time, to learn of the documents this server did not
+upload, and again after a clear that failed halfway.
+
+A corpus is either on Google's Semantic Retriever (`GoogleCorpus`) or on local
+disk (`api.local_store.LocalVectorStore`); both implement `Corpus`.
+"""
+import asyncio
+import base64
+import bisect
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from google.api_core import exceptions as gapi_exception
+from google.api_core.retry_async import AsyncRetry, if_exception_type
+import google.ai.generativelanguage as genai
+import hashlib
+import json
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.google.generativeai import GoogleVectorStore
+import llama_index.vector_stores.google.generativeai.genai_extension as genaix
+import logging
+import os
+from pydantic import BaseModel
+import threading
+import time
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Protocol,
+    Set,
+    Tuple,
+)
+from .base_rag import FilePage
+from .chunkers.base import document_id
+from .lexical import get_inverted_index
+from .llms.genaix import get_async_client, get_client
+from .local_store import LocalVectorStore
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Where the manifests are kept, one JSON file per corpus.
+MANIFEST_DIR = os.environ.get(
+    "RAG_MANIFEST_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "choose-a-rag"))
+
+# How many chunk batches of one file are uploaded at the same time.
+MAX_CONCURRENT_BATCHES = 4
+# Keeps batch requests well under gRPC's 4 MB message limit.
+MAX_BATCH_BYTES = 2 * 1024 * 1024
+# How many documents `GoogleCorpus.aclear` deletes at the same time.
+MAX_CONCURRENT_DELETES = 16
+
+# The most requests the Semantic Retriever accepts in one batch call.
+_MAX_REQUESTS_PER_BATCH = 100
+# The most documents the Semantic Retriever lists per page.
+_MAX_DOCUMENTS_PER_PAGE = 20
+# How often `GoogleCorpus.aclear` reports its progress, in documents.
+_PROGRESS_INTERVAL = 100
+_TRANSIENT_RETRY = AsyncRetry(
+    predicate=if_exception_type(
+        gapi_exception.DeadlineExceeded,
+        gapi_exception.ServiceUnavailable,
+        gapi_exception.TooManyRequests,
+    ),
+    initial=0.5,
+    maximum=10.0,
+    multiplier=2.0,
+    timeout=120.0,
+)
+
+
+class DocumentEntry(BaseModel):
+  file_name: str
+  content_hash: str
+
+
+class _ManifestData(BaseModel):
+  documents: Dict[str, DocumentEntry] = {}
+  # Whether `documents` was reconciled with the corpus itself, and so also
+  # has the documents that this server did not upload.
+  synced: bool = False
+
+
+# How the manifest orders documents: by file name, then document id.
+_ListingKey = Tuple[str, str]
+
+
+class Manifest:
+  """The files this server has uploaded to one corpus, by document id."""
+
+  def __init__(self, corpus_id: str) -> None:
+    self._path = os.path.join(MANIFEST_DIR, f"{corpus_id}.json")
+    self._lock = threading.Lock()
+    self._document_locks: Dict[str, threading.Lock] = {}
+    self._data = self._load()
+    self._listing = self._sorted_listing()
+
+  @property
+  def synced(self) -> bool:
+    with self._lock:
+      return self._data.synced
+
+  def get(self, document_id: str) -> DocumentEntry | None:
+    with self._lock:
+      return self._data.documents.get(document_id)
+
+  def put(self, document_id: str, entry: DocumentEntry) -> None:
+    with self._lock:
+      previous = self._data.documents.get(document_id)
+      self._data.documents[document_id] = entry
+      if previous is None or previous.file_name != entry.file_name:
+        if previous is not None:
+          self._listing.remove((previous.file_name, document_id))
+        bisect.insort(self._listing, (entry.file_name, document_id))
+      self._save()
+
+  def clear(self) -> None:
+    with self._lock:
+      # An empty corpus is in sync.
+      self._data = _ManifestData(synced=True)
+      self._listing = []
+      self._save()
+
+  def invalidate(self) -> None:
+    """Has the next `list_files` reconcile with the corpus again."""
+    with self._lock:
+      self._data.synced = False
+      self._save()
+
+  def sync(self, file_names: Dict[str, str]) -> None:
+    """Makes the manifest list exactly the documents in `file_names`.
+
+    Documents this server did not upload get an empty content hash, so that
+    uploading them again syncs them.
+    """
+    with self._lock:
+      documents = self._data.documents
+      self._data = _ManifestData(
+          documents={
+              doc_id: documents.get(doc_id) or DocumentEntry(
+                  file_name=file_name, content_hash="")
+              for doc_id, file_name in file_names.items()
+          },
+          synced=True)
+      self._listing = self._sorted_listing()
+      self._save()
+
+  def page(self, *, cursor: str | None, limit: int | None) -> FilePage:
+    """The entries after `cursor`, up to `limit` of them, or all if None."""
+    assert limit is None or limit > 0, f"Invalid page size {limit}"
+    with self._lock:
+      start = 0
+      if cursor is not None:
+        start = bisect.bisect_right(self._listing, _decode_cursor(cursor))
+      end = len(self._listing) if limit is None else start + limit
+      listing = self._listing[start:end]
+      return FilePage(
+          filenames=[file_name for file_name, _ in listing],
+          next_cursor=(_encode_cursor(listing[-1])
+                       if listing and end < len(self._listing) else None))
+
+  def document_lock(self, document_id: str) -> threading.Lock:
+    """Serializes concurrent uploads of the same file."""
+    with self._lock:
+      return self._document_locks.setdefault(document_id, threading.Lock())
+
+  def _sorted_listing(self) -> List[_ListingKey]:
+    return sorted(
+        (entry.file_name, doc_id)
+        for doc_id, entry in self._data.documents.items())
+
+  def _load(self) -> _ManifestData:
+    try:
+      with open(self._path, "r", encoding="utf-8") as f:
+        return _ManifestData.model_validate_json(f.read())
+    except FileNotFoundError:
+      return _ManifestData()
+    except Exception:
+      _logger.warning(
+          f"Ignoring unreadable manifest {self._path}", exc_info=True)
+      return _ManifestData()
+
+  def _save(self) -> None:
+    os.makedirs(os.path.dirname(self._path), exist_ok=True)
+    tmp_path = f"{self._path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      f.write(self._data.model_dump_json())
+    os.replace(tmp_path, self._path)
+
+
+def _encode_cursor(key: _ListingKey) -> str:
+  return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode()
+
+
+def _decode_cursor(cursor: str) -> _ListingKey:
+  try:
+    file_name, doc_id = json.loads(base64.urlsafe_b64decode(cursor))
+  except Exception as e:
+    raise ValueError(f"Invalid cursor {cursor!r}") from e
+  return (str(file_name), str(doc_id))
+
+
+_manifests: Dict[str, Manifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(corpus_id: str) -> Manifest:
+  with _manifests_lock:
+    if corpus_id not in _manifests:
+      _manifests[corpus_id] = Manifest(corpus_id)
+    return _manifests[corpus_id]
+
+
+_corpus_versions: Dict[str, int] = {}
+_corpus_versions_lock = threading.Lock()
+
+
+def corpus_version(corpus_id: str) -> int:
+  """Grows whenever this server changes the documents of `corpus_id`."""
+  with _corpus_versions_lock:
+    return _corpus_versions.get(corpus_id, 0)
+
+
+def _bump_corpus_version(corpus_id: str) -> None:
+  with _corpus_versions_lock:
+    _corpus_versions[corpus_id] = _corpus_versions.get(corpus_id, 0) + 1
+
+
+def content_hash(content: IO[bytes]) -> str:
+  """Hashes `content` from the start and rewinds it."""
+  digest = hashlib.sha256()
+  content.seek(0)
+  for block in iter(lambda: content.read(1 << 20), b""):
+    digest.update(block)
+  content.seek(0)
+  return digest.hexdigest()
+
+
+def add_file(
+    *,
+    corpus: "Corpus",
+    filename: str,
+    content: IO[bytes],
+    chunk: Callable[[], Iterable[BaseNode]],
+) -> None:
+  """Brings the document of `filename` in line with `content`.
+
+  `chunk` is only called if `content` differs from what was uploaded last
+  time. Its nodes must come from the chunkers, which give them content
+  addresses as ids.
+  """
+  start = time.perf_counter()
+  manifest = get_manifest(corpus.corpus_id)
+  lexical_index = get_inverted_index(corpus.corpus_id)
+  digest = content_hash(content)
+  doc_id = document_id(filename)
+
+  with manifest.document_lock(doc_id):
+    has_document = corpus.has_document(doc_id)
+    entry = manifest.get(doc_id)
+    if (has_document
+        and entry is not None
+        and entry.content_hash == digest
+        and lexical_index.has_document(doc_id)):
+      _logger.info(f"Skipping {filename}: unchanged since its last upload")
+      return
+
+    try:
+      if has_document:
+        existing_ids = set(corpus.list_chunk_ids(doc_id))
+      else:
+        corpus.create_document(doc_id, filename)
+        existing_ids = set()
+        # Listed even if the sync fails. The empty hash has the next upload
+        # sync it again.
+        manifest.put(
+            doc_id, DocumentEntry(file_name=filename, content_hash=""))
+
+      seen_ids: Set[str] = set()
+      # The id and text of every chunk, for the lexical index. The nodes
+      # themselves, with their metadata, are only held while in flight.
+      chunks: List[Tuple[str, str]] = []
+
+      def new_nodes() -> Iterator[BaseNode]:
+        for node in chunk():
+          assert node.ref_doc_id == doc_id
+          if node.node_id in seen_ids:
+            continue
+          seen_ids.add(node.node_id)
+          chunks.append((node.node_id, node.get_content()))
+          if node.node_id not in existing_ids:
+            yield node
+
+      created = corpus.create_chunks(doc_id, new_nodes())
+      stale_ids = [
+          chunk_id for chunk_id in existing_ids if chunk_id not in seen_ids]
+      corpus.delete_chunks(doc_id, stale_ids)
+      lexical_index.replace_document(doc_id, chunks)
+      manifest.put(
+          doc_id, DocumentEntry(file_name=filename, content_hash=digest))
+    finally:
+      # Even a failed sync may have changed some chunks.
+      _bump_corpus_version(corpus.corpus_id)
+
+  _logger.info(
+      f"Synced {filename} in {time.perf_counter() - start:.1f}s: "
+      f"{created} chunks added, {len(stale_ids)} removed, "
+      f"{len(seen_ids) - created} unchanged")
+
+
+async def aclear_corpus(corpus: "Corpus") -> None:
+  """Deletes every document of `corpus`."""
+  manifest = get_manifest(corpus.corpus_id)
+  try:
+    await corpus.aclear()
+  except BaseException:
+    # Some documents may be left, so list the corpus again.
+    manifest.invalidate()
+    raise
+  finally:
+    # Even a failed clear may have deleted some documents.
+    _bump_corpus_version(corpus.corpus_id)
+  manifest.clear()
+  get_inverted_index(corpus.corpus_id).clear()
+
+
+def list_files(
+    corpus: "Corpus", *, cursor: str | None = None, limit: int | None = None
+) -> FilePage:
+  """The file names of `corpus` after `cursor`, from its manifest."""
+  manifest = get_manifest(corpus.corpus_id)
+  if not manifest.synced:
+    start = time.perf_counter()
+    file_names = corpus.list_documents()
+    manifest.sync(file_names)
+    _logger.info(
+        f"Listed {len(file_names)} documents of {corpus.corpus_id} in "
+        f"{time.perf_counter() - start:.1f}s")
+  return manifest.page(cursor=cursor, limit=limit)
+
+
+class Corpus(Protocol):
+  """Where `add_file` uploads to: a Google corpus or a `LocalVectorStore`."""
+  @property
+  def corpus_id(self) -> str: ...
+
+  def has_document(self, document_id: str) -> bool: ...
+
+  def create_document(self, document_id: str, display_name: str) -> None: ...
+
+  def list_chunk_ids(self, document_id: str) -> Iterable[str]: ...
+
+  def create_chunks(
+      self, document_id: str, nodes: Iterable[BaseNode]) -> int: ...
+
+  def delete_chunks(self, document_id: str, chunk_ids: List[str]) -> None: ...
+
+  # The file name of every document, by document id.
+  def list_documents(self) -> Dict[str, str]: ...
+
+  async def aclear(self) -> None: ...
+
+
+def get_corpus(store: GoogleVectorStore | LocalVectorStore) -> Corpus:
+  if isinstance(store, LocalVectorStore):
+    return store
+  return GoogleCorpus(store.corpus_id)
+
+
+class GoogleCorpus:
+  """A corpus of Google's Semantic Retriever."""
+
+  def __init__(self, corpus_id: str) -> None:
+    self._corpus_id = corpus_id
+    self._client = get_client(genai.RetrieverServiceClient)
+
+  @property
+  def corpus_id(self) -> str:
+    return self._corpus_id
+
+  def has_document(self, document_id: str) -> bool:
+    return genaix.get_document(
+        corpus_id=self._corpus_id,
+        document_id=document_id,
+        client=self._client) is not None
+
+  def create_document(self, document_id: str, display_name: str) -> None:
+    genaix.create_document(
+        corpus_id=self._corpus_id,
+        document_id=document_id,
+        display_name=display_name,
+        metadata={"file_name": display_name},
+        client=self._client)
+
+  def list_chunk_ids(self, document_id: str) -> Iterable[str]:
+    parent = str(genaix.EntityName(
+        corpus_id=self._corpus_id, document_id=document_id))
+    for chunk in self._client.list_chunks(
+        genai.ListChunksRequest(parent=parent, page_size=100)):
+      chunk_id = genaix.EntityName.from_str(chunk.name).chunk_id
+      assert chunk_id is not None
+      yield chunk_id
+
+  def create_chunks(self, document_id: str, nodes: Iterable[BaseNode]) -> int:
+    """Creates `nodes` as chunks while they are still being produced.
+
+    Batches are flushed once they reach `_MAX_REQUESTS_PER_BATCH` chunks or
+    `MAX_BATCH_BYTES`, with up to `MAX_CONCURRENT_BATCHES` in flight. Only
+    those batches are held in memory.
+    """
+    parent = str(genaix.EntityName(
+        corpus_id=self._corpus_id, document_id=document_id))
+    created = 0
+    batch: List[genai.CreateChunkRequest] = []
+    batch_bytes = 0
+    in_flight: Deque[Future[genai.BatchCreateChunksResponse]] = deque()
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as executor:
+      def flush() -> None:
+        nonlocal batch, batch_bytes
+        if len(in_flight) >= MAX_CONCURRENT_BATCHES:
+          in_flight.popleft().result()
+        in_flight.append(executor.submit(
+            self._client.batch_create_chunks,
+            genai.BatchCreateChunksRequest(parent=parent, requests=batch)))
+        batch = []
+        batch_bytes = 0
+
+      for node in nodes:
+        request = genai.CreateChunkRequest(
+            parent=parent,
+            chunk=genai.Chunk(
+                name=str(genaix.EntityName(
+                    corpus_id=self._corpus_id,
+                    document_id=document_id,
+                    chunk_id=node.node_id)),
+                data=genai.ChunkData(string_value=node.get_content()),
+            ),
+        )
+        request_bytes = genai.CreateChunkRequest.pb(request).ByteSize()
+        if batch and (len(batch) >= _MAX_REQUESTS_PER_BATCH
+                      or batch_bytes + request_bytes > MAX_BATCH_BYTES):
+          flush()
+        batch.append(request)
+        batch_bytes += request_bytes
+        created += 1
+      if batch:
+        flush()
+      while in_flight:
+        in_flight.popleft().result()
+
+    return created
+
+  def delete_chunks(self, document_id: str, chunk_ids: List[str]) -> None:
+    parent = str(genaix.EntityName(
+        corpus_id=self._corpus_id, document_id=document_id))
+    for i in range(0, len(chunk_ids), _MAX_REQUESTS_PER_BATCH):
+      self._client.batch_delete_chunks(genai.BatchDeleteChunksRequest(
+          parent=parent,
+          requests=[
+              genai.DeleteChunkRequest(name=str(genaix.EntityName(
+                  corpus_id=self._corpus_id,
+                  document_id=document_id,
+                  chunk_id=chunk_id)))
+              for chunk_id in chunk_ids[i:i + _MAX_REQUESTS_PER_BATCH]
+          ],
+      ))
+
+  def list_documents(self) -> Dict[str, str]:
+    file_names: Dict[str, str] = {}
+    for document in genaix.list_documents(
+        corpus_id=self._corpus_id, client=self._client):
+      doc_id = genaix.EntityName.from_str(document.name).document_id
+      assert doc_id is not None
+      file_names[doc_id] = document.display_name or "?"
+    return file_names
+
+  async def aclear(self) -> None:
+    """Deletes every document of the corpus.
+
+    The documents are deleted `MAX_CONCURRENT_DELETES` at a time, and each
+    delete is retried on transient errors such as rate limiting.
+    """
+    start = time.perf_counter()
+    client = get_async_client(genai.RetrieverServiceAsyncClient)
+    # List everything first: deleting while paging could skip documents.
+    names = [
+        document.name
+        async for document in await client.list_documents(
+            genai.ListDocumentsRequest(
+                parent=str(genaix.EntityName(corpus_id=self._corpus_id)),
+                page_size=_MAX_DOCUMENTS_PER_PAGE))
+    ]
+    _logger.info(f"Deleting {len(names)} documents from {self._corpus_id}")
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DELETES)
+    deleted = 0
+
+    async def delete(name: str) -> None:
+      nonlocal deleted
+      async with semaphore:
+        try:
+          await client.delete_document(
+              genai.DeleteDocumentRequest(name=name, force=True),
+              retry=_TRANSIENT_RETRY)
+        except gapi_exception.NotFound:
+          pass  # Someone else deleted it meanwhile.
+      deleted += 1
+      if deleted % _PROGRESS_INTERVAL == 0:
+        _logger.info(f"Deleted {deleted}/{len(names)} documents")
+
+    results = await asyncio.gather(
+        *[delete(name) for name in names], return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    _logger.info(
+        f"Deleted {len(names) - len(failures)}/{len(names)} documents from "
+        f"{self._corpus_id} in {time.perf_counter() - start:.1f}s")
+    if failures:
+      raise failures[0]
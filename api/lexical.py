@@ -0,0 +1,319 @@
+"""Lexical retrieval, fused with vector retrieval.
+
+Embeddings miss exact tokens such as product codes and error strings. An
+`InvertedIndex` of every corpus is kept locally and fed by `api.ingest` with
+the same chunks that are uploaded, and `HybridRetriever` fuses its BM25
+ranking with the vector retriever's by reciprocal rank fusion.
+"""
+from array import array
+from collections import Counter
+import json
+from llama_index.core import BaseRetriever
+from llama_index.schema import (
+    BaseNode,
+    NodeRelationship,
+    NodeWithScore,
+    QueryBundle,
+    RelatedNodeInfo,
+    TextNode,
+)
+import logging
+import numpy as np
+import numpy.typing as npt
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+from .bm25 import DEFAULT_B, DEFAULT_K1, tokenize
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+LEXICAL_INDEX_DIR = os.environ.get(
+    "RAG_LEXICAL_INDEX_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "choose-a-rag", "lexical"))
+# The constant of reciprocal rank fusion. Larger values flatten the
+# difference between the top ranks.
+RRF_K = 60
+
+
+class InvertedIndex:
+  """BM25 search over the chunks of one corpus.
+
+  The postings of a term are two compact arrays: the rows that contain it and
+  how often. Deleted rows are only masked out, and compacted away once they
+  outnumber the live ones.
+
+  On disk, the index is a log with one record per replaced document, which
+  supersedes the earlier records of that document. The log is rewritten once
+  superseded records outnumber the live ones.
+  """
+
+  def __init__(self, path: str) -> None:
+    self._path = path
+    self._lock = threading.Lock()
+    # Taken before `_lock` and held while writing, so that the log is
+    # written in the order the index changed, without blocking searches.
+    self._log_lock = threading.Lock()
+    self._log_records = 0
+    self._clear()
+    self._load()
+
+  def has_document(self, document_id: str) -> bool:
+    with self._lock:
+      return document_id in self._rows_by_doc
+
+  def is_empty(self) -> bool:
+    with self._lock:
+      return not self._rows_by_doc
+
+  def replace_document(
+      self, document_id: str, chunks: Sequence[Tuple[str, str]]
+  ) -> None:
+    """Makes `chunks` the chunks of `document_id`, and persists the index.
+
+    `chunks` are (chunk id, text) pairs.
+    """
+    record = json.dumps({
+        "document_id": document_id,
+        "chunks": [[chunk_id, text] for chunk_id, text in chunks],
+    })
+    with self._log_lock:
+      with self._lock:
+        self._replace_document(document_id, chunks)
+        self._log_records += 1
+        compact = self._log_records > 2 * len(self._rows_by_doc)
+        live_chunks = self._live_chunks() if compact else []
+      if compact:
+        self._save(live_chunks)
+      else:
+        self._append_to_log(record)
+
+  def clear(self) -> None:
+    with self._log_lock:
+      with self._lock:
+        self._clear()
+      self._save([])
+
+  def search(
+      self,
+      query: str,
+      top_k: int,
+      *,
+      k1: float = DEFAULT_K1,
+      b: float = DEFAULT_B,
+  ) -> List[NodeWithScore]:
+    with self._lock:
+      count = len(self._chunk_ids)
+      live = count - self._dead
+      if live == 0 or top_k <= 0:
+        return []
+      # Copies, since a view would pin the buffers against appends.
+      alive = np.array(self._alive, dtype=np.bool_)
+      lengths = np.array(self._lengths, dtype=np.uint32)
+      average_length = max(float(lengths[alive].mean()), 1.0)
+      scores = np.zeros(count, dtype=np.float64)
+      for term in set(tokenize(query)):
+        if term not in self._posting_rows:
+          continue
+        rows = np.array(self._posting_rows[term], dtype=np.uint32)
+        tfs = np.array(self._posting_tfs[term], dtype=np.float64)
+        live_postings = alive[rows]
+        rows, tfs = rows[live_postings], tfs[live_postings]
+        df = len(rows)
+        idf = np.log1p((live - df + 0.5) / (df + 0.5))
+        norm = k1 * (1 - b + b * lengths[rows] / average_length)
+        scores[rows] += idf * tfs * (k1 + 1) / (tfs + norm)
+
+      matches: npt.NDArray[np.int64] = np.flatnonzero(scores > 0)
+      if len(matches) > top_k:
+        matches = matches[
+            np.argpartition(-scores[matches], top_k - 1)[:top_k]]
+      matches = matches[np.argsort(-scores[matches], kind="stable")]
+      return [
+          NodeWithScore(
+              node=TextNode(
+                  id_=self._chunk_ids[row],
+                  text=self._texts[row],
+                  relationships={
+                      NodeRelationship.SOURCE: RelatedNodeInfo(
+                          node_id=self._doc_ids[row]),
+                  },
+              ),
+              score=float(scores[row]))
+          for row in matches
+      ]
+
+  def _replace_document(
+      self, document_id: str, chunks: Sequence[Tuple[str, str]]
+  ) -> None:
+    rows = self._rows_by_doc.pop(document_id, {})
+    wanted = {chunk_id for chunk_id, _ in chunks}
+    for chunk_id, row in rows.items():
+      if chunk_id not in wanted:
+        self._alive[row] = False
+        self._dead += 1
+    kept = {
+        chunk_id: row for chunk_id, row in rows.items()
+        if chunk_id in wanted}
+    for chunk_id, text in chunks:
+      if chunk_id not in kept:
+        kept[chunk_id] = self._append(chunk_id, document_id, text)
+    self._rows_by_doc[document_id] = kept
+    if self._dead > len(self._chunk_ids) - self._dead:
+      self._compact()
+
+  def _clear(self) -> None:
+    self._chunk_ids: List[str] = []
+    self._doc_ids: List[str] = []
+    self._texts: List[str] = []
+    self._lengths = array("I")
+    self._alive = bytearray()
+    self._dead = 0
+    self._rows_by_doc: Dict[str, Dict[str, int]] = {}
+    self._posting_rows: Dict[str, array[int]] = {}
+    self._posting_tfs: Dict[str, array[int]] = {}
+
+  def _append(self, chunk_id: str, document_id: str, text: str) -> int:
+    row = len(self._chunk_ids)
+    counts = Counter(tokenize(text))
+    for term, tf in counts.items():
+      if term not in self._posting_rows:
+        self._posting_rows[term] = array("I")
+        self._posting_tfs[term] = array("I")
+      self._posting_rows[term].append(row)
+      self._posting_tfs[term].append(tf)
+    self._chunk_ids.append(chunk_id)
+    self._doc_ids.append(document_id)
+    self._texts.append(text)
+    self._lengths.append(sum(counts.values()))
+    self._alive.append(True)
+    return row
+
+  def _compact(self) -> None:
+    chunks = list(self._live_chunks())
+    self._clear()
+    for chunk_id, document_id, text in chunks:
+      row = self._append(chunk_id, document_id, text)
+      self._rows_by_doc.setdefault(document_id, {})[chunk_id] = row
+
+  def _live_chunks(self) -> List[tuple[str, str, str]]:
+    return [
+        (self._chunk_ids[row], self._doc_ids[row], self._texts[row])
+        for row in range(len(self._chunk_ids)) if self._alive[row]
+    ]
+
+  def _load(self) -> None:
+    # Only the chunks are persisted. Rebuilding the postings from them is
+    # fast, and keeps the file format trivial.
+    documents: Dict[str, List[tuple[str, str]]] = {}
+    try:
+      with open(self._path, "r", encoding="utf-8") as f:
+        for line in f:
+          record = json.loads(line)
+          if isinstance(record, list):
+            # A chunk, as written before the index was a log.
+            chunk_id, document_id, text = record
+            documents.setdefault(document_id, []).append((chunk_id, text))
+          else:
+            documents[record["document_id"]] = [
+                (chunk_id, text) for chunk_id, text in record["chunks"]]
+          self._log_records += 1
+    except FileNotFoundError:
+      pass
+    except Exception:
+      _logger.warning(
+          f"Ignoring unreadable lexical index {self._path}", exc_info=True)
+      documents = {}
+      self._log_records = 0
+    for document_id, chunks in documents.items():
+      rows = self._rows_by_doc.setdefault(document_id, {})
+      for chunk_id, text in chunks:
+        rows[chunk_id] = self._append(chunk_id, document_id, text)
+
+  def _append_to_log(self, record: str) -> None:
+    os.makedirs(os.path.dirname(self._path), exist_ok=True)
+    with open(self._path, "a", encoding="utf-8") as f:
+      f.write(record + "\n")
+
+  def _save(self, chunks: List[tuple[str, str, str]]) -> None:
+    """Rewrites the log with one record per document of `chunks`."""
+    documents: Dict[str, List[List[str]]] = {}
+    for chunk_id, document_id, text in chunks:
+      documents.setdefault(document_id, []).append([chunk_id, text])
+    os.makedirs(os.path.dirname(self._path), exist_ok=True)
+    tmp_path = f"{self._path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      f.writelines(
+          json.dumps({"document_id": document_id, "chunks": doc_chunks}) + "\n"
+          for document_id, doc_chunks in documents.items())
+    os.replace(tmp_path, self._path)
+    with self._lock:
+      self._log_records = len(documents)
+
+
+_indexes: Dict[str, InvertedIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_inverted_index(corpus_id: str) -> InvertedIndex:
+  with _indexes_lock:
+    if corpus_id not in _indexes:
+      _indexes[corpus_id] = InvertedIndex(
+          os.path.join(LEXICAL_INDEX_DIR, f"{corpus_id}.jsonl"))
+    return _indexes[corpus_id]
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[List[NodeWithScore]],
+    *,
+    top_k: int,
+    k: int = RRF_K,
+) -> List[NodeWithScore]:
+  """Merges `rankings` by the sum of 1 / (k + rank) of each node.
+
+  Nodes are matched by id. Of a node found more than once, the one from the
+  earliest ranking is kept.
+  """
+  scores: Dict[str, float] = {}
+  nodes: Dict[str, BaseNode] = {}
+  for ranking in rankings:
+    for rank, node in enumerate(ranking, start=1):
+      node_id = node.node.node_id
+      scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank)
+      nodes.setdefault(node_id, node.node)
+  best = sorted(scores, key=lambda node_id: -scores[node_id])[:top_k]
+  return [NodeWithScore(node=nodes[node_id], score=scores[node_id])
+          for node_id in best]
+
+
+class HybridRetriever(BaseRetriever):
+  """Fuses a vector retriever with BM25 over the corpus' `InvertedIndex`.
+
+  The fused ranking is cut to `similarity_top_k`. While the index is empty,
+  as for corpora uploaded before it existed, the vector retriever's nodes are
+  returned as they are, so it can be asked for more to make up for it.
+  """
+
+  def __init__(
+      self,
+      vector_retriever: BaseRetriever,
+      index: InvertedIndex,
+      *,
+      similarity_top_k: int,
+  ) -> None:
+    super().__init__(callback_manager=None)
+    self._vector_retriever = vector_retriever
+    self._index = index
+    self._similarity_top_k = similarity_top_k
+
+  def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+    vector_nodes = self._vector_retriever.retrieve(query_bundle)
+    if self._index.is_empty():
+      return vector_nodes
+    lexical_nodes = self._index.search(
+        query_bundle.query_str, self._similarity_top_k)
+    return reciprocal_rank_fusion(
+        [vector_nodes, lexical_nodes], top_k=self._similarity_top_k)
@@ -0,0 +1,159 @@
+"""Memoizes completions by their serialized request.
+
+Query transforms and rerankers send the same low-temperature prompts over
+and over. LLMs memoize by default only at low temperatures, and those call
+sites opt in otherwise. Completions are kept in an in-memory LRU and, if
+`GENAI_COMPLETION_CACHE_PATH` is set, in a SQLite file that outlives the
+process. Both evict the least recently used completions beyond a size in
+bytes.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+COMPLETION_CACHE_PATH = os.environ.get("GENAI_COMPLETION_CACHE_PATH")
+COMPLETION_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+COMPLETION_CACHE_DISK_BYTES = 512 * 1024 * 1024
+# LLMs only memoize their completions by default up to this temperature.
+# Above it samples are meant to vary, and memoizing would pin the first one.
+CACHEABLE_TEMPERATURE = 0.2
+
+
+def completion_key(request_type: str, serialized_request: bytes) -> str:
+    digest = hashlib.sha256(serialized_request).hexdigest()
+    return f"{request_type}:{digest}"
+
+
+class CompletionCache:
+    """In-memory LRU of completions, optionally backed by SQLite."""
+
+    def __init__(
+        self,
+        *,
+        memory_bytes: int = COMPLETION_CACHE_MEMORY_BYTES,
+        path: Optional[str] = None,
+        disk_bytes: int = COMPLETION_CACHE_DISK_BYTES,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._memory_bytes = 0
+        self._max_memory_bytes = memory_bytes
+        self._max_disk_bytes = disk_bytes
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self._open(path)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            completion = self._memory.get(key)
+            if completion is not None:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT completion FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    completion = row[0]
+                    self._db.execute(
+                        "UPDATE completions SET used = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    self._db.commit()
+                    self._remember(key, completion)
+            if completion is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return completion
+
+    def put(self, key: str, completion: str) -> None:
+        with self._lock:
+            self._remember(key, completion)
+            if self._db is None:
+                return
+            size = len(key) + len(completion.encode("utf-8"))
+            previous = self._db.execute(
+                "SELECT size FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, completion, size, time.time()),
+            )
+            self._disk_bytes += size - (previous[0] if previous else 0)
+            self._evict_from_disk()
+            self._db.commit()
+
+    def _remember(self, key: str, completion: str) -> None:
+        if key in self._memory:
+            self._memory_bytes -= _size(key, self._memory.pop(key))
+        self._memory[key] = completion
+        self._memory_bytes += _size(key, completion)
+        while self._memory_bytes > self._max_memory_bytes and self._memory:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= _size(evicted_key, evicted)
+
+    def _open(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Only used under `_lock`, so it may be shared across threads.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, completion TEXT, size INTEGER, used REAL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS completions_used ON completions (used)"
+        )
+        self._disk_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+        _logger.info(
+            f"Opened completion cache {path} "
+            f"({self._disk_bytes / 1e6:.1f} MB)"
+        )
+
+    def _evict_from_disk(self) -> None:
+        assert self._db is not None
+        while self._disk_bytes > self._max_disk_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM completions ORDER BY used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                return
+            self._db.executemany(
+                "DELETE FROM completions WHERE key = ?",
+                [(key,) for key, _ in rows],
+            )
+            self._disk_bytes -= sum(size for _, size in rows)
+
+
+def _size(key: str, completion: str) -> int:
+    return len(key) + len(completion)
+
+
+_cache: Optional[CompletionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> CompletionCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CompletionCache(path=COMPLETION_CACHE_PATH)
+        return _cache
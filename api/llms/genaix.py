@@ -1,33 +1,302 @@
+import asyncio
 import google.ai.generativelanguage as genai
 from google.api_core import client_options as client_options_lib
-from typing import Iterable
+import json
+import logging
+import os
+from pydantic import BaseModel
+import threading
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    Tuple,
+    Type,
+    TypeVar,
+)
+from .completion_cache import completion_key, get_completion_cache
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
 
 
 # _DEFAULT_API_ENDPOINT = "autopush-generativelanguage.sandbox.googleapis.com"
 _DEFAULT_API_ENDPOINT = None
+# How long the model catalog is trusted before it is listed again.
+MODEL_CATALOG_TTL_SECONDS = 60 * 60
+# How long a cached catalog is still used after listing it again failed.
+MODEL_CATALOG_RETRY_SECONDS = 60
+# Optional JSON snapshot of the model catalog. It is loaded on a cold start
+# (so the server can start offline) and rewritten after every refresh.
+MODEL_CATALOG_SNAPSHOT_PATH = os.environ.get("GENAI_MODEL_CATALOG_SNAPSHOT")
 
 
-def list_models() -> Iterable[genai.Model]:
-    service = genai.ModelServiceClient(
-        client_options=client_options_lib.ClientOptions(
-            api_endpoint=_DEFAULT_API_ENDPOINT
-        ),
+_ServiceClient = TypeVar("_ServiceClient")
+
+
+class ClientPoolStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    # Number of times each pooled client has been handed out, keyed by
+    # "<ServiceClient>@<endpoint>".
+    reuses: Dict[str, int] = {}
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class _ClientPool:
+    """Process-wide pool of genai service clients.
+
+    Each client owns a gRPC channel, so building one per call pays channel
+    setup and TLS handshake on every LLM hop. Clients are shared per
+    (service type, endpoint). gRPC channels must not cross a fork, so a child
+    process starts with an empty pool. Async clients are bound to the event
+    loop they were created on, so they are additionally keyed by loop.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients: Dict[Tuple[type, str | None, int | None], Any] = {}
+        self._stats = ClientPoolStats()
+
+    def get(
+        self,
+        client_type: Type[_ServiceClient],
+        api_endpoint: str | None = _DEFAULT_API_ENDPOINT,
+        loop: asyncio.AbstractEventLoop | None = None,
+    ) -> _ServiceClient:
+        key = (client_type, api_endpoint, id(loop) if loop is not None else None)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_locked()
+            client = self._clients.get(key)
+            if client is None:
+                self._stats.misses += 1
+                client = cast(Any, client_type)(
+                    client_options=client_options_lib.ClientOptions(
+                        api_endpoint=api_endpoint
+                    ),
+                )
+                self._clients[key] = client
+            else:
+                self._stats.hits += 1
+            name = f"{client_type.__name__}@{api_endpoint or 'default'}"
+            self._stats.reuses[name] = self._stats.reuses.get(name, 0) + 1
+            return cast(_ServiceClient, client)
+
+    def stats(self) -> ClientPoolStats:
+        with self._lock:
+            return self._stats.model_copy(deep=True)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._reset_locked()
+
+    def _reset_locked(self) -> None:
+        # Do not close the inherited channels: they belong to the parent.
+        self._pid = os.getpid()
+        self._clients = {}
+        self._stats = ClientPoolStats()
+
+    def _after_fork_in_child(self) -> None:
+        # The lock may have been held by another thread at fork time.
+        self._lock = threading.Lock()
+        self._reset_locked()
+
+
+_client_pool = _ClientPool()
+os.register_at_fork(after_in_child=_client_pool._after_fork_in_child)
+
+
+def get_client(
+    client_type: Type[_ServiceClient],
+    api_endpoint: str | None = _DEFAULT_API_ENDPOINT,
+) -> _ServiceClient:
+    return _client_pool.get(client_type, api_endpoint)
+
+
+def get_async_client(
+    client_type: Type[_ServiceClient],
+    api_endpoint: str | None = _DEFAULT_API_ENDPOINT,
+) -> _ServiceClient:
+    return _client_pool.get(
+        client_type, api_endpoint, loop=asyncio.get_running_loop()
     )
+
+
+def get_client_pool_stats() -> ClientPoolStats:
+    return _client_pool.stats()
+
+
+def reset_client_pool() -> None:
+    _client_pool.reset()
+
+
+def list_models() -> Iterable[genai.Model]:
+    service = get_client(genai.ModelServiceClient)
     models = service.list_models(request=genai.ListModelsRequest())
     return [model for model in models]
 
 
-def generate_text(model: str, prompt: str) -> str:
-    service = genai.TextServiceClient(
-        client_options=client_options_lib.ClientOptions(
-            api_endpoint=_DEFAULT_API_ENDPOINT
-        ),
+class _ModelCatalog:
+    """In-memory cache of `list_models()` with a TTL and an on-disk snapshot.
+
+    Constructing an LLM only needs the model's token limits, so it should
+    not cost a network round trip each time.
+    """
+
+    def __init__(
+        self, *, ttl_seconds: float, snapshot_path: str | None
+    ) -> None:
+        self._lock = threading.Lock()
+        self._ttl_seconds = ttl_seconds
+        self._snapshot_path = snapshot_path
+        self._models: Dict[str, genai.Model] = {}
+        self._fetched_at = 0.0
+
+    def get(self, model_name: str | None) -> genai.Model:
+        with self._lock:
+            if not self._models:
+                self._load_snapshot()
+            if self._is_stale() or model_name not in self._models:
+                self._refresh()
+            if model_name is None or model_name not in self._models:
+                raise ValueError(
+                    f"Model name {model_name} not found in {self._models.keys()}"
+                )
+            return self._models[model_name]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._fetched_at = 0.0
+
+    def save_snapshot(self, path: str) -> None:
+        with self._lock:
+            self._save_snapshot(path)
+
+    def _is_stale(self) -> bool:
+        return time.time() - self._fetched_at > self._ttl_seconds
+
+    def _refresh(self) -> None:
+        try:
+            models = list_models()
+        except Exception as e:
+            if not self._models:
+                raise
+            _logger.warning(f"Cannot refresh model catalog; using cached: {e}")
+            # Do not retry on every lookup while the service is unreachable.
+            self._fetched_at = (
+                time.time() - self._ttl_seconds + MODEL_CATALOG_RETRY_SECONDS
+            )
+            return
+        self._models = {m.name: m for m in models}
+        self._fetched_at = time.time()
+        if self._snapshot_path is not None:
+            self._save_snapshot(self._snapshot_path)
+
+    def _load_snapshot(self) -> None:
+        if self._snapshot_path is None or not os.path.exists(self._snapshot_path):
+            return
+        with open(self._snapshot_path) as f:
+            models = [genai.Model(m) for m in json.load(f)]
+        self._models = {m.name: m for m in models}
+        self._fetched_at = os.path.getmtime(self._snapshot_path)
+
+    def _save_snapshot(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                [genai.Model.to_dict(m) for m in self._models.values()],
+                f,
+                indent=2,
+            )
+        os.replace(tmp_path, path)
+
+
+_model_catalog = _ModelCatalog(
+    ttl_seconds=MODEL_CATALOG_TTL_SECONDS,
+    snapshot_path=MODEL_CATALOG_SNAPSHOT_PATH,
+)
+
+
+def get_model(model_name: str | None) -> genai.Model:
+    return _model_catalog.get(model_name)
+
+
+def invalidate_model_catalog() -> None:
+    _model_catalog.invalidate()
+
+
+def save_model_catalog_snapshot(path: str) -> None:
+    _model_catalog.save_snapshot(path)
+
+
+def generate_text(
+    model: str,
+    prompt: str,
+    *,
+    temperature: float,
+    cache: bool = True,
+) -> str:
+    request = _build_generate_text_request(
+        model=model, prompt=prompt, temperature=temperature
     )
-    response = service.generate_text(
-        request=genai.GenerateTextRequest(
-            model=model, temperature=0.2, prompt=genai.TextPrompt(text=prompt)
-        )
+    key = _completion_key(request) if cache else None
+    if key is not None:
+        completion = get_completion_cache().get(key)
+        if completion is not None:
+            return completion
+    service = get_client(genai.TextServiceClient)
+    completion = _get_generated_text(service.generate_text(request=request))
+    if key is not None:
+        get_completion_cache().put(key, completion)
+    return completion
+
+
+async def agenerate_text(
+    model: str,
+    prompt: str,
+    *,
+    temperature: float,
+    cache: bool = True,
+) -> str:
+    request = _build_generate_text_request(
+        model=model, prompt=prompt, temperature=temperature
+    )
+    key = _completion_key(request) if cache else None
+    if key is not None:
+        completion = await asyncio.to_thread(get_completion_cache().get, key)
+        if completion is not None:
+            return completion
+    service = get_async_client(genai.TextServiceAsyncClient)
+    response = await service.generate_text(request=request)
+    completion = _get_generated_text(response)
+    if key is not None:
+        await asyncio.to_thread(get_completion_cache().put, key, completion)
+    return completion
+
+
+def _build_generate_text_request(
+    *, model: str, prompt: str, temperature: float
+) -> genai.GenerateTextRequest:
+    return genai.GenerateTextRequest(
+        model=model,
+        temperature=temperature,
+        prompt=genai.TextPrompt(text=prompt),
     )
+
+
+def _get_generated_text(response: genai.GenerateTextResponse) -> str:
     candidates = list(response.candidates)
     if len(candidates) == 0:
         return ""
@@ -35,28 +304,139 @@ def generate_text(model: str, prompt: str) -> str:
     return str(candidate.output)
 
 
-def generate_content(model: str, prompt: str) -> str:
-    service = genai.GenerativeServiceClient(
-        client_options=client_options_lib.ClientOptions(
-            api_endpoint=_DEFAULT_API_ENDPOINT
-        ),
+def generate_content(
+    model: str,
+    prompt: str,
+    *,
+    temperature: float,
+    cache: bool = True,
+) -> str:
+    request = _build_generate_content_request(
+        model=model, prompt=prompt, temperature=temperature
     )
-    response = service.generate_content(
-        request=genai.GenerateContentRequest(
-            model=model,
-            contents=[
-                genai.Content(
-                    parts=[
-                        genai.Part(text=prompt),
-                    ],
-                )
-            ],
-            generation_config=genai.GenerationConfig(
-                temperature=0.7,
-            ),
+    key = _completion_key(request) if cache else None
+    if key is not None:
+        completion = get_completion_cache().get(key)
+        if completion is not None:
+            return completion
+    service = get_client(genai.GenerativeServiceClient)
+    completion = _get_generated_content(
+        service.generate_content(request=request)
+    )
+    if key is not None:
+        get_completion_cache().put(key, completion)
+    return completion
+
+
+async def agenerate_content(
+    model: str,
+    prompt: str,
+    *,
+    temperature: float,
+    cache: bool = True,
+) -> str:
+    request = _build_generate_content_request(
+        model=model, prompt=prompt, temperature=temperature
+    )
+    key = _completion_key(request) if cache else None
+    if key is not None:
+        completion = await asyncio.to_thread(get_completion_cache().get, key)
+        if completion is not None:
+            return completion
+    service = get_async_client(genai.GenerativeServiceAsyncClient)
+    response = await service.generate_content(request=request)
+    completion = _get_generated_content(response)
+    if key is not None:
+        await asyncio.to_thread(get_completion_cache().put, key, completion)
+    return completion
+
+
+def stream_generate_content(
+    model: str,
+    prompt: str,
+    *,
+    temperature: float,
+    cache: bool = True,
+) -> Iterator[str]:
+    """Yields deltas, or the whole completion at once if it is cached."""
+    request = _build_generate_content_request(
+        model=model, prompt=prompt, temperature=temperature
+    )
+    key = _completion_key(request) if cache else None
+    if key is not None:
+        completion = get_completion_cache().get(key)
+        if completion is not None:
+            yield completion
+            return
+    service = get_client(genai.GenerativeServiceClient)
+    deltas = []
+    for response in service.stream_generate_content(request=request):
+        delta = _get_generated_content(response)
+        deltas.append(delta)
+        yield delta
+    # Only reached if the stream was consumed to the end.
+    if key is not None:
+        get_completion_cache().put(key, "".join(deltas))
+
+
+async def astream_generate_content(
+    model: str,
+    prompt: str,
+    *,
+    temperature: float,
+    cache: bool = True,
+) -> AsyncIterator[str]:
+    """See `stream_generate_content`."""
+    request = _build_generate_content_request(
+        model=model, prompt=prompt, temperature=temperature
+    )
+    key = _completion_key(request) if cache else None
+    if key is not None:
+        completion = await asyncio.to_thread(get_completion_cache().get, key)
+        if completion is not None:
+            yield completion
+            return
+    service = get_async_client(genai.GenerativeServiceAsyncClient)
+    stream = await service.stream_generate_content(request=request)
+    deltas = []
+    async for response in stream:
+        delta = _get_generated_content(response)
+        deltas.append(delta)
+        yield delta
+    if key is not None:
+        await asyncio.to_thread(
+            get_completion_cache().put, key, "".join(deltas)
         )
+
+
+def _build_generate_content_request(
+    *, model: str, prompt: str, temperature: float
+) -> genai.GenerateContentRequest:
+    return genai.GenerateContentRequest(
+        model=model,
+        contents=[
+            genai.Content(
+                parts=[
+                    genai.Part(text=prompt),
+                ],
+            )
+        ],
+        generation_config=genai.GenerationConfig(
+            temperature=temperature,
+        ),
+    )
+
+
+def _completion_key(
+    request: genai.GenerateTextRequest | genai.GenerateContentRequest,
+) -> str:
+    # The request holds the model, the prompt and the generation config.
+    return completion_key(
+        type(request).__name__, type(request).serialize(request)
     )
 
+
+def _get_generated_content(response: genai.GenerateContentResponse) -> str:
     if len(response.candidates) == 0:
         return ""
 
@@ -70,11 +450,7 @@ def generate_content(model: str, prompt: str) -> str:
 
 
 def generate_answer(model: str, prompt: str) -> str:
-    service = genai.GenerativeServiceClient(
-        client_options=client_options_lib.ClientOptions(
-            api_endpoint=_DEFAULT_API_ENDPOINT
-        ),
-    )
+    service = get_client(genai.GenerativeServiceClient)
     response = service.generate_answer(
         request=genai.GenerateAnswerRequest(
             model=model,
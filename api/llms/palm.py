@@ -5,12 +5,18 @@ from llama_index.bridge.pydantic import Field, PrivateAttr
 from llama_index.callbacks import CallbackManager
 from llama_index.llms.base import (
     CompletionResponse,
+    CompletionResponseAsyncGen,
     CompletionResponseGen,
     LLMMetadata,
     llm_completion_callback,
 )
 from llama_index.llms.custom import CustomLLM
 
+from .completion_cache import CACHEABLE_TEMPERATURE
+
+# The sampling temperature unless one is given.
+DEFAULT_TEMPERATURE = 0.2
+
 
 class PaLM(CustomLLM):
     """Gemini LLM."""
@@ -20,6 +26,14 @@ class PaLM(CustomLLM):
     generate_kwargs: dict = Field(
         default_factory=dict, description="Kwargs for generation."
     )
+    temperature: float = Field(
+        default=DEFAULT_TEMPERATURE,
+        description="The sampling temperature.",
+    )
+    cache_completions: bool = Field(
+        description="Whether to memoize completions. By default, only if "
+        "`temperature` is at most `CACHEABLE_TEMPERATURE`."
+    )
 
     _model: Any = PrivateAttr()
 
@@ -27,30 +41,29 @@ class PaLM(CustomLLM):
         self,
         model_name: Optional[str] = "models/text-bison-001",
         num_output: Optional[int] = None,
+        temperature: float = DEFAULT_TEMPERATURE,
+        cache_completions: Optional[bool] = None,
         callback_manager: Optional[CallbackManager] = None,
         **generate_kwargs: Any,
     ) -> None:
         """Initialize params."""
-        from .genaix import list_models
-
-        models = list_models()
-        models_dict = {m.name: m for m in models}
-        if model_name not in models_dict:
-            raise ValueError(
-                f"Model name {model_name} not found in {models_dict.keys()}"
-            )
+        from .genaix import get_model
 
-        model_name = model_name
-        self._model = models_dict[model_name]
+        self._model = get_model(model_name)
 
         # get num_output
         num_output = num_output or self._model.output_token_limit
 
+        if cache_completions is None:
+            cache_completions = temperature <= CACHEABLE_TEMPERATURE
+
         generate_kwargs = generate_kwargs or {}
         super().__init__(
             model_name=model_name,
             num_output=num_output,
+            temperature=temperature,
             generate_kwargs=generate_kwargs,
+            cache_completions=cache_completions,
             callback_manager=callback_manager,
         )
 
@@ -85,6 +98,33 @@ class PaLM(CustomLLM):
         completion = generate_text(
             model=self.model_name,
             prompt=prompt,
+            temperature=self.temperature,
+            cache=self.cache_completions,
+            **kwargs,
+        )
+        return CompletionResponse(text=completion)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        """Asynchronously predict the answer to a query.
+
+        Unlike the `CustomLLM` default, this awaits the async service client
+        instead of blocking the event loop on `complete`.
+
+        Args:
+            prompt (str): Prompt to use for prediction.
+
+        Returns:
+            CompletionResponse: The predicted answer.
+
+        """
+        from .genaix import agenerate_text
+
+        completion = await agenerate_text(
+            model=self.model_name,
+            prompt=prompt,
+            temperature=self.temperature,
+            cache=self.cache_completions,
             **kwargs,
         )
         return CompletionResponse(text=completion)
@@ -93,16 +133,55 @@ class PaLM(CustomLLM):
     def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
         """Stream the answer to a query.
 
-        NOTE: this is a beta feature. Will try to build or use
-        better abstractions about response handling.
+        The text service has no streaming RPC, so the whole answer arrives as
+        a single chunk.
 
         Args:
             prompt (str): Prompt to use for prediction.
 
         Returns:
-            str: The predicted answer.
+            CompletionResponseGen: A single response with the whole answer.
 
         """
-        raise NotImplementedError(
-            "PaLM does not support streaming completion in LlamaIndex currently."
-        )
+        from .genaix import generate_text
+
+        def gen() -> CompletionResponseGen:
+            completion = generate_text(
+                model=self.model_name,
+                prompt=prompt,
+                temperature=self.temperature,
+                cache=self.cache_completions,
+                **kwargs,
+            )
+            yield CompletionResponse(text=completion, delta=completion)
+
+        return gen()
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        """Asynchronously stream the answer to a query.
+
+        See `stream_complete`.
+
+        Args:
+            prompt (str): Prompt to use for prediction.
+
+        Returns:
+            CompletionResponseAsyncGen: A single response with the whole answer.
+
+        """
+        from .genaix import agenerate_text
+
+        async def gen() -> CompletionResponseAsyncGen:
+            completion = await agenerate_text(
+                model=self.model_name,
+                prompt=prompt,
+                temperature=self.temperature,
+                cache=self.cache_completions,
+                **kwargs,
+            )
+            yield CompletionResponse(text=completion, delta=completion)
+
+        return gen()
@@ -0,0 +1,513 @@
+"""A vector store on local disk, as an offline stand-in for Google corpora.
+
+`LocalVectorStore` keeps the embeddings of a corpus in one memory-mapped
+float32 matrix and searches it exactly, by cosine similarity, in vectorized
+blocks. Like `GoogleVectorStore` it embeds text itself, here with feature
+hashing of the words, so the stacks need no embedding service either.
+
+Large corpora also get an IVF index (see `api.ann`), which `ANNRetriever`
+searches instead of scanning every chunk.
+
+Which corpora are local is configured with `RAG_LOCAL_CORPORA`.
+"""
+import asyncio
+import json
+from llama_index import VectorStoreIndex
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.core import BaseRetriever
+from llama_index.retrievers import VectorIndexRetriever
+from llama_index.schema import (
+    BaseNode,
+    NodeRelationship,
+    NodeWithScore,
+    QueryBundle,
+    RelatedNodeInfo,
+    TextNode,
+)
+from llama_index.vector_stores.google.generativeai import GoogleVectorStore
+from llama_index.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+import logging
+import numpy as np
+import numpy.typing as npt
+import os
+import shutil
+import threading
+from typing import Any, Dict, Iterable, List, Sequence, TypeAlias
+import zlib
+from .ann import ANN_MIN_ROWS, DEFAULT_NPROBE, IVFIndex
+from .bm25 import tokenize
+from .lexical import get_inverted_index, HybridRetriever
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Corpus ids to keep on local disk instead of Google's Semantic Retriever,
+# comma separated. A stack on one of these corpora retrieves offline.
+LOCAL_CORPUS_IDS = frozenset(
+    filter(None, os.environ.get("RAG_LOCAL_CORPORA", "").split(",")))
+LOCAL_STORE_DIR = os.environ.get(
+    "RAG_LOCAL_STORE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "choose-a-rag", "stores"))
+EMBEDDING_DIM = 512
+
+# Rows scored at a time, so a search never holds the whole matrix in memory.
+_QUERY_BLOCK_ROWS = 1 << 16
+# Chunks embedded and appended at a time by `create_chunks`.
+_APPEND_BATCH_ROWS = 1000
+
+
+def embed(texts: Sequence[str]) -> npt.NDArray[np.float32]:
+  """Unit-length hashed bag-of-words vectors, one row per text."""
+  vectors = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+  for row, text in enumerate(texts):
+    hashes = np.array(
+        [zlib.crc32(token.encode("utf-8")) for token in tokenize(text)],
+        dtype=np.int64)
+    # The top bit picks a sign, so collisions cancel out on average.
+    signs = np.where(hashes & (1 << 31), -1.0, 1.0)
+    np.add.at(vectors[row], hashes % EMBEDDING_DIM, signs)
+  vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  normalized: npt.NDArray[np.float32] = vectors / np.maximum(norms, 1e-12)
+  return normalized
+
+
+def embed_query(texts: Sequence[str]) -> List[float]:
+  """One unit-length vector for all of `texts`, e.g. for HyDE.
+
+  Averages like llama_index does for the embedding strings of a query.
+  """
+  mean = embed(texts).mean(axis=0)
+  normalized = mean / max(float(np.linalg.norm(mean)), 1e-12)
+  return [float(x) for x in normalized]
+
+
+class LocalVectorStore(BasePydanticVectorStore):
+  """Exact cosine search over a corpus kept in `LOCAL_STORE_DIR`.
+
+  Rows are only ever appended; deleted rows are masked out by tombstones.
+  """
+  stores_text: bool = True
+  is_embedding_query: bool = False
+
+  corpus_id: str = Field(frozen=True)
+
+  _dir: str = PrivateAttr()
+  _lock: threading.Lock = PrivateAttr()
+  _documents: Dict[str, str] = PrivateAttr()
+  _chunk_ids: List[str] = PrivateAttr()
+  _offsets: List[int] = PrivateAttr()
+  _rows_by_doc: Dict[str, List[int]] = PrivateAttr()
+  _alive: npt.NDArray[np.bool_] = PrivateAttr()
+  _ivf: IVFIndex | None = PrivateAttr()
+
+  def __init__(self, *, corpus_id: str) -> None:
+    super().__init__(corpus_id=corpus_id)  # type: ignore[call-arg]
+    self._dir = os.path.join(LOCAL_STORE_DIR, corpus_id)
+    self._lock = threading.Lock()
+    os.makedirs(self._dir, exist_ok=True)
+    self._load()
+
+  @classmethod
+  def class_name(cls) -> str:
+    return "LocalVectorStore"
+
+  @property
+  def client(self) -> Any:
+    return None
+
+  def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+    """Same as `GoogleVectorStore.add`."""
+    for document_id, group in _group_by_document(nodes).items():
+      source = group[0].source_node
+      if not self.has_document(document_id):
+        self.create_document(
+            document_id,
+            (source.metadata.get("file_name") if source else None)
+            or document_id)
+      self.create_chunks(document_id, group)
+    return [node.node_id for node in nodes]
+
+  def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+    with self._lock:
+      self._tombstone(self._rows_by_doc.pop(ref_doc_id, []))
+      self._documents.pop(ref_doc_id, None)
+      self._save_documents()
+
+  def query(
+      self, query: VectorStoreQuery, **kwargs: Any
+  ) -> VectorStoreQueryResult:
+    """Scores every chunk, so the result is exact."""
+    return self._query(query, approximate=False)
+
+  def approximate_query(
+      self, query: VectorStoreQuery, *, nprobe: int = DEFAULT_NPROBE
+  ) -> VectorStoreQueryResult:
+    """Like `query`, but through the IVF index once the corpus has one."""
+    return self._query(query, approximate=True, nprobe=nprobe)
+
+  # The methods below are what `api.ingest.Corpus` needs.
+
+  def has_document(self, document_id: str) -> bool:
+    with self._lock:
+      return document_id in self._documents
+
+  def create_document(self, document_id: str, display_name: str) -> None:
+    with self._lock:
+      self._documents[document_id] = display_name
+      self._save_documents()
+
+  def list_chunk_ids(self, document_id: str) -> Iterable[str]:
+    with self._lock:
+      return [self._chunk_ids[row]
+              for row in self._rows_by_doc.get(document_id, [])]
+
+  def create_chunks(self, document_id: str, nodes: Iterable[BaseNode]) -> int:
+    created = 0
+    batch: List[BaseNode] = []
+    for node in nodes:
+      batch.append(node)
+      if len(batch) >= _APPEND_BATCH_ROWS:
+        created += self._append(document_id, batch)
+        batch = []
+    created += self._append(document_id, batch)
+    if created:
+      self._update_index()
+    return created
+
+  def delete_chunks(self, document_id: str, chunk_ids: List[str]) -> None:
+    doomed = set(chunk_ids)
+    with self._lock:
+      rows = self._rows_by_doc.get(document_id, [])
+      self._tombstone([row for row in rows if self._chunk_ids[row] in doomed])
+      self._rows_by_doc[document_id] = [
+          row for row in rows if self._chunk_ids[row] not in doomed]
+
+  def list_documents(self) -> Dict[str, str]:
+    with self._lock:
+      return dict(self._documents)
+
+  async def aclear(self) -> None:
+    await asyncio.to_thread(self._clear)
+
+  def _clear(self) -> None:
+    with self._lock:
+      shutil.rmtree(self._dir, ignore_errors=True)
+      os.makedirs(self._dir, exist_ok=True)
+      self._load()
+
+  def _query(
+      self,
+      query: VectorStoreQuery,
+      *,
+      approximate: bool,
+      nprobe: int = DEFAULT_NPROBE,
+  ) -> VectorStoreQueryResult:
+    if query.query_embedding is not None:
+      query_vector = np.asarray(query.query_embedding, dtype=np.float32)
+    elif query.query_str is not None:
+      query_vector = embed([query.query_str])[0]
+    else:
+      raise ValueError("LocalVectorStore needs the query text.")
+
+    with self._lock:
+      count = len(self._chunk_ids)
+      alive = self._alive[:count].copy()
+      if query.doc_ids is not None:
+        allowed = np.zeros(count, dtype=np.bool_)
+        for doc_id in query.doc_ids:
+          allowed[self._rows_by_doc.get(doc_id, [])] = True
+        alive &= allowed
+      if query.node_ids is not None:
+        wanted = set(query.node_ids)
+        alive &= np.array(
+            [chunk_id in wanted for chunk_id in self._chunk_ids[:count]],
+            dtype=np.bool_)
+      ivf = self._ivf if approximate else None
+    if count == 0:
+      rows: List[int] = []
+      scores: List[float] = []
+    elif ivf is not None:
+      rows, scores = ivf.search(
+          self._matrix(count),
+          query_vector,
+          alive,
+          query.similarity_top_k,
+          nprobe)
+    else:
+      rows, scores = self._search(
+          query_vector, alive, count, query.similarity_top_k)
+
+    nodes = self._read_nodes(rows)
+    return VectorStoreQueryResult(
+        nodes=nodes,
+        similarities=scores,
+        ids=[node.node_id for node in nodes],
+    )
+
+  def _path(self, name: str) -> str:
+    return os.path.join(self._dir, name)
+
+  def _load(self) -> None:
+    try:
+      with open(self._path("documents.json"), "r", encoding="utf-8") as f:
+        self._documents = json.load(f)
+    except FileNotFoundError:
+      self._documents = {}
+
+    self._chunk_ids = []
+    self._offsets = []
+    self._rows_by_doc = {}
+    vector_rows = _file_size(self._path("vectors.f32")) // (EMBEDDING_DIM * 4)
+    with open(self._path("chunks.jsonl"), "a+b") as f:
+      f.seek(0)
+      offset = 0
+      for line in f:
+        if len(self._chunk_ids) == vector_rows or not line.endswith(b"\n"):
+          break  # A write was cut short.
+        chunk = json.loads(line)
+        self._rows_by_doc.setdefault(chunk["doc_id"], []).append(
+            len(self._chunk_ids))
+        self._chunk_ids.append(chunk["id"])
+        self._offsets.append(offset)
+        offset += len(line)
+      f.truncate(offset)
+    count = len(self._chunk_ids)
+    with open(self._path("vectors.f32"), "a+b") as f:
+      f.truncate(count * EMBEDDING_DIM * 4)
+
+    self._alive = np.ones(count, dtype=np.bool_)
+    try:
+      with open(self._path("tombstones.txt"), "r", encoding="utf-8") as f:
+        dead = [int(line) for line in f if line.strip()]
+      self._alive[[row for row in dead if row < count]] = False
+    except FileNotFoundError:
+      pass
+    for doc_id, rows in self._rows_by_doc.items():
+      self._rows_by_doc[doc_id] = [row for row in rows if self._alive[row]]
+
+    self._ivf = IVFIndex.load(self._path("ivf.npz"))
+    if self._ivf is not None:
+      if self._ivf.size > count:
+        self._ivf.truncate(count)
+      elif self._ivf.size < count:
+        self._ivf.add(self._matrix(count)[self._ivf.size:])
+    _logger.info(f"Loaded {int(self._alive.sum())} chunks from {self._dir}")
+
+  def _append(self, document_id: str, nodes: List[BaseNode]) -> int:
+    if not nodes:
+      return 0
+    texts = [node.get_content() for node in nodes]
+    vectors = embed(texts)
+    lines = [
+        (json.dumps({"id": node.node_id, "doc_id": document_id, "text": text})
+         + "\n").encode("utf-8")
+        for node, text in zip(nodes, texts)
+    ]
+    with self._lock:
+      # Vectors first: `_load` drops chunks that have no vector.
+      with open(self._path("vectors.f32"), "ab") as f:
+        f.write(vectors.tobytes())
+      if self._ivf is not None:
+        self._ivf.add(vectors)
+      offset = _file_size(self._path("chunks.jsonl"))
+      with open(self._path("chunks.jsonl"), "ab") as f:
+        f.writelines(lines)
+      rows = self._rows_by_doc.setdefault(document_id, [])
+      for node, line in zip(nodes, lines):
+        rows.append(len(self._chunk_ids))
+        self._chunk_ids.append(node.node_id)
+        self._offsets.append(offset)
+        offset += len(line)
+      self._alive = np.concatenate(
+          [self._alive, np.ones(len(nodes), dtype=np.bool_)])
+    return len(nodes)
+
+  def _tombstone(self, rows: List[int]) -> None:
+    if not rows:
+      return
+    self._alive[rows] = False
+    with open(self._path("tombstones.txt"), "a", encoding="utf-8") as f:
+      f.writelines(f"{row}\n" for row in rows)
+
+  def _save_documents(self) -> None:
+    tmp_path = self._path("documents.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump(self._documents, f)
+    os.replace(tmp_path, self._path("documents.json"))
+
+  def _search(
+      self,
+      query_vector: npt.NDArray[np.float32],
+      alive: npt.NDArray[np.bool_],
+      count: int,
+      top_k: int,
+  ) -> tuple[List[int], List[float]]:
+    if count == 0 or top_k <= 0:
+      return [], []
+    matrix = self._matrix(count)
+    rows: List[npt.NDArray[np.int64]] = []
+    scores: List[npt.NDArray[np.float32]] = []
+    for start in range(0, count, _QUERY_BLOCK_ROWS):
+      block_scores = matrix[start:start + _QUERY_BLOCK_ROWS] @ query_vector
+      block_scores[~alive[start:start + _QUERY_BLOCK_ROWS]] = -np.inf
+      k = min(top_k, len(block_scores))
+      best = np.argpartition(-block_scores, k - 1)[:k]
+      rows.append(best + start)
+      scores.append(block_scores[best])
+    all_rows = np.concatenate(rows)
+    all_scores = np.concatenate(scores)
+    order = np.argsort(-all_scores, kind="stable")[:top_k]
+    return (
+        [int(all_rows[i]) for i in order if np.isfinite(all_scores[i])],
+        [float(all_scores[i]) for i in order if np.isfinite(all_scores[i])],
+    )
+
+  def _matrix(self, count: int) -> npt.NDArray[np.float32]:
+    # Rows below `count` are never rewritten, so no lock is needed to read
+    # them.
+    matrix: npt.NDArray[np.float32] = np.memmap(
+        self._path("vectors.f32"),
+        dtype=np.float32,
+        mode="r",
+        shape=(count, EMBEDDING_DIM))
+    return matrix
+
+  def _update_index(self) -> None:
+    """Builds, extends or retrains the IVF index, and persists it."""
+    with self._lock:
+      count = len(self._chunk_ids)
+      if self._ivf is None and count < ANN_MIN_ROWS:
+        return
+      if self._ivf is None or self._ivf.needs_retraining(count):
+        # Under the lock, so no rows are appended meanwhile. This blocks
+        # queries for a few seconds, but only when the corpus has grown
+        # RETRAIN_GROWTH times over.
+        self._ivf = IVFIndex.train(self._matrix(count))
+      self._ivf.save(self._path("ivf.npz"))
+
+  def _read_nodes(self, rows: List[int]) -> List[BaseNode]:
+    nodes: List[BaseNode] = []
+    with open(self._path("chunks.jsonl"), "rb") as f:
+      for row in rows:
+        f.seek(self._offsets[row])
+        chunk = json.loads(f.readline())
+        nodes.append(TextNode(
+            id_=chunk["id"],
+            text=chunk["text"],
+            relationships={
+                NodeRelationship.SOURCE: RelatedNodeInfo(
+                    node_id=chunk["doc_id"]),
+            },
+        ))
+    return nodes
+
+
+# What the stacks retrieve from.
+AnyVectorStore: TypeAlias = GoogleVectorStore | LocalVectorStore
+
+
+def open_vector_store(*, corpus_id: str) -> AnyVectorStore:
+  if corpus_id in LOCAL_CORPUS_IDS:
+    return _get_local_store(corpus_id)
+  return GoogleVectorStore.from_corpus(corpus_id=corpus_id)
+
+
+def create_vector_store(
+    *, corpus_id: str, display_name: str
+) -> AnyVectorStore:
+  if corpus_id in LOCAL_CORPUS_IDS:
+    return _get_local_store(corpus_id)
+  return GoogleVectorStore.create_corpus(
+      corpus_id=corpus_id, display_name=display_name)
+
+
+_local_stores: Dict[str, LocalVectorStore] = {}
+_local_stores_lock = threading.Lock()
+
+
+def _get_local_store(corpus_id: str) -> LocalVectorStore:
+  # Stacks on the same corpus must share its in-memory index.
+  with _local_stores_lock:
+    if corpus_id not in _local_stores:
+      _local_stores[corpus_id] = LocalVectorStore(corpus_id=corpus_id)
+    return _local_stores[corpus_id]
+
+
+class ANNRetriever(BaseRetriever):
+  """Retrieves from a `LocalVectorStore` through its IVF index."""
+
+  def __init__(
+      self,
+      store: LocalVectorStore,
+      *,
+      similarity_top_k: int,
+      nprobe: int = DEFAULT_NPROBE,
+  ) -> None:
+    super().__init__(callback_manager=None)
+    self._store = store
+    self._similarity_top_k = similarity_top_k
+    self._nprobe = nprobe
+
+  def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+    result = self._store.approximate_query(
+        VectorStoreQuery(
+            query_str=query_bundle.query_str,
+            query_embedding=query_bundle.embedding,
+            similarity_top_k=self._similarity_top_k),
+        nprobe=self._nprobe)
+    assert result.nodes is not None and result.similarities is not None
+    return [
+        NodeWithScore(node=node, score=score)
+        for node, score in zip(result.nodes, result.similarities)
+    ]
+
+
+def build_retriever(
+    index: VectorStoreIndex,
+    *,
+    similarity_top_k: int,
+    hybrid_top_k: int | None = None,
+) -> BaseRetriever:
+  """An `ANNRetriever` for local stores, else a `VectorIndexRetriever`.
+
+  With `hybrid_top_k`, it is fused with BM25 over the corpus' inverted index
+  into that many nodes, once the index has documents (see `HybridRetriever`).
+  """
+  store = index.vector_store
+  assert isinstance(store, (GoogleVectorStore, LocalVectorStore))
+  retriever: BaseRetriever
+  if isinstance(store, LocalVectorStore):
+    retriever = ANNRetriever(store, similarity_top_k=similarity_top_k)
+  else:
+    retriever = VectorIndexRetriever(
+        index=index, similarity_top_k=similarity_top_k)
+  if hybrid_top_k is None:
+    return retriever
+  return HybridRetriever(
+      retriever,
+      get_inverted_index(store.corpus_id),
+      similarity_top_k=hybrid_top_k)
+
+
+def _group_by_document(
+    nodes: Sequence[BaseNode]
+) -> Dict[str, List[BaseNode]]:
+  groups: Dict[str, List[BaseNode]] = {}
+  for node in nodes:
+    groups.setdefault(node.ref_doc_id or "default-doc", []).append(node)
+  return groups
+
+
+def _file_size(path: str) -> int:
+  try:
+    return os.path.getsize(path)
+  except FileNotFoundError:
+    return 0
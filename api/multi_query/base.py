@@ -3,34 +3,48 @@ from llama_index import (
     LLMPredictor,
     VectorStoreIndex,
 )
+from llama_index.core import BaseRetriever
 from llama_index.llms.base import LLM
-import llama_index.vector_stores.google.generativeai.genai_extension as genaix
-from llama_index.vector_stores.google.generativeai import (
-    GoogleVectorStore,
-    google_service_context,
-)
-from llama_index.indices.query.base import BaseQueryEngine
-from llama_index.indices.query.query_transform.base import (
-    StepDecomposeQueryTransform,
-)
+from llama_index.vector_stores.google.generativeai import google_service_context
 from llama_index.prompts.base import PromptTemplate
-from llama_index.query_engine.multistep_query_engine import (
-    MultiStepQueryEngine,
-)
 from llama_index.response.schema import Response
-from llama_index.schema import QueryBundle
+from llama_index.response_synthesizers.google.generativeai import (
+    GoogleTextSynthesizer,
+)
+from llama_index.schema import NodeWithScore, QueryBundle
 import logging
+import os
 from openai._types import FileContent
-from pydantic import BaseModel, PrivateAttr
+from pydantic import PrivateAttr
 from tempfile import SpooledTemporaryFile
-from typing import Any, cast, Dict, Iterable, List, Literal
+from typing import Any, AsyncIterator, cast, Dict, Iterable, List, Tuple
+from ..async_query import (
+    amulti_step_query,
+    aparallel_multi_step_query,
+    aretrieve,
+    astream_answer,
+    asynthesize,
+    astream_steps,
+    StepCallback,
+)
 from ..base_rag import (
     AttributedAnswer,
     BaseRag,
+    ConversationEvent,
+    FILE_PAGE_SIZE,
+    FilePage,
     build_response_synthesizer,
     PASSAGE_COUNT,
+    with_completion_cache,
 )
 from ..chunkers import chunk_unstructured
+from ..conversation import ConversationHistory
+from .. import ingest
+from ..local_store import (
+    AnyVectorStore,
+    create_vector_store,
+    open_vector_store,
+)
 
 
 _logger = logging.getLogger(__name__)
@@ -38,13 +52,40 @@ _logger.setLevel(logging.INFO)
 _logger.addHandler(logging.StreamHandler())
 
 
-class ConversationMessage(BaseModel):
-  role: Literal["assistant", "user"]
-  message: AttributedAnswer
-
-
 STEP_COUNT = 5
+# Whether to answer the independent sub-questions concurrently before asking
+# the dependent ones one at a time. Set RAG_PARALLEL_STEPS=1 to enable.
+PARALLEL_STEPS = os.environ.get("RAG_PARALLEL_STEPS", "") == "1"
+# Maximum number of sub-questions answered at the same time.
+MAX_PARALLEL_STEPS = 3
 DEFAULT_CORPUS_ID = "ltsang-unstructured"
+_INDEX_SUMMARY = "Ask me anything."
+_PARALLEL_DECOMPOSE_QUERY_TMPL = (
+    "The original question is as follows: {query_str}\n"
+    "We have an opportunity to answer some, or all of the question from a "
+    "knowledge source. "
+    "Context information for the knowledge source: {context_str}\n"
+    "Break the original question into at most {max_questions} questions "
+    "that can be answered from the knowledge source. "
+    "Each question must be answerable on its own, without knowing the answer "
+    "to any of the other questions. "
+    "Leave out questions that depend on the answer of another question; "
+    "they will be asked later.\n"
+    "If the original question cannot be broken down, return the original "
+    "question as the only question.\n"
+    "Do NOT ask the same question twice!\n"
+    "Write one question per line and nothing else.\n\n"
+    "Example:\n"
+    "Question: Who won more Grand Slam titles, the winner of the 2020 "
+    "Australian Open or the winner of the 2020 US Open?\n"
+    "Questions:\n"
+    "Who was the winner of the 2020 Australian Open?\n"
+    "Who was the winner of the 2020 US Open?\n\n"
+    "Question: {query_str}\n"
+    "Questions:\n"
+)
+_PARALLEL_DECOMPOSE_QUERY_PROMPT = PromptTemplate(
+  _PARALLEL_DECOMPOSE_QUERY_TMPL)
 _STEP_DECOMPOSE_QUERY_TRANSFORM_TMPL = (
     "The original question is as follows: {query_str}\n"
     "We have an opportunity to answer some, or all of the question from a "
@@ -104,75 +145,101 @@ _STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT = PromptTemplate(
   _STEP_DECOMPOSE_QUERY_TRANSFORM_TMPL)
 
 class MultiQueryBaseRag(BaseRag):
-  _store: GoogleVectorStore = PrivateAttr()
-  _query_engine: BaseQueryEngine = PrivateAttr()
-
-  conversation: List[ConversationMessage] = []
-
-  def __init__(self, *, store: GoogleVectorStore, llm: LLM) -> None:
+  _store: AnyVectorStore = PrivateAttr()
+  _retriever: BaseRetriever = PrivateAttr()
+  _response_synthesizer: GoogleTextSynthesizer = PrivateAttr()
+  _llm_predictor: LLMPredictor = PrivateAttr()
+  # Streams the answers of `stream_conversation`.
+  _llm: LLM = PrivateAttr()
+  _parallel_steps: bool = PrivateAttr()
+
+  _conversation: ConversationHistory = PrivateAttr(
+      default_factory=ConversationHistory)
+
+  def __init__(
+      self,
+      *,
+      store: AnyVectorStore,
+      llm: LLM,
+      parallel_steps: bool = PARALLEL_STEPS,
+  ) -> None:
     super().__init__()
 
     index = VectorStoreIndex.from_vector_store(
         vector_store=store,
         service_context=google_service_context)
     response_synthesizer = build_response_synthesizer()
-    single_step_query_engine = index.as_query_engine(
-        similarity_top_k=PASSAGE_COUNT,
-        response_synthesizer=response_synthesizer)
-    step_decompose_transform = StepDecomposeQueryTransform(
-        LLMPredictor(llm=llm),
-        step_decompose_query_prompt=_STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT,
-        verbose=True)
-    query_engine = MultiStepQueryEngine(
-        query_engine=single_step_query_engine,
-        query_transform=step_decompose_transform,
-        response_synthesizer=response_synthesizer,
-        index_summary="Ask me anything.",
-        stop_fn=_stop_fn,
-        num_steps=STEP_COUNT)
+    retriever = index.as_retriever(similarity_top_k=PASSAGE_COUNT)
 
     self._store = store
-    self._query_engine = query_engine
+    self._retriever = retriever
+    self._response_synthesizer = response_synthesizer
+    self._llm_predictor = LLMPredictor(llm=with_completion_cache(llm))
+    self._llm = llm
+    self._parallel_steps = parallel_steps
 
   @classmethod
   async def create(
-      cls, *, corpus_id: str, display_name: str, llm: LLM
+      cls,
+      *,
+      corpus_id: str,
+      display_name: str,
+      llm: LLM,
+      parallel_steps: bool = PARALLEL_STEPS,
   ) -> BaseRag:
     return await asyncio.to_thread(
         lambda: cls._create(
-            corpus_id=corpus_id, display_name=display_name, llm=llm)
+            corpus_id=corpus_id,
+            display_name=display_name,
+            llm=llm,
+            parallel_steps=parallel_steps)
     )
 
   @classmethod
   def _create(
-      cls, *, corpus_id: str, display_name: str, llm: LLM
+      cls,
+      *,
+      corpus_id: str,
+      display_name: str,
+      llm: LLM,
+      parallel_steps: bool = PARALLEL_STEPS,
   ) -> BaseRag:
     return cls(
-      store=GoogleVectorStore.create_corpus(
+      store=create_vector_store(
           corpus_id=corpus_id,
           display_name=display_name),
-      llm=llm)
+      llm=llm,
+      parallel_steps=parallel_steps)
 
   @classmethod
-  async def get(cls, *, corpus_id: str, llm: LLM) -> BaseRag:
+  async def get(
+      cls, *, corpus_id: str, llm: LLM, parallel_steps: bool = PARALLEL_STEPS
+  ) -> BaseRag:
     return await asyncio.to_thread(
-        lambda: cls._get(corpus_id=corpus_id, llm=llm))
+        lambda: cls._get(
+            corpus_id=corpus_id, llm=llm, parallel_steps=parallel_steps))
 
   @classmethod
-  def _get(cls, *, corpus_id: str, llm: LLM) -> BaseRag:
+  def _get(
+      cls, *, corpus_id: str, llm: LLM, parallel_steps: bool = PARALLEL_STEPS
+  ) -> BaseRag:
     return cls(
-        store=GoogleVectorStore.from_corpus(corpus_id=corpus_id),
-        llm=llm)
+        store=open_vector_store(corpus_id=corpus_id),
+        llm=llm,
+        parallel_steps=parallel_steps)
 
   async def list_files(self) -> Iterable[str]:
     return await asyncio.to_thread(lambda: self._list_files())
 
   def _list_files(self) -> Iterable[str]:
-    return [
-        document.display_name or "?"
-        for document in genaix.list_documents(
-            corpus_id=self._store.corpus_id)
-    ]
+    return ingest.list_files(ingest.get_corpus(self._store)).filenames
+
+  async def list_file_page(
+      self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+  ) -> FilePage:
+    return await asyncio.to_thread(
+        lambda: ingest.list_files(
+            ingest.get_corpus(self._store), cursor=cursor, limit=limit))
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
@@ -187,24 +254,82 @@ class MultiQueryBaseRag(BaseRag):
       self, *, filename: str, content: FileContent, content_type: str
   ) -> None:
     assert isinstance(content, SpooledTemporaryFile)
-    self._store.add(list(chunk_unstructured(filename, content, content_type)))
+    ingest.add_file(
+        corpus=ingest.get_corpus(self._store),
+        filename=filename,
+        content=content,
+        chunk=lambda: chunk_unstructured(filename, content, content_type))
 
   async def clear_files(self) -> None:
-    return await asyncio.to_thread(lambda: self._clear_files())
+    await ingest.aclear_corpus(ingest.get_corpus(self._store))
 
-  def _clear_files(self) -> None:
-    for document in genaix.list_documents(corpus_id=self._store.corpus_id):
-      genaix.delete_document(
-          corpus_id=self._store.corpus_id, document_id=document.document_id
-      )
+  def corpus_version(self) -> int | None:
+    return ingest.corpus_version(self._store.corpus_id)
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    return await asyncio.to_thread(lambda: self._add_conversation(message))
+    return await self._aadd_conversation(message)
+
+  async def _aadd_conversation(self, message: str) -> Iterable[AttributedAnswer]:
+    query_bundle = QueryBundle(message)
+    nodes, source_nodes, metadata = await self._amulti_step_query(query_bundle)
+    response = await asynthesize(
+        self._response_synthesizer, query_bundle, nodes, source_nodes)
+    response.metadata = metadata
+    return self._record_conversation(message, response)
+
+  async def _astream_conversation(
+      self, message: str
+  ) -> AsyncIterator[ConversationEvent]:
+    async for event in astream_steps(
+        lambda on_step: self._astream_answer(message, on_step=on_step)):
+      yield event
+
+  async def _astream_answer(
+      self, message: str, *, on_step: StepCallback
+  ) -> AsyncIterator[ConversationEvent]:
+    query_bundle = QueryBundle(message)
+    nodes, source_nodes, _ = await self._amulti_step_query(
+        query_bundle, on_step=on_step)
+    async for event in astream_answer(
+        self._llm,
+        query_bundle,
+        nodes,
+        lambda response: self._record_conversation(message, response),
+        source_nodes):
+      yield event
+
+  async def _amulti_step_query(
+      self, query_bundle: QueryBundle, *, on_step: StepCallback | None = None
+  ) -> Tuple[List[NodeWithScore], List[NodeWithScore], Dict[str, Any]]:
+    if self._parallel_steps:
+      return await aparallel_multi_step_query(
+          query_bundle,
+          llm_predictor=self._llm_predictor,
+          decompose_prompt=_PARALLEL_DECOMPOSE_QUERY_PROMPT,
+          step_decompose_prompt=_STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT,
+          index_summary=_INDEX_SUMMARY,
+          num_steps=STEP_COUNT,
+          max_concurrency=MAX_PARALLEL_STEPS,
+          stop_fn=_stop_fn,
+          aquery_step=self._aquery_step,
+          on_step=on_step)
+    return await amulti_step_query(
+        query_bundle,
+        llm_predictor=self._llm_predictor,
+        step_decompose_prompt=_STEP_DECOMPOSE_QUERY_TRANSFORM_PROMPT,
+        index_summary=_INDEX_SUMMARY,
+        num_steps=STEP_COUNT,
+        stop_fn=_stop_fn,
+        aquery_step=self._aquery_step,
+        on_step=on_step)
 
-  def _add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    response = self._query_engine.query(message)
-    assert isinstance(response, Response)
+  async def _aquery_step(self, query_bundle: QueryBundle) -> Response:
+    nodes = await aretrieve(self._retriever, query_bundle)
+    return await asynthesize(self._response_synthesizer, query_bundle, nodes)
 
+  def _record_conversation(
+      self, message: str, response: Response
+  ) -> Iterable[AttributedAnswer]:
     assistant_message = AttributedAnswer(
         answer=response.response or '',
         citations=[node.text
@@ -212,25 +337,26 @@ class MultiQueryBaseRag(BaseRag):
         score=_get_answerable_probability(response),
     )
 
-    self.conversation.extend(
-        [
-            ConversationMessage(
-                role="user",
-                message=AttributedAnswer(
-                    answer=message,
-                ),
-            ),
-            ConversationMessage(
-                role="assistant",
-                message=assistant_message,
-            ),
-        ]
+    self._conversation.append(
+        message,
+        assistant_message,
+        citation_ids=[node.node_id
+                      for node in response.source_nodes if node.score is None],
     )
 
     return [assistant_message]
 
-  async def clear_conversation(self) -> None:
-      self.conversation = []
+  def record_turn(
+      self, message: str, answers: Iterable[AttributedAnswer]
+  ) -> None:
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory()
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
 
 
 def _get_answerable_probability(response: Response) -> float | None:
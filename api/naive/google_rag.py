@@ -1,23 +1,29 @@
 import asyncio
-import llama_index.vector_stores.google.generativeai.genai_extension as genaix
+from llama_index.core import BaseRetriever
 from llama_index.indices.managed.google.generativeai import GoogleIndex
 from llama_index.vector_stores.google.generativeai.base import NoSuchCorpusException
-from llama_index.indices.query.base import BaseQueryEngine
 from llama_index.response.schema import Response
+from llama_index.response_synthesizers.google.generativeai import (
+    GoogleTextSynthesizer,
+)
+from llama_index.schema import QueryBundle
 import logging
 from openai._types import FileContent
-from pydantic import BaseModel, PrivateAttr
+from pydantic import PrivateAttr
 from tempfile import SpooledTemporaryFile
-from typing import Iterable, List, Literal
+from typing import Iterable
+from ..async_query import aretrieve, asynthesize
 from ..base_rag import (
-    ANSWER_STYLE,
     AttributedAnswer,
     BaseRag,
+    FILE_PAGE_SIZE,
+    FilePage,
+    build_response_synthesizer,
     PASSAGE_COUNT,
-    SAFETY_SETTING,
-    TEMPERATURE,
 )
 from ..chunkers import chunk_unstructured
+from ..conversation import ConversationHistory
+from .. import ingest
 
 
 _logger = logging.getLogger(__name__)
@@ -28,26 +34,19 @@ _logger.addHandler(logging.StreamHandler())
 DEFAULT_CORPUS_ID = "ltsang-unstructured"
 
 
-class ConversationMessage(BaseModel):
-  role: Literal["assistant", "user"]
-  message: AttributedAnswer
-
-
 class GoogleRag(BaseRag):
   _client: GoogleIndex = PrivateAttr()
-  _query_engine: BaseQueryEngine = PrivateAttr()
+  _retriever: BaseRetriever = PrivateAttr()
+  _response_synthesizer: GoogleTextSynthesizer = PrivateAttr()
 
-  conversation: List[ConversationMessage] = []
+  _conversation: ConversationHistory = PrivateAttr(
+      default_factory=ConversationHistory)
 
   def __init__(self, client: GoogleIndex) -> None:
     super().__init__()
     self._client = client
-    self._query_engine = client.as_query_engine(
-        similarity_top_k=PASSAGE_COUNT,
-        temperature=TEMPERATURE,
-        answer_style=ANSWER_STYLE,
-        safety_setting=SAFETY_SETTING,
-    )
+    self._retriever = client.as_retriever(similarity_top_k=PASSAGE_COUNT)
+    self._response_synthesizer = build_response_synthesizer()
 
   @classmethod
   async def get_default(cls) -> "BaseRag":
@@ -83,9 +82,14 @@ class GoogleRag(BaseRag):
     return await asyncio.to_thread(lambda: self._list_files())
 
   def _list_files(self) -> Iterable[str]:
-    return [
-      document.display_name or "?"
-      for document in genaix.list_documents(corpus_id=self._client.corpus_id)]
+    return ingest.list_files(ingest.GoogleCorpus(self._client.corpus_id)).filenames
+
+  async def list_file_page(
+      self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+  ) -> FilePage:
+    return await asyncio.to_thread(
+        lambda: ingest.list_files(
+            ingest.GoogleCorpus(self._client.corpus_id), cursor=cursor, limit=limit))
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
@@ -98,25 +102,31 @@ class GoogleRag(BaseRag):
       self, *, filename: str, content: FileContent, content_type: str
   ) -> None:
     assert isinstance(content, SpooledTemporaryFile)
-    self._client.insert_nodes(
-        list(chunk_unstructured(filename, content, content_type)))
+    ingest.add_file(
+        corpus=ingest.GoogleCorpus(self._client.corpus_id),
+        filename=filename,
+        content=content,
+        chunk=lambda: chunk_unstructured(filename, content, content_type))
 
   async def clear_files(self) -> None:
-    return await asyncio.to_thread(lambda: self._clear_files())
+    await ingest.aclear_corpus(ingest.GoogleCorpus(self._client.corpus_id))
 
-  def _clear_files(self) -> None:
-    for document in genaix.list_documents(corpus_id=self._client.corpus_id):
-      genaix.delete_document(
-          corpus_id=self._client.corpus_id,
-          document_id=document.document_id)
+  def corpus_version(self) -> int | None:
+    return ingest.corpus_version(self._client.corpus_id)
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    return await asyncio.to_thread(lambda: self._add_conversation(message))
-
-  def _add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    response = self._query_engine.query(message)
-    assert isinstance(response, Response)
-
+    return await self._aadd_conversation(message)
+
+  async def _aadd_conversation(self, message: str) -> Iterable[AttributedAnswer]:
+    query_bundle = QueryBundle(message)
+    nodes = await aretrieve(self._retriever, query_bundle)
+    response = await asynthesize(
+        self._response_synthesizer, query_bundle, nodes)
+    return self._record_conversation(message, response)
+
+  def _record_conversation(
+      self, message: str, response: Response
+  ) -> Iterable[AttributedAnswer]:
     assistant_message = AttributedAnswer(
         answer=response.response or '',
         citations=[node.text
@@ -124,23 +134,26 @@ class GoogleRag(BaseRag):
         score=_get_answerable_probability(response),
     )
 
-    self.conversation.extend([
-      ConversationMessage(
-        role="user",
-        message=AttributedAnswer(
-          answer=message,
-        )
-      ),
-      ConversationMessage(
-        role="assistant",
-        message=assistant_message,
-      ),
-    ])
+    self._conversation.append(
+        message,
+        assistant_message,
+        citation_ids=[node.node_id
+                      for node in response.source_nodes if node.score is None],
+    )
 
     return [assistant_message]
 
-  async def clear_conversation(self) -> None:
-    self.conversation = []
+  def record_turn(
+      self, message: str, answers: Iterable[AttributedAnswer]
+  ) -> None:
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory()
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
 
 
 def _get_answerable_probability(response: Response) -> float | None:
@@ -1,12 +1,14 @@
 import asyncio
 import logging
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, NotFoundError
 from openai.types.beta import Assistant, Thread
 from openai.types.beta.threads import MessageContentText
 from openai._types import FileContent, NOT_GIVEN, NotGiven
 from pydantic import PrivateAttr
-from typing import Iterable, List
-from ..base_rag import AttributedAnswer, BaseRag
+import random
+import time
+from typing import Dict, Iterable, List, Sequence, Tuple
+from ..base_rag import AttributedAnswer, BaseRag, FileStatus, NewFile
 from ..debugging import pretty
 
 
@@ -15,11 +17,38 @@ _logger.setLevel(logging.INFO)
 _logger.addHandler(logging.StreamHandler())
 
 
+# How many files clear_files deletes at the same time. The client itself
+# retries transient failures such as rate limits.
+MAX_CONCURRENT_DELETES = 16
+# How many files add_files uploads at the same time, and how often it checks
+# whether they are processed.
+MAX_CONCURRENT_UPLOADS = 8
+FILE_PROCESSING_POLL_SECONDS = 1.0
+
+
+# The names of the files seen so far, by id. Files are immutable, so this
+# only ever grows, and listing the files of an assistant does not need to walk
+# every file of the account each time.
+_file_names: Dict[str, str] = {}
+# How _run_thread polls a run: first after RUN_POLL_INITIAL_SECONDS, then
+# RUN_POLL_BACKOFF times later each time up to RUN_POLL_MAX_SECONDS, with
+# jitter so that concurrent conversations spread their requests out. The
+# openai version pinned here predates run streaming.
+RUN_POLL_INITIAL_SECONDS = 0.2
+RUN_POLL_MAX_SECONDS = 2.0
+RUN_POLL_BACKOFF = 1.5
+# After which a run still going is cancelled.
+RUN_DEADLINE_SECONDS = 300.0
+
+
 class OpenaiRag(BaseRag):
   _client: AsyncOpenAI = PrivateAttr()
   _assistant: Assistant = PrivateAttr()
   _thread: Thread = PrivateAttr()
   _after: str | NotGiven = PrivateAttr(NOT_GIVEN)
+  # Held while changing the files of the assistant, whose updates replace
+  # the whole list.
+  _files_lock: asyncio.Lock = PrivateAttr(default_factory=asyncio.Lock)
 
   def __init__(self, client: AsyncOpenAI, assistant: Assistant, thread: Thread) -> None:
     super().__init__()
@@ -54,34 +83,131 @@ class OpenaiRag(BaseRag):
     return cls(client, assistant, thread)
 
   async def list_files(self) -> Iterable[str]:
-    filenames: List[str] = []
-    async for file in self._client.files.list():
-      if file.id in self._assistant.file_ids:
-        filenames.append(file.filename)
-    return filenames
+    file_ids = self._assistant.file_ids
+    if any(file_id not in _file_names for file_id in file_ids):
+      async for file in self._client.files.list():
+        _file_names[file.id] = file.filename
+    return [_file_names[file_id]
+            for file_id in file_ids if file_id in _file_names]
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
   ) -> None:
-    new_file = await self._client.files.create(
-      file=(filename, content, content_type),
-      purpose='assistants'
-    )
-    new_file = await self._client.files.wait_for_processing(new_file.id)
+    [status] = await self.add_files(
+        [NewFile(filename=filename, content=content, content_type=content_type)])
+    if not status.ok:
+      raise RuntimeError(status.error)
 
-    self._assistant = await self._client.beta.assistants.update(
-      self._assistant.id,
-      file_ids=self._assistant.file_ids + [new_file.id]
-    )
+  async def add_files(self, files: Sequence[NewFile]) -> List[FileStatus]:
+    """Uploads and processes `files` concurrently.
+
+    The processed files are then attached to the assistant in one update,
+    rather than one per file.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+    async def upload(file: NewFile) -> Tuple[FileStatus, str | None]:
+      start = time.perf_counter()
+      try:
+        async with semaphore:
+          new_file = await self._client.files.create(
+            file=(file.filename, file.content, file.content_type),
+            purpose='assistants'
+          )
+        uploaded = time.perf_counter()
+        new_file = await self._client.files.wait_for_processing(
+            new_file.id,
+            poll_interval=FILE_PROCESSING_POLL_SECONDS)
+        if new_file.status != "processed":
+          raise RuntimeError(
+              f"File {new_file.id} is {new_file.status}: "
+              f"{new_file.status_details}")
+      except Exception as e:
+        _logger.warning(f"Failed to upload {file.filename}", exc_info=True)
+        return FileStatus(
+            filename=file.filename,
+            ok=False,
+            error=str(e),
+            seconds=time.perf_counter() - start), None
+      processed = time.perf_counter()
+      _file_names[new_file.id] = file.filename
+      _logger.info(
+          f"Uploaded {file.filename} in {uploaded - start:.1f}s, processed "
+          f"in {processed - uploaded:.1f}s")
+      return FileStatus(
+          filename=file.filename,
+          ok=True,
+          seconds=processed - start), new_file.id
+
+    results = await asyncio.gather(*[upload(file) for file in files])
+    new_file_ids = [file_id for _, file_id in results if file_id is not None]
+    if not new_file_ids:
+      return [status for status, _ in results]
+
+    start = time.perf_counter()
+    try:
+      async with self._files_lock:
+        self._assistant = await self._client.beta.assistants.update(
+          self._assistant.id,
+          file_ids=self._assistant.file_ids + new_file_ids
+        )
+    except Exception as e:
+      _logger.warning(
+          f"Failed to attach {len(new_file_ids)} files", exc_info=True)
+      return [
+          status if file_id is None else status.model_copy(
+              update={"ok": False, "error": str(e)})
+          for status, file_id in results
+      ]
+    seconds = time.perf_counter() - start
+    _logger.info(f"Attached {len(new_file_ids)} files in {seconds:.1f}s")
+    # Every file waited for the update.
+    return [
+        status if file_id is None else status.model_copy(
+            update={"seconds": status.seconds + seconds})
+        for status, file_id in results
+    ]
 
   async def clear_files(self) -> None:
-    for file_id in self._assistant.file_ids:
-      await self._client.files.delete(file_id)
+    start = time.perf_counter()
+    file_ids = self._assistant.file_ids
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DELETES)
+    deleted = 0
 
-    self._assistant = await self._client.beta.assistants.update(
-      self._assistant.id,
-      file_ids=[],
-    )
+    async def delete(file_id: str) -> None:
+      nonlocal deleted
+      async with semaphore:
+        try:
+          await self._client.files.delete(file_id)
+        except NotFoundError:
+          pass  # Deleted already.
+      deleted += 1
+      if deleted % 10 == 0:
+        _logger.info(f"Deleted {deleted}/{len(file_ids)} files")
+
+    results = await asyncio.gather(
+        *[delete(file_id) for file_id in file_ids], return_exceptions=True)
+    failed_ids = [
+        file_id
+        for file_id, result in zip(file_ids, results)
+        if isinstance(result, Exception)
+    ]
+    _logger.info(
+        f"Deleted {len(file_ids) - len(failed_ids)}/{len(file_ids)} files in "
+        f"{time.perf_counter() - start:.1f}s")
+
+    # Keep the files that could not be deleted, so a retry can find them.
+    async with self._files_lock:
+      self._assistant = await self._client.beta.assistants.update(
+        self._assistant.id,
+        file_ids=[
+            file_id for file_id in self._assistant.file_ids
+            if file_id not in file_ids or file_id in failed_ids
+        ],
+      )
+    for result in results:
+      if isinstance(result, Exception):
+        raise result
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
     await self._client.beta.threads.messages.create(
@@ -92,28 +218,44 @@ class OpenaiRag(BaseRag):
     await self._run_thread()
     return await self._get_new_messages()
 
-  async def clear_conversation(self) -> None:
+  async def start_conversation(self) -> None:
     # Don't actually delete the thread for future reference.
     self._thread = await self._client.beta.threads.create()
+    self._after = NOT_GIVEN
 
   async def _run_thread(self) -> None:
+    start = time.perf_counter()
     run = await self._client.beta.threads.runs.create(
         thread_id=self._thread.id,
         assistant_id=self._assistant.id)
+    delay = RUN_POLL_INITIAL_SECONDS
+    polls = 0
     while True:
       # _logger.info(pretty(run))
       match run.status:
         case "queued" | "in_progress":
-          await asyncio.sleep(1) 
+          elapsed = time.perf_counter() - start
+          if elapsed > RUN_DEADLINE_SECONDS:
+            await self._client.beta.threads.runs.cancel(
+                run.id,
+                thread_id=self._thread.id)
+            raise TimeoutError(
+                f"Run {run.id} still {run.status} after {elapsed:.1f}s")
+          await asyncio.sleep(random.uniform(delay / 2, delay))
+          delay = min(delay * RUN_POLL_BACKOFF, RUN_POLL_MAX_SECONDS)
         case "failed" | "expired":
           raise RuntimeError(run.last_error)
         case "completed":
+          _logger.info(
+              f"Run {run.id} completed in "
+              f"{time.perf_counter() - start:.1f}s after {polls} polls")
           return
         case "requires_action" | "cancelling" | "cancelled" | _:
           raise NotImplementedError(f"Run state {run.status} not supported")
       run = await self._client.beta.threads.runs.retrieve(
           run.id,
           thread_id=self._thread.id)
+      polls += 1
 
   async def _get_new_messages(self) -> Iterable[AttributedAnswer]:
     attributed_answers: List[AttributedAnswer] = []
@@ -1,25 +1,30 @@
 import asyncio
 from llama_index import VectorStoreIndex
-import llama_index.vector_stores.google.generativeai.genai_extension as genaix
 from llama_index.vector_stores.google.generativeai.base import NoSuchCorpusException
-from llama_index.vector_stores.google.generativeai import (
-    GoogleVectorStore,
-    google_service_context,
-)
+from llama_index.vector_stores.google.generativeai import google_service_context
 from llama_index.indices.query.base import BaseQueryEngine
 from llama_index.indices.service_context import ServiceContext
 from llama_index.response.schema import Response
 import logging
 from openai._types import FileContent
-from pydantic import BaseModel, PrivateAttr
+from pydantic import PrivateAttr
 from tempfile import SpooledTemporaryFile
-from typing import Iterable, List, Literal
+from typing import Iterable
 from ..base_rag import (
     AttributedAnswer,
     BaseRag,
+    FILE_PAGE_SIZE,
+    FilePage,
     build_palm_2,
 )
 from ..chunkers import chunk_unstructured
+from ..conversation import ConversationHistory
+from .. import ingest
+from ..local_store import (
+    AnyVectorStore,
+    create_vector_store,
+    open_vector_store,
+)
 
 
 _logger = logging.getLogger(__name__)
@@ -30,21 +35,17 @@ _logger.addHandler(logging.StreamHandler())
 DEFAULT_CORPUS_ID = "ltsang-unstructured"
 
 
-class ConversationMessage(BaseModel):
-  role: Literal["assistant", "user"]
-  message: AttributedAnswer
-
-
 class PalmRag(BaseRag):
-  _store: GoogleVectorStore = PrivateAttr()
+  _store: AnyVectorStore = PrivateAttr()
   _query_engine: BaseQueryEngine = PrivateAttr()
 
-  conversation: List[ConversationMessage] = []
+  _conversation: ConversationHistory = PrivateAttr(
+      default_factory=ConversationHistory)
 
   def __init__(
       self,
       *,
-      store: GoogleVectorStore,
+      store: AnyVectorStore,
    ) -> None:
     super().__init__()
 
@@ -78,7 +79,7 @@ class PalmRag(BaseRag):
   @classmethod
   def _create(cls, *, corpus_id: str, display_name: str) -> "PalmRag":
     return cls(
-        store=GoogleVectorStore.create_corpus(
+        store=create_vector_store(
             corpus_id=corpus_id, display_name=display_name))
 
   @classmethod
@@ -87,15 +88,20 @@ class PalmRag(BaseRag):
 
   @classmethod
   def _get(cls, *, corpus_id: str) -> "PalmRag":
-    return cls(store=GoogleVectorStore.from_corpus(corpus_id=corpus_id))
+    return cls(store=open_vector_store(corpus_id=corpus_id))
 
   async def list_files(self) -> Iterable[str]:
     return await asyncio.to_thread(lambda: self._list_files())
 
   def _list_files(self) -> Iterable[str]:
-    return [
-      document.display_name or "?"
-      for document in genaix.list_documents(corpus_id=self._store.corpus_id)]
+    return ingest.list_files(ingest.get_corpus(self._store)).filenames
+
+  async def list_file_page(
+      self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+  ) -> FilePage:
+    return await asyncio.to_thread(
+        lambda: ingest.list_files(
+            ingest.get_corpus(self._store), cursor=cursor, limit=limit))
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
@@ -108,17 +114,17 @@ class PalmRag(BaseRag):
       self, *, filename: str, content: FileContent, content_type: str
   ) -> None:
     assert isinstance(content, SpooledTemporaryFile)
-    self._store.add(
-        list(chunk_unstructured(filename, content, content_type)))
+    ingest.add_file(
+        corpus=ingest.get_corpus(self._store),
+        filename=filename,
+        content=content,
+        chunk=lambda: chunk_unstructured(filename, content, content_type))
 
   async def clear_files(self) -> None:
-    return await asyncio.to_thread(lambda: self._clear_files())
+    await ingest.aclear_corpus(ingest.get_corpus(self._store))
 
-  def _clear_files(self) -> None:
-    for document in genaix.list_documents(corpus_id=self._store.corpus_id):
-      genaix.delete_document(
-          corpus_id=self._store.corpus_id,
-          document_id=document.document_id)
+  def corpus_version(self) -> int | None:
+    return ingest.corpus_version(self._store.corpus_id)
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
     return await asyncio.to_thread(lambda: self._add_conversation(message))
@@ -134,23 +140,26 @@ class PalmRag(BaseRag):
         score=_get_answerable_probability(response),
     )
 
-    self.conversation.extend([
-      ConversationMessage(
-        role="user",
-        message=AttributedAnswer(
-          answer=message,
-        )
-      ),
-      ConversationMessage(
-        role="assistant",
-        message=assistant_message,
-      ),
-    ])
+    self._conversation.append(
+        message,
+        assistant_message,
+        citation_ids=[node.node_id
+                      for node in response.source_nodes if node.score is None],
+    )
 
     return [assistant_message]
 
-  async def clear_conversation(self) -> None:
-    self.conversation = []
+  def record_turn(
+      self, message: str, answers: Iterable[AttributedAnswer]
+  ) -> None:
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory()
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
 
 
 def _get_answerable_probability(response: Response) -> float | None:
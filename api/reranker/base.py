@@ -4,28 +4,45 @@ from llama_index import ServiceContext, VectorStoreIndex
 from llama_index.core import BaseRetriever
 from llama_index.llms.base import LLM
 from llama_index.postprocessor import LLMRerank
+from llama_index.postprocessor.types import BaseNodePostprocessor
 from llama_index.response.schema import Response
 from llama_index.response_synthesizers.google.generativeai import (
     GoogleTextSynthesizer,
 )
-from llama_index.retrievers import VectorIndexRetriever
-from llama_index.schema import QueryBundle
-import llama_index.vector_stores.google.generativeai.genai_extension as genaix
-from llama_index.vector_stores.google.generativeai import (
-    GoogleVectorStore,
-    google_service_context,
-)
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.google.generativeai import google_service_context
 from openai._types import FileContent
-from pydantic import BaseModel, PrivateAttr
+from pydantic import PrivateAttr
 from tempfile import SpooledTemporaryFile
-from typing import Iterable, List, Literal
+from typing import AsyncIterator, Iterable, List
+from ..async_query import (
+    apostprocess,
+    aretrieve,
+    astream_answer,
+    asynthesize,
+    RerankMerge,
+)
 from ..base_rag import (
     AttributedAnswer,
     BaseRag,
+    ConversationEvent,
+    FILE_PAGE_SIZE,
+    FilePage,
     build_response_synthesizer,
     PASSAGE_COUNT,
+    with_completion_cache,
 )
+from ..bm25 import BM25Rerank
 from ..chunkers import chunk_unstructured
+from ..conversation import ConversationHistory
+from .. import ingest
+from ..local_store import (
+    AnyVectorStore,
+    build_retriever,
+    create_vector_store,
+    open_vector_store,
+)
+from ..retrieval_cache import CachedRetriever
 
 
 _logger = logging.getLogger(__name__)
@@ -35,47 +52,61 @@ _logger.addHandler(logging.StreamHandler())
 
 DEFAULT_CORPUS_ID = "ltsang-unstructured"
 OVER_RETRIEVE_FACTOR = 5
+# Fuses BM25 over a local inverted index into retrieval, which finds exact
+# tokens such as product codes that embeddings miss. The candidates are better
+# then, so fewer need to be reranked. Corpora without a local index yet keep
+# OVER_RETRIEVE_FACTOR.
+HYBRID_RETRIEVAL = True
+HYBRID_OVER_RETRIEVE_FACTOR = 3
 CHOICE_BATCH_SIZE = PASSAGE_COUNT * OVER_RETRIEVE_FACTOR
-
-
-class ConversationMessage(BaseModel):
-  role: Literal["assistant", "user"]
-  message: AttributedAnswer
+# The async path scores smaller batches concurrently instead, so reranking
+# latency stays flat as OVER_RETRIEVE_FACTOR grows.
+RERANK_BATCH_SIZE = 5
+RERANK_CONCURRENCY = 4
+RERANK_MERGE: RerankMerge = "score"
+# BM25 pre-filters the candidates on the CPU so the LLM only ranks the best
+# LEXICAL_TOP_N of them. With LLM_RERANK off, BM25 picks the passages alone.
+LLM_RERANK = True
+LEXICAL_TOP_N = 2 * PASSAGE_COUNT
+LEXICAL_WEIGHT = 0.5
 
 
 class RerankerBaseRag(BaseRag):
-  _store: GoogleVectorStore = PrivateAttr()
+  _store: AnyVectorStore = PrivateAttr()
   _retriever: BaseRetriever = PrivateAttr()
-  _reranker: LLMRerank = PrivateAttr()
+  _rerankers: List[BaseNodePostprocessor] = PrivateAttr()
   _response_synthesizer: GoogleTextSynthesizer = PrivateAttr()
+  # Streams the answers of `stream_conversation`.
+  _llm: LLM = PrivateAttr()
 
-  conversation: List[ConversationMessage] = []
+  _conversation: ConversationHistory = PrivateAttr(
+      default_factory=ConversationHistory)
 
   def __init__(
       self,
       *,
-      store: GoogleVectorStore,
+      store: AnyVectorStore,
       llm: LLM) -> None:
     super().__init__()
 
     index = VectorStoreIndex.from_vector_store(
         vector_store=store,
         service_context=google_service_context)
-    retriever = VectorIndexRetriever(
-        index=index,
-        similarity_top_k=PASSAGE_COUNT * OVER_RETRIEVE_FACTOR,
-    )
-    reranker = LLMRerank(
-        top_n=PASSAGE_COUNT,
-        choice_batch_size=CHOICE_BATCH_SIZE,
-        service_context=ServiceContext.from_defaults(llm=llm),
-    )
+    retriever = CachedRetriever(
+        build_retriever(
+            index,
+            similarity_top_k=PASSAGE_COUNT * OVER_RETRIEVE_FACTOR,
+            hybrid_top_k=(PASSAGE_COUNT * HYBRID_OVER_RETRIEVE_FACTOR
+                          if HYBRID_RETRIEVAL else None)),
+        version=lambda: ingest.corpus_version(store.corpus_id))
+    rerankers = build_rerankers(llm)
     response_synthesizer = build_response_synthesizer()
 
     self._store = store
     self._retriever = retriever
-    self._reranker = reranker
+    self._rerankers = rerankers
     self._response_synthesizer = response_synthesizer
+    self._llm = llm
 
   @classmethod
   async def create(
@@ -91,7 +122,7 @@ class RerankerBaseRag(BaseRag):
       cls, *, corpus_id: str, display_name: str, llm: LLM
   ) -> BaseRag:
     return cls(
-      store=GoogleVectorStore.create_corpus(
+      store=create_vector_store(
           corpus_id=corpus_id,
           display_name=display_name),
       llm=llm)
@@ -104,18 +135,21 @@ class RerankerBaseRag(BaseRag):
   @classmethod
   def _get(cls, *, corpus_id: str, llm: LLM) -> BaseRag:
     return cls(
-        store=GoogleVectorStore.from_corpus(corpus_id=corpus_id),
+        store=open_vector_store(corpus_id=corpus_id),
         llm=llm)
 
   async def list_files(self) -> Iterable[str]:
     return await asyncio.to_thread(lambda: self._list_files())
 
   def _list_files(self) -> Iterable[str]:
-    return [
-        document.display_name or "?"
-        for document in genaix.list_documents(
-            corpus_id=self._store.corpus_id)
-    ]
+    return ingest.list_files(ingest.get_corpus(self._store)).filenames
+
+  async def list_file_page(
+      self, *, cursor: str | None = None, limit: int = FILE_PAGE_SIZE
+  ) -> FilePage:
+    return await asyncio.to_thread(
+        lambda: ingest.list_files(
+            ingest.get_corpus(self._store), cursor=cursor, limit=limit))
 
   async def add_file(
       self, *, filename: str, content: FileContent, content_type: str
@@ -130,57 +164,93 @@ class RerankerBaseRag(BaseRag):
       self, *, filename: str, content: FileContent, content_type: str
   ) -> None:
     assert isinstance(content, SpooledTemporaryFile)
-    self._store.add(list(chunk_unstructured(filename, content, content_type)))
+    ingest.add_file(
+        corpus=ingest.get_corpus(self._store),
+        filename=filename,
+        content=content,
+        chunk=lambda: chunk_unstructured(filename, content, content_type))
 
   async def clear_files(self) -> None:
-    return await asyncio.to_thread(lambda: self._clear_files())
+    await ingest.aclear_corpus(ingest.get_corpus(self._store))
 
-  def _clear_files(self) -> None:
-    for document in genaix.list_documents(corpus_id=self._store.corpus_id):
-      genaix.delete_document(
-          corpus_id=self._store.corpus_id, document_id=document.document_id
-      )
+  def corpus_version(self) -> int | None:
+    return ingest.corpus_version(self._store.corpus_id)
 
   async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
-    return await asyncio.to_thread(lambda: self._add_conversation(message))
+    return await self._aadd_conversation(message)
 
-  def _add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
+  async def _aadd_conversation(self, message: str) -> Iterable[AttributedAnswer]:
     query_bundle = QueryBundle(message)
-    retrieved_nodes = self._retriever.retrieve(query_bundle)
-    reranked_nodes = self._reranker.postprocess_nodes(
-        retrieved_nodes, query_bundle
-    )
-    response = self._response_synthesizer.synthesize(
+    reranked_nodes = await self._aretrieve(query_bundle)
+    response = await asynthesize(
+        self._response_synthesizer, query_bundle, reranked_nodes)
+    return self._record_conversation(message, response)
+
+  async def _astream_conversation(
+      self, message: str
+  ) -> AsyncIterator[ConversationEvent]:
+    query_bundle = QueryBundle(message)
+    reranked_nodes = await self._aretrieve(query_bundle)
+    async for event in astream_answer(
+        self._llm,
         query_bundle,
         reranked_nodes,
-    )
-    assert isinstance(response, Response)
+        lambda response: self._record_conversation(message, response)):
+      yield event
+
+  async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+    retrieved_nodes = await aretrieve(self._retriever, query_bundle)
+    return await apostprocess(
+        self._rerankers,
+        retrieved_nodes,
+        query_bundle,
+        batch_size=RERANK_BATCH_SIZE,
+        max_concurrency=RERANK_CONCURRENCY,
+        merge=RERANK_MERGE)
 
+  def _record_conversation(
+      self, message: str, response: Response
+  ) -> Iterable[AttributedAnswer]:
     assistant_message = AttributedAnswer(
         answer=response.response or '',
         citations=[node.text
                    for node in response.source_nodes if node.score is None],
         score=_get_answerable_probability(response),
     )
-    self.conversation.extend(
-        [
-            ConversationMessage(
-                role="user",
-                message=AttributedAnswer(
-                    answer=message,
-                ),
-            ),
-            ConversationMessage(
-                role="assistant",
-                message=assistant_message,
-            ),
-        ]
+    self._conversation.append(
+        message,
+        assistant_message,
+        citation_ids=[node.node_id
+                      for node in response.source_nodes if node.score is None],
     )
 
     return [assistant_message]
 
-  async def clear_conversation(self) -> None:
-    self.conversation = []
+  def record_turn(
+      self, message: str, answers: Iterable[AttributedAnswer]
+  ) -> None:
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory()
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
+
+
+def build_rerankers(llm: LLM) -> List[BaseNodePostprocessor]:
+  if not LLM_RERANK:
+    return [BM25Rerank(top_n=PASSAGE_COUNT, lexical_weight=LEXICAL_WEIGHT)]
+  return [
+      BM25Rerank(top_n=LEXICAL_TOP_N, lexical_weight=LEXICAL_WEIGHT),
+      LLMRerank(
+          top_n=PASSAGE_COUNT,
+          choice_batch_size=CHOICE_BATCH_SIZE,
+          service_context=ServiceContext.from_defaults(
+              llm=with_completion_cache(llm)),
+      ),
+  ]
 
 
 def _get_answerable_probability(response: Response) -> float | None:
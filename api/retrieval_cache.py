@@ -0,0 +1,82 @@
+"""Caches retrieved nodes by query.
+
+Multi-step stacks often retrieve for the same sub-question more than once, and
+users repeat questions across requests. `CachedRetriever` answers those from
+an LRU cache, which it drops whenever the corpus version changes.
+"""
+from collections import OrderedDict
+from llama_index.core import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+# Queries whose nodes are kept per retriever.
+RETRIEVAL_CACHE_SIZE = 1024
+
+_Key = Tuple[str, Tuple[str, ...]]
+
+
+class CachedRetriever(BaseRetriever):
+  """Wraps `retriever` with an LRU cache valid for one corpus version."""
+
+  def __init__(
+      self,
+      retriever: BaseRetriever,
+      *,
+      version: Callable[[], int],
+      max_size: int = RETRIEVAL_CACHE_SIZE,
+  ) -> None:
+    super().__init__(callback_manager=None)
+    self._retriever = retriever
+    self._version = version
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    self._entries: OrderedDict[_Key, List[NodeWithScore]] = OrderedDict()
+    self._entries_version: int | None = None
+    self.hits = 0
+    self.misses = 0
+
+  def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+    if query_bundle.embedding is not None:
+      # A precomputed embedding is not part of the key.
+      return self._retriever.retrieve(query_bundle)
+
+    key = (
+        " ".join(query_bundle.query_str.split()),
+        tuple(query_bundle.custom_embedding_strs or ()),
+    )
+    version = self._version()
+    with self._lock:
+      if self._entries_version != version:
+        self._entries.clear()
+        self._entries_version = version
+      nodes = self._entries.get(key)
+      if nodes is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+      else:
+        self.misses += 1
+    if nodes is not None:
+      _logger.info(f"Reusing the nodes retrieved for {key[0]!r}")
+      return _copy(nodes)
+
+    nodes = self._retriever.retrieve(query_bundle)
+    with self._lock:
+      # Unless the corpus changed while retrieving.
+      if self._entries_version == version:
+        self._entries[key] = _copy(nodes)
+        while len(self._entries) > self._max_size:
+          self._entries.popitem(last=False)
+    return nodes
+
+
+def _copy(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+  # Postprocessors may rescore the nodes they are given.
+  return [NodeWithScore(node=node.node, score=node.score) for node in nodes]
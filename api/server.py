@@ -1,11 +1,33 @@
-from fastapi import FastAPI, Request, UploadFile
+import asyncio
+from fastapi import FastAPI, Query, Request, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import logging
 from pydantic import BaseModel
-from typing import Any, cast, List, Literal, Type
-from .base_rag import AttributedAnswer, BaseRag
+import secrets
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    cast,
+    List,
+    Literal,
+    Type,
+)
+from .answer_cache import AnswerCache, AnswerCacheStats
+from .base_rag import (
+    AttributedAnswer,
+    BaseRag,
+    ConversationEvent,
+    FILE_PAGE_SIZE,
+    FilePage,
+    FileStatus,
+    MAX_FILE_PAGE_SIZE,
+    NewFile,
+)
 from .naive import GoogleRag, OpenaiRag, PalmRag
 from .hyde import (
     HydeGpt4Rag,
@@ -28,6 +50,7 @@ from .everything import (
     EverythingGeminiProRag,
     EverythingGeminiUltraRag,
 )
+from .sessions import SessionPool
 
 
 app = FastAPI()
@@ -45,6 +68,28 @@ app.add_middleware(
 )
 
 
+# Where clients pass their session id. Clients that pass neither get a cookie.
+SESSION_HEADER = "X-Session-Id"
+SESSION_COOKIE = "rag-session"
+
+
+@app.middleware("http")
+async def assign_session(
+    request: Request, call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+  session_id = (request.headers.get(SESSION_HEADER)
+                or request.cookies.get(SESSION_COOKIE))
+  is_new = session_id is None
+  if session_id is None:
+    session_id = secrets.token_urlsafe(16)
+  request.state.session_id = session_id
+  response = await call_next(request)
+  if is_new:
+    response.set_cookie(
+        SESSION_COOKIE, session_id, httponly=True, samesite="lax")
+  return response
+
+
 @app.exception_handler(Exception)
 async def exception_handler(request: Request, exc: Any) -> JSONResponse:
     if hasattr(exc, "message"):
@@ -101,9 +146,18 @@ stack_types: dict[StackId, Type[BaseRag]] = {
   "everything-gemini-pro": EverythingGeminiProRag,
   "everything-gemini-ultra": EverythingGeminiUltraRag,
 }
+# The loaded stacks, shared by every session. Files are added to and listed
+# from these, while conversations go to the copies in `sessions`.
 stacks: dict[StackId, BaseRag | None] = {
   stack: None for stack in stack_types.keys()
 }
+stack_locks: dict[StackId, asyncio.Lock] = {
+  stack: asyncio.Lock() for stack in stack_types.keys()
+}
+sessions = SessionPool()
+answer_caches: dict[StackId, AnswerCache] = {
+  stack: AnswerCache() for stack in stack_types.keys()
+}
 
 
 def get_stack(stack: str) -> BaseRag:
@@ -117,31 +171,68 @@ def set_stack(stack: str, instance: BaseRag) -> None:
   stacks[cast(StackId, stack)] = instance
 
 
+async def get_session_stack(request: Request, stack: str) -> BaseRag:
+  return await sessions.get(
+      request.state.session_id, stack, get_stack(stack))
+
+
 @app.post('/api/{stack}/new')
-async def new_stack(stack: str) -> None:
+async def new_stack(stack: str, request: Request) -> None:
+  """Starts a new conversation with `stack` for this session.
+
+  The stack itself is only loaded once, and shared by every session.
+  """
   s = cast(StackId, stack)
   t = stack_types[s]
   if t is None:
     raise RuntimeError(f"Stack type {stack} is unknown")
 
-  # We just reuse an existing one.
-  stacks[s] = await t.get_default()
+  async with stack_locks[s]:
+    if stacks[s] is None:
+      # We just reuse an existing one.
+      stacks[s] = await t.get_default()
+  sessions.discard(request.state.session_id, s)
 
 
 @app.get('/api/{stack}/list-files')
-async def list_file(stack: str) -> List[str]:
-  return list(await get_stack(stack).list_files())
+async def list_file(
+    stack: str,
+    cursor: str | None = None,
+    limit: int = Query(FILE_PAGE_SIZE, ge=1, le=MAX_FILE_PAGE_SIZE),
+) -> FilePage:
+  """A page of the file names of `stack`, in order.
+
+  Pass the `next_cursor` of a page as `cursor` to get the next one.
+  """
+  return await get_stack(stack).list_file_page(cursor=cursor, limit=limit)
 
 
 @app.post('/api/{stack}/add-files')
-async def add_file(stack: str, files: List[UploadFile]) -> None:
+async def add_file(stack: str, files: List[UploadFile]) -> List[FileStatus]:
+  """Ingests `files` concurrently.
+
+  A file that fails does not fail the others; check the status of each.
+  """
+  s = get_stack(stack)
+  new_files = []
   for file in files:
     assert file.filename is not None
     assert file.content_type is not None
-    await get_stack(stack).add_file(
+    new_files.append(NewFile(
         filename=file.filename,
         content=file.file,
-        content_type=file.content_type)
+        content_type=file.content_type))
+
+  start = time.perf_counter()
+  statuses = await s.add_files(new_files)
+  seconds = time.perf_counter() - start
+  added = [file for file, status in zip(files, statuses) if status.ok]
+  megabytes = sum(file.size or 0 for file in added) / 1e6
+  logger.info(
+      f"Added {len(added)}/{len(files)} files ({megabytes:.1f} MB) to "
+      f"{stack} in {seconds:.1f}s: {len(added) / seconds:.2f} files/s, "
+      f"{megabytes / seconds:.2f} MB/s")
+  return statuses
 
 
 @app.post('/api/{stack}/clear-files')
@@ -150,13 +241,74 @@ async def clear_files(stack: str) -> None:
 
 
 @app.post('/api/{stack}/add-conversation')
-async def add_conversation(stack: str, message: UserMessage) -> List[AttributedAnswer]:
-  return list(await get_stack(stack).add_conversation(message.text))
+async def add_conversation(
+    stack: str, message: UserMessage, request: Request
+) -> List[AttributedAnswer]:
+  s = await get_session_stack(request, stack)
+  cache = answer_caches[cast(StackId, stack)]
+  version = s.corpus_version()
+  if version is not None:
+    cached = cache.get(message.text, version)
+    if cached is not None:
+      s.record_turn(message.text, cached)
+      return cached
+
+  answers = list(await s.add_conversation(message.text))
+  if version is not None:
+    cache.put(message.text, version, answers)
+  return answers
+
+
+@app.post('/api/{stack}/add-conversation-stream')
+async def add_conversation_stream(
+    stack: str, message: UserMessage, request: Request) -> StreamingResponse:
+  """Same as add-conversation, but as Server-Sent Events.
+
+  See `ConversationEvent` for the events. The trailing `answer` events carry
+  the citations and score, or an `error` event ends a failed turn.
+  """
+  s = await get_session_stack(request, stack)
+  cache = answer_caches[cast(StackId, stack)]
+  version = s.corpus_version()
+
+  async def conversation_events() -> AsyncIterator[ConversationEvent]:
+    if version is None:
+      async for event in s.stream_conversation(message.text):
+        yield event
+      return
+
+    cached = cache.get(message.text, version)
+    if cached is not None:
+      s.record_turn(message.text, cached)
+      for answer in cached:
+        yield ConversationEvent(event="delta", text=answer.answer)
+        yield ConversationEvent(event="answer", answer=answer)
+      return
+
+    answers = []
+    async for event in s.stream_conversation(message.text):
+      if event.event == "answer" and event.answer is not None:
+        answers.append(event.answer)
+      yield event
+      if event.event == "error":
+        return
+    cache.put(message.text, version, answers)
+
+  async def events() -> AsyncIterator[str]:
+    async for event in conversation_events():
+      yield f"event: {event.event}\ndata: {event.model_dump_json()}\n\n"
+
+  return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get('/api/{stack}/answer-cache-stats')
+async def answer_cache_stats(stack: str) -> AnswerCacheStats:
+  return answer_caches[cast(StackId, stack)].stats()
 
 
 @app.post('/api/{stack}/clear-conversation')
-async def clear_conversation(stack: str) -> None:
-  await get_stack(stack).clear_conversation()
+async def clear_conversation(stack: str, request: Request) -> None:
+  await (await get_session_stack(request, stack)).clear_conversation()
 
 
 app.mount("/", StaticFiles(directory="dist", html=True), name="webapp")
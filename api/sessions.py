@@ -0,0 +1,88 @@
+"""Conversations per session.
+
+Every stack is loaded once and shared by all sessions for its files. Each
+session converses with its own `BaseRag.new_session` copy of it, which shares
+the store, index, LLMs and synthesizer, and only has its own conversation.
+Sessions idle for `SESSION_IDLE_SECONDS`, and the least recently used ones
+beyond `MAX_SESSIONS`, are dropped and their conversations closed.
+"""
+from collections import OrderedDict
+import logging
+import time
+from typing import Tuple
+from .base_rag import BaseRag
+
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+_logger.addHandler(logging.StreamHandler())
+
+
+SESSION_IDLE_SECONDS = 30 * 60
+# Stack instances kept across all sessions.
+MAX_SESSIONS = 10_000
+
+_Key = Tuple[str, str]
+
+
+class _Session:
+  __slots__ = ("stack", "used")
+
+  def __init__(self, stack: BaseRag) -> None:
+    self.stack = stack
+    self.used = time.monotonic()
+
+
+class SessionPool:
+  """The stack instances of every session, least recently used first."""
+
+  def __init__(
+      self,
+      *,
+      idle_seconds: float = SESSION_IDLE_SECONDS,
+      max_sessions: int = MAX_SESSIONS,
+  ) -> None:
+    self._idle_seconds = idle_seconds
+    self._max_sessions = max_sessions
+    self._sessions: OrderedDict[_Key, _Session] = OrderedDict()
+
+  def __len__(self) -> int:
+    return len(self._sessions)
+
+  async def get(
+      self, session_id: str, stack_id: str, shared: BaseRag
+  ) -> BaseRag:
+    """The instance of `stack_id` for `session_id`, copied from `shared`."""
+    key = (session_id, stack_id)
+    self._evict_idle()
+    session = self._sessions.get(key)
+    if session is None:
+      stack = await shared.new_session()
+      # Another request of the session may have created one meanwhile.
+      session = self._sessions.setdefault(key, _Session(stack))
+      while len(self._sessions) > self._max_sessions:
+        _, dropped = self._sessions.popitem(last=False)
+        dropped.stack.close_conversation()
+    session.used = time.monotonic()
+    self._sessions.move_to_end(key)
+    return session.stack
+
+  def discard(self, session_id: str, stack_id: str) -> None:
+    """Has the next `get` start a new conversation."""
+    session = self._sessions.pop((session_id, stack_id), None)
+    if session is not None:
+      session.stack.close_conversation()
+
+  def _evict_idle(self) -> None:
+    deadline = time.monotonic() - self._idle_seconds
+    evicted = 0
+    while self._sessions:
+      key, session = next(iter(self._sessions.items()))
+      if session.used > deadline:
+        break
+      del self._sessions[key]
+      session.stack.close_conversation()
+      evicted += 1
+    if evicted:
+      _logger.info(
+          f"Dropped {evicted} idle sessions, {len(self._sessions)} left")
@@ -5,6 +5,7 @@ from tempfile import SpooledTemporaryFile
 from ..naive import GoogleRag
 from ..base_rag import BaseRag
 from ..chunkers import chunk_markdown
+from .. import ingest
 
 
 _logger = logging.getLogger(__name__)
@@ -36,4 +37,8 @@ class WindowGoogleRag(GoogleRag):
       return
 
     assert isinstance(content, SpooledTemporaryFile)
-    self._client.insert_nodes(list(chunk_markdown(filename, content)))
+    ingest.add_file(
+        corpus=ingest.GoogleCorpus(self._client.corpus_id),
+        filename=filename,
+        content=content,
+        chunk=lambda: chunk_markdown(filename, content))
@@ -0,0 +1,97 @@
+"""Reports recall and latency of ANNRetriever against exact search.
+
+Run with `python -m scripts.benchmark_ann [chunks]`. The corpus is synthetic:
+every chunk draws most of its words from one of 200 narrow topics, so that
+it clusters roughly like real documents do.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Iterable, List
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ["RAG_LOCAL_STORE_DIR"] = _tmp_dir.name
+
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.vector_stores.types import (
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from api.local_store import LocalVectorStore
+
+
+VOCABULARY = [f"w{i}" for i in range(20_000)]
+TOPICS = 200
+WORDS_PER_TOPIC = 40
+QUERIES = 100
+TOP_K = 25
+NPROBES = [1, 4, 16, 64]
+
+
+def make_topics(rng: random.Random) -> List[List[str]]:
+  return [rng.sample(VOCABULARY, WORDS_PER_TOPIC) for _ in range(TOPICS)]
+
+
+def make_text(rng: random.Random, topics: List[List[str]], length: int) -> str:
+  topic = rng.choice(topics)
+  return " ".join(
+      rng.choice(topic) if rng.random() < 0.9 else rng.choice(VOCABULARY)
+      for _ in range(length))
+
+
+def make_chunks(
+    count: int, rng: random.Random, topics: List[List[str]]
+) -> Iterable[TextNode]:
+  for i in range(count):
+    yield TextNode(
+        id_=f"chunk-{i}",
+        text=make_text(rng, topics, rng.randint(20, 80)),
+        relationships={
+            NodeRelationship.SOURCE: RelatedNodeInfo(node_id="handbook"),
+        },
+    )
+
+
+def measure(
+    queries: List[str],
+    search: Callable[[VectorStoreQuery], VectorStoreQueryResult],
+) -> tuple[List[List[str]], float]:
+  results = []
+  latencies = []
+  for query in queries:
+    start = time.perf_counter()
+    result = search(VectorStoreQuery(query_str=query, similarity_top_k=TOP_K))
+    latencies.append(time.perf_counter() - start)
+    results.append(result.ids or [])
+  return results, statistics.median(latencies)
+
+
+def main() -> None:
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+  rng = random.Random(0)
+  topics = make_topics(rng)
+  store = LocalVectorStore(corpus_id="benchmark")
+  store.create_document("handbook", "handbook.md")
+  start = time.perf_counter()
+  store.create_chunks("handbook", make_chunks(count, rng, topics))
+  print(f"Ingested and indexed {count} chunks in "
+        f"{time.perf_counter() - start:.1f}s")
+
+  queries = [make_text(rng, topics, 8) for _ in range(QUERIES)]
+  expected, exact_seconds = measure(queries, store.query)
+  print(f"exact       recall 1.000  p50 {exact_seconds * 1000:7.1f}ms")
+  for nprobe in NPROBES:
+    found, seconds = measure(
+        queries, lambda query: store.approximate_query(query, nprobe=nprobe))
+    recall = statistics.mean(
+        len(set(ids) & set(truth)) / max(len(truth), 1)
+        for ids, truth in zip(found, expected))
+    print(f"nprobe {nprobe:>3}  recall {recall:.3f}  "
+          f"p50 {seconds * 1000:7.1f}ms")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,67 @@
+"""Measures query latency of LocalVectorStore as the corpus grows to 1M chunks.
+
+Run with `python -m scripts.benchmark_local_store`. The store is built in a
+temporary directory, which takes about 2 GB of disk at the largest size.
+"""
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Iterable, List
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ["RAG_LOCAL_STORE_DIR"] = _tmp_dir.name
+
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.vector_stores.types import VectorStoreQuery
+from api.local_store import LocalVectorStore
+
+
+WORDS = ["policy", "travel", "expense", "review", "team", "approval",
+         "manager", "budget", "onboarding", "security", "laptop", "leave",
+         "holiday", "badge", "payroll", "benefits", "contract", "office"]
+QUERIES = 50
+TOP_K = 25
+
+
+def make_chunks(start: int, stop: int, rng: random.Random) -> Iterable[TextNode]:
+  for i in range(start, stop):
+    yield TextNode(
+        id_=f"chunk-{i}",
+        text=" ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))),
+        relationships={
+            NodeRelationship.SOURCE: RelatedNodeInfo(node_id="handbook"),
+        },
+    )
+
+
+def percentile(values: List[float], fraction: float) -> float:
+  return sorted(values)[int(fraction * (len(values) - 1))]
+
+
+def main() -> None:
+  rng = random.Random(0)
+  store = LocalVectorStore(corpus_id="benchmark")
+  store.create_document("handbook", "handbook.md")
+  size = 0
+  for target in [10_000, 100_000, 1_000_000]:
+    start = time.perf_counter()
+    store.create_chunks("handbook", make_chunks(size, target, rng))
+    ingest_seconds = time.perf_counter() - start
+    size = target
+
+    latencies = []
+    for _ in range(QUERIES):
+      query = " ".join(rng.choice(WORDS) for _ in range(5))
+      start = time.perf_counter()
+      store.query(VectorStoreQuery(query_str=query, similarity_top_k=TOP_K))
+      latencies.append(time.perf_counter() - start)
+    print(
+        f"{size:>9} chunks: ingest {ingest_seconds:6.1f}s, query "
+        f"p50 {statistics.median(latencies) * 1000:7.1f}ms "
+        f"p95 {percentile(latencies, 0.95) * 1000:7.1f}ms")
+
+
+if __name__ == "__main__":
+  main()
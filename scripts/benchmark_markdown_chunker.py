@@ -0,0 +1,157 @@
+"""Compares chunk_markdown against its previous quadratic implementation.
+
+Run with `python -m scripts.benchmark_markdown_chunker`. It fails if the two
+implementations disagree on any chunk or chunk id.
+"""
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+import random
+import time
+from typing import Callable, Iterable, List, Tuple, TypeAlias
+from api.chunkers import chunk_markdown
+from api.chunkers.base import MAX_CHUNK_SIZE, chunk_id, document_id
+
+
+# The previous api/chunkers/markdown_chunker.py, verbatim but for the name
+# of its entry point and the content-addressed ids the current one assigns,
+# so both do the same work.
+Section: TypeAlias = List[str]
+Stack: TypeAlias = List[Section]
+
+
+def reference_chunk_markdown(
+    filename: str, content: Iterable[bytes]
+) -> Iterable[TextNode]:
+  doc_id = document_id(filename)
+  stack: Stack = []
+  for raw_line in content:
+    line = raw_line.decode('utf-8').strip()
+    if line.startswith("#"):
+      if len(stack) > 0:
+        yield from stack_to_text_node(stack, filename=filename, doc_id=doc_id)
+      add_to_stack(stack, line)
+    else:
+      add_to_last_section(stack, line)
+  if len(stack) > 0:
+    yield from stack_to_text_node(stack, filename=filename, doc_id=doc_id)
+
+
+def stack_to_text_node(
+    stack: Stack, *, filename: str, doc_id: str
+) -> Iterable[TextNode]:
+  context_sections = stack[:-1]
+  last_section = stack[-1]
+
+  context = "\n".join(
+      ["\n".join(section)[:MAX_CHUNK_SIZE] for section in context_sections]
+  )
+  for chunk in chunk_section(last_section):
+    text = "\n".join([context, chunk])
+    yield TextNode(
+        id_=chunk_id(text),
+        text=text,
+        relationships={
+            NodeRelationship.SOURCE: RelatedNodeInfo(
+                node_id=doc_id,
+                metadata={"file_name": filename},
+            )
+        },
+    )
+
+
+def chunk_section(section: Section) -> Iterable[str]:
+  text: List[str] = [section[0]]
+  text_len = sum([len(line) for line in text])
+  for line in section[1:]:
+    line_len = len(line)
+    if text_len + line_len < MAX_CHUNK_SIZE:
+      text.append(line)
+      text_len += line_len
+      continue
+    yield "\n".join(text)[:MAX_CHUNK_SIZE]
+    text = [section[0], line]
+    text_len = sum([len(line) for line in text])
+  if len(text) > 0:
+    yield "\n".join(text)[:MAX_CHUNK_SIZE]
+
+
+def add_to_stack(stack: Stack, line: str) -> None:
+  assert line.startswith("#")
+  line_depth = compute_header_depth(line)
+
+  while True:
+    if len(stack) == 0:
+      stack.append([line])
+      break
+
+    section = stack[-1]
+    header = section[0]
+
+    assert header.startswith("#")
+    header_depth = compute_header_depth(header)
+
+    if line_depth > header_depth:
+      stack.append([line])
+      return
+
+    del stack[-1]
+
+
+def compute_header_depth(header: str) -> int:
+  count = 0
+  for char in header:
+    if char == '#':
+        count += 1
+    else:
+        break
+  return count
+
+
+def add_to_last_section(stack: Stack, line: str) -> None:
+  # Ignore bare lines with no header.
+  if len(stack) == 0:
+    return
+
+  last_section = stack[-1]
+  last_section.append(line)
+
+
+def make_handbook(*, sections: int, seed: int = 0) -> List[bytes]:
+  rng = random.Random(seed)
+  words = ["policy", "travel", "expense", "review", "team", "approval",
+           "manager", "#tag", "budget", "2024", "onboarding", "security"]
+  lines = [b"Preamble before any header is dropped."]
+  for i in range(sections):
+    lines.append(f"{'#' * rng.randint(1, 6)} Section {i}\n".encode("utf-8"))
+    for _ in range(rng.randint(0, 60)):
+      length = rng.choice([5, 20, 80, 400, 3000])
+      lines.append(
+          (" ".join(rng.choice(words) for _ in range(length // 6)) + "\n")
+          .encode("utf-8"))
+  return lines
+
+
+def timed(
+    fn: Callable[[], List[Tuple[str, str]]]
+) -> Tuple[List[Tuple[str, str]], float]:
+  start = time.perf_counter()
+  result = fn()
+  return result, time.perf_counter() - start
+
+
+def main() -> None:
+  for sections in [100, 1_000, 5_000]:
+    content = make_handbook(sections=sections)
+    expected, reference_seconds = timed(
+        lambda: [(node.node_id, node.text) for node in reference_chunk_markdown(
+            "handbook.md", content)])
+    nodes, seconds = timed(
+        lambda: [(node.node_id, node.text)
+                 for node in chunk_markdown("handbook.md", content)])
+    assert nodes == expected, f"Output differs with {sections} sections."
+    print(
+        f"{sections:>6} sections {len(nodes):>7} chunks: "
+        f"reference {reference_seconds:.3f}s, current {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+  main()
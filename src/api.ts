@@ -6,6 +6,13 @@ export interface AttributedAnswer {
   score?: number;
 }
 
+export interface FileStatus {
+  filename: string;
+  ok: boolean;
+  error?: string;
+  seconds: number;
+}
+
 export type Stack =
   | 'openai'
   | 'google-aqa'
@@ -59,8 +66,20 @@ export async function get({stack}: {stack: Stack}): Promise<void> {
   }
 }
 
-export async function listFiles({stack}: {stack: Stack}): Promise<string[]> {
-  const response = await fetch(`${api}/${stack}/list-files`, {
+export interface FilePage {
+  filenames: string[];
+  next_cursor?: string | null;
+}
+
+export async function listFilePage({
+  stack,
+  cursor,
+}: {
+  stack: Stack;
+  cursor?: string;
+}): Promise<FilePage> {
+  const params = cursor ? `?${new URLSearchParams({cursor})}` : '';
+  const response = await fetch(`${api}/${stack}/list-files${params}`, {
     method: 'GET',
   });
   if (!response.ok) {
@@ -70,13 +89,24 @@ export async function listFiles({stack}: {stack: Stack}): Promise<string[]> {
   return await response.json();
 }
 
+export async function listFiles({stack}: {stack: Stack}): Promise<string[]> {
+  const filenames: string[] = [];
+  let cursor: string | undefined;
+  do {
+    const page = await listFilePage({stack, cursor});
+    filenames.push(...page.filenames);
+    cursor = page.next_cursor ?? undefined;
+  } while (cursor);
+  return filenames;
+}
+
 export async function addFiles({
   stack,
   files,
 }: {
   stack: Stack;
   files: FileList | File[];
-}): Promise<void> {
+}): Promise<FileStatus[]> {
   const formData = new FormData();
   for (let i = 0; i < files.length; i++) {
     const file = files[i];
@@ -91,6 +121,14 @@ export async function addFiles({
     const message = await response.json();
     throw new Error(message.message);
   }
+  const statuses: FileStatus[] = await response.json();
+  const failures = statuses.filter(status => !status.ok);
+  if (failures.length > 0) {
+    throw new Error(
+      failures.map(status => `${status.filename}: ${status.error}`).join('\n')
+    );
+  }
+  return statuses;
 }
 
 export async function clearFiles({stack}: {stack: Stack}): Promise<void> {
@@ -125,6 +163,60 @@ export async function addConversation({
   return answers;
 }
 
+export interface ConversationEvent {
+  event: 'step' | 'delta' | 'answer' | 'error';
+  text?: string | null;
+  answer?: AttributedAnswer | null;
+}
+
+/// Same as addConversation, but yields the events of the answer as they
+/// arrive: `delta` events with answer text, then `answer` events with the
+/// citations and score. An `error` event is thrown.
+export async function* streamConversation({
+  stack,
+  message,
+}: {
+  stack: Stack;
+  message: string;
+}): AsyncGenerator<ConversationEvent> {
+  const response = await fetch(`${api}/${stack}/add-conversation-stream`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({text: message}),
+  });
+  if (!response.ok || response.body === null) {
+    const message = await response.json();
+    throw new Error(message.message);
+  }
+  const reader = response.body
+    .pipeThrough(new TextDecoderStream())
+    .getReader();
+  let buffer = '';
+  for (;;) {
+    const {done, value} = await reader.read();
+    if (done) break;
+    buffer += value;
+    let end: number;
+    while ((end = buffer.indexOf('\n\n')) >= 0) {
+      const data = buffer
+        .slice(0, end)
+        .split('\n')
+        .filter(line => line.startsWith('data: '))
+        .map(line => line.slice('data: '.length))
+        .join('\n');
+      buffer = buffer.slice(end + 2);
+      if (data === '') continue;
+      const event: ConversationEvent = JSON.parse(data);
+      if (event.event === 'error') {
+        throw new Error(event.text ?? 'Cannot answer');
+      }
+      yield event;
+    }
+  }
+}
+
 export async function clearConversation({
   stack,
 }: {
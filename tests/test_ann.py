@@ -0,0 +1,118 @@
+import numpy as np
+import os
+import tempfile
+from typing import List
+import unittest
+from api.ann import RETRAIN_GROWTH, IVFIndex, Matrix
+
+
+def _unit(vectors: np.ndarray) -> Matrix:
+  return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(
+      np.float32)
+
+
+def _clustered(rows: int, *, seed: int, dims: int = 32) -> Matrix:
+  """Unit vectors around 50 topics, like embeddings of a corpus."""
+  rng = np.random.default_rng(seed)
+  topics = rng.standard_normal((50, dims))
+  return _unit(topics[rng.integers(50, size=rows)]
+               + 0.5 * rng.standard_normal((rows, dims)))
+
+
+def _brute_force(
+    vectors: Matrix, query: Matrix, alive: np.ndarray, top_k: int
+) -> List[int]:
+  scores = np.where(alive, vectors @ query, -np.inf)
+  return [int(row) for row in np.argsort(-scores, kind="stable")[:top_k]]
+
+
+class IVFIndexTest(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.vectors = _clustered(4000, seed=0)
+    self.queries = _clustered(50, seed=1)
+    self.alive = np.ones(len(self.vectors), dtype=bool)
+    self.index = IVFIndex.train(self.vectors)
+
+  def _recall(self, alive: np.ndarray, top_k: int = 10) -> float:
+    hits = 0
+    for query in self.queries:
+      rows, _ = self.index.search(self.vectors, query, alive, top_k)
+      hits += len(set(rows) & set(
+          _brute_force(self.vectors, query, alive, top_k)))
+    return hits / (top_k * len(self.queries))
+
+  def test_trains_about_sqrt_n_lists(self) -> None:
+    self.assertEqual(self.index.nlist, 63)
+    self.assertEqual(self.index.size, len(self.vectors))
+
+  def test_recall_against_brute_force(self) -> None:
+    self.assertGreaterEqual(self._recall(self.alive), 0.9)
+
+  def test_probing_every_list_is_exact(self) -> None:
+    for query in self.queries[:10]:
+      rows, scores = self.index.search(
+          self.vectors, query, self.alive, 10, nprobe=self.index.nlist)
+      self.assertEqual(rows, _brute_force(self.vectors, query, self.alive, 10))
+      np.testing.assert_allclose(
+          scores, self.vectors[rows] @ query, rtol=1e-5)
+      self.assertEqual(scores, sorted(scores, reverse=True))
+
+  def test_skips_deleted_rows(self) -> None:
+    alive = self.alive.copy()
+    alive[::2] = False
+    for query in self.queries[:10]:
+      rows, _ = self.index.search(self.vectors, query, alive, 10)
+      self.assertTrue(all(alive[row] for row in rows))
+    self.assertGreaterEqual(self._recall(alive), 0.9)
+
+  def test_skips_rows_past_snapshot(self) -> None:
+    rows, _ = self.index.search(
+        self.vectors, self.vectors[-1], self.alive[:100], 10, nprobe=63)
+    self.assertTrue(all(row < 100 for row in rows))
+
+  def test_added_rows_are_searched(self) -> None:
+    more = _clustered(1000, seed=2)
+    self.vectors = np.concatenate([self.vectors, more])
+    self.index.add(more)
+    alive = np.ones(len(self.vectors), dtype=bool)
+    self.assertEqual(self.index.size, 5000)
+    rows, _ = self.index.search(self.vectors, more[0], alive, 1)
+    self.assertEqual(rows, [4000])
+    self.assertGreaterEqual(self._recall(alive), 0.9)
+
+    self.index.truncate(4000)
+    self.vectors = self.vectors[:4000]
+    rows, _ = self.index.search(self.vectors, more[0], self.alive, 10)
+    self.assertTrue(all(row < 4000 for row in rows))
+
+  def test_empty_results(self) -> None:
+    dead = np.zeros(len(self.vectors), dtype=bool)
+    self.assertEqual(
+        self.index.search(self.vectors, self.queries[0], dead, 10), ([], []))
+    self.assertEqual(
+        self.index.search(self.vectors, self.queries[0], self.alive, 0),
+        ([], []))
+
+  def test_needs_retraining(self) -> None:
+    self.assertFalse(self.index.needs_retraining(RETRAIN_GROWTH * 4000))
+    self.assertTrue(self.index.needs_retraining(RETRAIN_GROWTH * 4000 + 1))
+
+  def test_save_and_load(self) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "index.npz")
+      self.assertIsNone(IVFIndex.load(path))
+      self.index.save(path)
+      loaded = IVFIndex.load(path)
+    assert loaded is not None
+    self.assertEqual(loaded.nlist, self.index.nlist)
+    self.assertEqual(loaded.size, self.index.size)
+    self.assertFalse(loaded.needs_retraining(RETRAIN_GROWTH * 4000))
+    for query in self.queries[:10]:
+      self.assertEqual(
+          loaded.search(self.vectors, query, self.alive, 10),
+          self.index.search(self.vectors, query, self.alive, 10))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,48 @@
+from typing import List
+import unittest
+from api.answer_cache import AnswerCache, normalize
+from api.base_rag import AttributedAnswer
+
+
+def _answers(text: str) -> List[AttributedAnswer]:
+  return [AttributedAnswer(answer=text)]
+
+
+class NormalizeTest(unittest.TestCase):
+
+  def test_ignores_case_and_whitespace(self) -> None:
+    self.assertEqual(
+        normalize("  What is\tthe Travel   policy?\n"),
+        normalize("what is the travel policy?"))
+
+  def test_keeps_punctuation(self) -> None:
+    self.assertNotEqual(normalize("error AB-12"), normalize("error AB 12"))
+    self.assertNotEqual(normalize("C++ style"), normalize("C style"))
+    self.assertNotEqual(normalize("v1.2 notes"), normalize("v1 2 notes"))
+
+
+class AnswerCacheTest(unittest.TestCase):
+
+  def test_distinct_product_codes_do_not_collide(self) -> None:
+    cache = AnswerCache()
+    cache.put("What does error AB-12 mean?", 1, _answers("AB-12 answer"))
+    cache.put("What does error AB-13 mean?", 1, _answers("AB-13 answer"))
+    self.assertEqual(
+        cache.get("what does error AB-12 mean?", 1), _answers("AB-12 answer"))
+    self.assertEqual(
+        cache.get("What does error AB-13 mean?", 1), _answers("AB-13 answer"))
+    self.assertIsNone(cache.get("What does error AB 12 mean?", 1))
+    self.assertIsNone(cache.get("What does error AB-14 mean?", 1))
+
+  def test_drops_answers_of_older_versions(self) -> None:
+    cache = AnswerCache()
+    cache.put("question", 1, _answers("old"))
+    self.assertIsNone(cache.get("question", 2))
+    # Answered before the corpus changed.
+    cache.put("question", 1, _answers("old"))
+    self.assertIsNone(cache.get("question", 2))
+    self.assertEqual(cache.stats().invalidations, 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
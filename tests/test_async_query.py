@@ -0,0 +1,214 @@
+import asyncio
+from llama_index.llms.base import CompletionResponse
+from llama_index.postprocessor import LLMRerank
+from llama_index.response.schema import Response
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+from typing import Any, AsyncIterator, Iterable, List
+import unittest
+from unittest import mock
+from api.async_query import (
+    _parse_choices,
+    _split_evenly,
+    arerank,
+    astream_answer,
+    astream_steps,
+    StepCallback,
+)
+from api.base_rag import AttributedAnswer, ConversationEvent
+
+
+def _nodes(count: int) -> List[NodeWithScore]:
+  return [NodeWithScore(node=TextNode(id_=f"n{i}", text=f"passage {i}"))
+          for i in range(count)]
+
+
+class _Predictor:
+  """Answers every rerank prompt from `answers`, in order."""
+
+  def __init__(self, answers: List[str]) -> None:
+    self.answers = answers
+    self.batch_sizes: List[int] = []
+
+  async def apredict(self, prompt: Any, **kwargs: str) -> str:
+    self.batch_sizes.append(kwargs["context_str"].count("Document "))
+    return self.answers.pop(0)
+
+
+class _StreamingLlm:
+  """Streams `chunks` for any prompt."""
+
+  def __init__(self, chunks: List[str]) -> None:
+    self.chunks = chunks
+    self.prompts: List[str] = []
+
+  async def astream_complete(
+      self, prompt: str
+  ) -> AsyncIterator[CompletionResponse]:
+    self.prompts.append(prompt)
+
+    async def gen() -> AsyncIterator[CompletionResponse]:
+      text = ""
+      for chunk in self.chunks:
+        text += chunk
+        yield CompletionResponse(text=text, delta=chunk)
+
+    return gen()
+
+
+async def _collect(
+    events: AsyncIterator[ConversationEvent],
+) -> List[ConversationEvent]:
+  return [event async for event in events]
+
+
+def _reranker(predictor: _Predictor, top_n: int) -> Any:
+  return mock.Mock(
+      spec=LLMRerank,
+      service_context=mock.Mock(llm_predictor=predictor),
+      choice_batch_size=5,
+      choice_select_prompt=None,
+      top_n=top_n)
+
+
+class ParseChoicesTest(unittest.TestCase):
+
+  def test_parses_choices_and_relevances(self) -> None:
+    self.assertEqual(
+        _parse_choices("Doc: 2, Relevance: 7\nDoc: 1, Relevance: 4.5", 3),
+        [(2, 7.0), (1, 4.5)])
+
+  def test_skips_malformed_lines(self) -> None:
+    self.assertEqual(
+        _parse_choices(
+            "Here you go:\nDoc: x, Relevance: 2\nDoc: 3\nDoc: 1, Relevance: 8",
+            3),
+        [(1, 8.0)])
+
+  def test_skips_out_of_range_choices(self) -> None:
+    self.assertEqual(
+        _parse_choices(
+            "Doc: 0, Relevance: 9\nDoc: 4, Relevance: 9\nDoc: 2, Relevance: 5",
+            3),
+        [(2, 5.0)])
+
+  def test_keeps_the_first_of_repeated_choices(self) -> None:
+    self.assertEqual(
+        _parse_choices("Doc: 1, Relevance: 6\nDoc: 1, Relevance: 2", 3),
+        [(1, 6.0)])
+
+
+class SplitEvenlyTest(unittest.TestCase):
+
+  def test_leaves_no_singleton_batch(self) -> None:
+    self.assertEqual(
+        [len(batch) for batch in _split_evenly(_nodes(6), 5)], [3, 3])
+    self.assertEqual(
+        [len(batch) for batch in _split_evenly(_nodes(11), 5)], [4, 4, 3])
+
+  def test_keeps_order_and_every_node(self) -> None:
+    nodes = _nodes(7)
+    self.assertEqual(
+        [node for batch in _split_evenly(nodes, 3) for node in batch], nodes)
+
+  def test_empty(self) -> None:
+    self.assertEqual(_split_evenly([], 5), [])
+
+
+class ArerankTest(unittest.TestCase):
+
+  def test_weak_last_candidate_does_not_win_its_batch(self) -> None:
+    # n5 is the only candidate that would be alone in a batch of 5 and 1.
+    predictor = _Predictor([
+        "Doc: 1, Relevance: 9\nDoc: 2, Relevance: 8\nDoc: 3, Relevance: 7",
+        "Doc: 1, Relevance: 6\nDoc: 2, Relevance: 5\nDoc: 3, Relevance: 2",
+    ])
+    results = asyncio.run(arerank(
+        _reranker(predictor, top_n=3), _nodes(6), QueryBundle("question")))
+    self.assertEqual(predictor.batch_sizes, [3, 3])
+    self.assertEqual(
+        [(node.node.node_id, node.score) for node in results],
+        [("n0", 0.9), ("n1", 0.8), ("n2", 0.7)])
+
+  def test_scores_compare_across_batches(self) -> None:
+    predictor = _Predictor([
+        "Doc: 1, Relevance: 3",
+        "Doc: 2, Relevance: 9",
+    ])
+    results = asyncio.run(arerank(
+        _reranker(predictor, top_n=1), _nodes(4), QueryBundle("question"),
+        batch_size=2))
+    self.assertEqual([node.node.node_id for node in results], ["n3"])
+
+  def test_ignores_unparsable_answers(self) -> None:
+    predictor = _Predictor(["no idea", "Doc: 1, Relevance: 4"])
+    results = asyncio.run(arerank(
+        _reranker(predictor, top_n=3), _nodes(4), QueryBundle("question"),
+        batch_size=2))
+    self.assertEqual(
+        [(node.node.node_id, node.score) for node in results], [("n2", 0.4)])
+
+
+class AstreamAnswerTest(unittest.TestCase):
+
+  def test_streams_deltas_then_the_recorded_answer(self) -> None:
+    llm = _StreamingLlm(["The policy ", "allows ", "it."])
+    responses: List[Response] = []
+
+    def record(response: Response) -> Iterable[AttributedAnswer]:
+      responses.append(response)
+      return [AttributedAnswer(
+          answer=response.response or "",
+          citations=[node.text for node in response.source_nodes
+                     if node.score is None])]
+
+    nodes = [NodeWithScore(node=TextNode(id_="n0", text="passage"), score=0.8)]
+    events = asyncio.run(_collect(astream_answer(
+        llm, QueryBundle("question"), nodes, record)))
+    self.assertEqual(
+        [(event.event, event.text) for event in events[:-1]],
+        [("delta", "The policy "), ("delta", "allows "), ("delta", "it.")])
+    answer = events[-1].answer
+    self.assertEqual(events[-1].event, "answer")
+    assert answer is not None
+    self.assertEqual(answer.answer, "The policy allows it.")
+    self.assertEqual(list(answer.citations or []), ["passage"])
+    self.assertIsNone(answer.score)
+    self.assertIn("passage", llm.prompts[0])
+    self.assertIn("question", llm.prompts[0])
+
+
+class AstreamStepsTest(unittest.TestCase):
+
+  def test_interleaves_steps_with_the_events(self) -> None:
+    async def astream(
+        on_step: StepCallback
+    ) -> AsyncIterator[ConversationEvent]:
+      await on_step(QueryBundle("sub-question"), Response(response="sub"))
+      yield ConversationEvent(event="delta", text="answer")
+
+    events = asyncio.run(_collect(astream_steps(astream)))
+    self.assertEqual(
+        [(event.event, event.text) for event in events],
+        [("step", "sub-question"), ("delta", "answer")])
+
+  def test_raises_the_failure_after_the_events_before_it(self) -> None:
+    async def astream(
+        on_step: StepCallback
+    ) -> AsyncIterator[ConversationEvent]:
+      await on_step(QueryBundle("sub-question"), Response(response="sub"))
+      raise RuntimeError("boom")
+      yield  # Makes this a generator.
+
+    events: List[ConversationEvent] = []
+
+    async def run() -> None:
+      async for event in astream_steps(astream):
+        events.append(event)
+
+    with self.assertRaisesRegex(RuntimeError, "boom"):
+      asyncio.run(run())
+    self.assertEqual([event.event for event in events], ["step"])
+
+
+if __name__ == "__main__":
+  unittest.main()
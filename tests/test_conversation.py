@@ -0,0 +1,132 @@
+import asyncio
+import os
+from pydantic import PrivateAttr
+import tempfile
+from typing import Iterable, List
+import unittest
+from api.base_rag import AttributedAnswer, BaseRag
+from api.conversation import ConversationHistory
+from api.sessions import SessionPool
+
+
+def _answer(text: str) -> AttributedAnswer:
+  return AttributedAnswer(answer=text, citations=[], score=None)
+
+
+class _Stack(BaseRag):
+  """Keeps a conversation that spills to `spill_dir`."""
+
+  spill_dir: str
+  _conversation: ConversationHistory = PrivateAttr()
+
+  @classmethod
+  async def get_default(cls) -> "_Stack":
+    raise NotImplementedError
+
+  async def list_files(self) -> Iterable[str]:
+    return []
+
+  async def add_file(self, *, filename, content, content_type) -> None:
+    raise NotImplementedError
+
+  async def clear_files(self) -> None:
+    pass
+
+  async def add_conversation(self, message: str) -> Iterable[AttributedAnswer]:
+    answers = [_answer(f"re: {message}")]
+    for answer in answers:
+      self._conversation.append(message, answer, citation_ids=[])
+    return answers
+
+  async def start_conversation(self) -> None:
+    self._conversation = ConversationHistory(
+        max_turns=1, spill_dir=self.spill_dir)
+
+  def close_conversation(self) -> None:
+    self._conversation.close()
+
+
+class ConversationHistoryCloseTest(unittest.TestCase):
+
+  def setUp(self) -> None:
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.spill_dir = directory.name
+
+  def _spill_files(self) -> List[str]:
+    return os.listdir(self.spill_dir)
+
+  def test_close_deletes_spilled_turns(self) -> None:
+    history = ConversationHistory(max_turns=1, spill_dir=self.spill_dir)
+    history.append("q1", _answer("a1"), citation_ids=[])
+    history.append("q2", _answer("a2"), citation_ids=[])
+    self.assertEqual([t.question for t in history.spilled()], ["q1"])
+    self.assertEqual(len(self._spill_files()), 1)
+
+    history.close()
+    self.assertEqual(self._spill_files(), [])
+    # Turns pushed out after closing are dropped rather than spilled again.
+    history.append("q3", _answer("a3"), citation_ids=[])
+    self.assertEqual(self._spill_files(), [])
+    self.assertEqual([t.question for t in history], ["q3"])
+    history.close()
+
+  def test_close_without_spilling(self) -> None:
+    ConversationHistory(spill_dir=self.spill_dir).close()
+    ConversationHistory(spill_dir=None).close()
+    self.assertEqual(self._spill_files(), [])
+
+
+class StackConversationTest(unittest.TestCase):
+
+  def setUp(self) -> None:
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.spill_dir = directory.name
+    self.shared = _Stack(spill_dir=self.spill_dir)
+    asyncio.run(self.shared.start_conversation())
+
+  def _spill(self, stack: BaseRag) -> None:
+    asyncio.run(stack.add_conversation("first"))
+    asyncio.run(stack.add_conversation("second"))
+
+  def _converse(self, pool: SessionPool, session_id: str) -> None:
+    self._spill(asyncio.run(pool.get(session_id, "stack", self.shared)))
+
+  def test_clear_conversation_deletes_spilled_turns(self) -> None:
+    self._spill(self.shared)
+    self.assertEqual(len(os.listdir(self.spill_dir)), 1)
+    asyncio.run(self.shared.clear_conversation())
+    self.assertEqual(os.listdir(self.spill_dir), [])
+
+  def test_new_session_leaves_shared_conversation(self) -> None:
+    self._spill(self.shared)
+    session = asyncio.run(self.shared.new_session())
+    self._spill(session)
+    self.assertEqual(len(os.listdir(self.spill_dir)), 2)
+    session.close_conversation()
+    self.assertEqual(len(os.listdir(self.spill_dir)), 1)
+    self.assertEqual(
+        [t.question for t in self.shared._conversation.spilled()], ["first"])
+
+  def test_pool_closes_dropped_sessions(self) -> None:
+    pool = SessionPool(max_sessions=1)
+
+    self._converse(pool, "s1")
+    self._converse(pool, "s2")
+    self.assertEqual(len(pool), 1)
+    self.assertEqual(len(os.listdir(self.spill_dir)), 1)
+    pool.discard("s2", "stack")
+    self.assertEqual(os.listdir(self.spill_dir), [])
+
+  def test_pool_closes_idle_sessions(self) -> None:
+    pool = SessionPool(idle_seconds=0)
+
+    self._converse(pool, "s1")
+    self.assertEqual(len(os.listdir(self.spill_dir)), 1)
+    asyncio.run(pool.get("s2", "stack", self.shared))
+    self.assertEqual(os.listdir(self.spill_dir), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,98 @@
+import tempfile
+from typing import List
+import unittest
+from unittest import mock
+from api.ingest import DocumentEntry, Manifest
+
+
+def _entry(file_name: str) -> DocumentEntry:
+  return DocumentEntry(file_name=file_name, content_hash="hash")
+
+
+class ManifestPageTest(unittest.TestCase):
+
+  def setUp(self) -> None:
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    patcher = mock.patch("api.ingest.MANIFEST_DIR", directory.name)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.manifest = Manifest("corpus")
+
+  def _all_pages(self, limit: int) -> List[List[str]]:
+    pages = []
+    cursor = None
+    while True:
+      page = self.manifest.page(cursor=cursor, limit=limit)
+      pages.append(page.filenames)
+      cursor = page.next_cursor
+      if cursor is None:
+        return pages
+
+  def test_pages_in_file_name_order(self) -> None:
+    for i, name in enumerate(["c.md", "a.md", "e.md", "b.md", "d.md"]):
+      self.manifest.put(f"doc{i}", _entry(name))
+    self.assertEqual(
+        self._all_pages(2), [["a.md", "b.md"], ["c.md", "d.md"], ["e.md"]])
+    self.assertEqual(
+        self._all_pages(5), [["a.md", "b.md", "c.md", "d.md", "e.md"]])
+    self.assertEqual(
+        self.manifest.page(cursor=None, limit=None).filenames,
+        ["a.md", "b.md", "c.md", "d.md", "e.md"])
+
+  def test_orders_equal_file_names_by_document_id(self) -> None:
+    self.manifest.put("doc2", _entry("same.md"))
+    self.manifest.put("doc1", _entry("same.md"))
+    self.manifest.put("doc3", _entry("same.md"))
+    self.assertEqual(self._all_pages(1), [["same.md"]] * 3)
+
+  def test_cursor_survives_inserts_and_deletes(self) -> None:
+    for i, name in enumerate(["b.md", "d.md", "f.md", "h.md"]):
+      self.manifest.put(f"doc{i}", _entry(name))
+    first = self.manifest.page(cursor=None, limit=2)
+    self.assertEqual(first.filenames, ["b.md", "d.md"])
+
+    # Before the cursor, so not listed again.
+    self.manifest.put("doc4", _entry("a.md"))
+    # After the cursor.
+    self.manifest.put("doc5", _entry("e.md"))
+    # Deletes d.md, which the cursor points at, and f.md.
+    self.manifest.sync({
+        "doc0": "b.md", "doc3": "h.md", "doc4": "a.md", "doc5": "e.md"})
+
+    second = self.manifest.page(cursor=first.next_cursor, limit=2)
+    self.assertEqual(second.filenames, ["e.md", "h.md"])
+    self.assertIsNone(second.next_cursor)
+
+  def test_renaming_moves_the_entry(self) -> None:
+    self.manifest.put("doc0", _entry("b.md"))
+    self.manifest.put("doc1", _entry("c.md"))
+    self.manifest.put("doc0", _entry("d.md"))
+    self.assertEqual(self._all_pages(10), [["c.md", "d.md"]])
+
+  def test_empty(self) -> None:
+    page = self.manifest.page(cursor=None, limit=10)
+    self.assertEqual(page.filenames, [])
+    self.assertIsNone(page.next_cursor)
+
+  def test_rejects_empty_pages(self) -> None:
+    with self.assertRaises(AssertionError):
+      self.manifest.page(cursor=None, limit=0)
+    with self.assertRaises(AssertionError):
+      self.manifest.page(cursor=None, limit=-1)
+
+  def test_rejects_invalid_cursors(self) -> None:
+    with self.assertRaises(ValueError):
+      self.manifest.page(cursor="not a cursor", limit=10)
+
+  def test_reloads_from_disk(self) -> None:
+    self.manifest.put("doc0", _entry("b.md"))
+    self.manifest.put("doc1", _entry("a.md"))
+    reloaded = Manifest("corpus")
+    self.assertEqual(
+        reloaded.page(cursor=None, limit=10).filenames, ["a.md", "b.md"])
+    self.assertEqual(reloaded.get("doc0"), _entry("b.md"))
+
+
+if __name__ == "__main__":
+  unittest.main()
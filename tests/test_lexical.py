@@ -0,0 +1,170 @@
+import json
+from llama_index.core import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+import os
+import random
+import tempfile
+from typing import Dict, List, Tuple
+import unittest
+from api.bm25 import bm25_scores
+from api.lexical import HybridRetriever, InvertedIndex, reciprocal_rank_fusion
+
+
+_WORDS = ["policy", "travel", "expense", "review", "team", "approval",
+          "manager", "budget", "onboarding", "security", "AB-12", "XK-99"]
+
+
+def _node(node_id: str, score: float | None = None) -> NodeWithScore:
+  return NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=score)
+
+
+class _FixedRetriever(BaseRetriever):
+
+  def __init__(self, nodes: List[NodeWithScore]) -> None:
+    super().__init__(callback_manager=None)
+    self._nodes = nodes
+
+  def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+    return self._nodes
+
+
+class InvertedIndexTest(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self._dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self._dir.cleanup)
+    self._path = os.path.join(self._dir.name, "corpus.jsonl")
+
+  def _assert_matches_bm25(
+      self,
+      index: InvertedIndex,
+      documents: Dict[str, List[Tuple[str, str]]],
+      query: str,
+  ) -> None:
+    chunks = [chunk for chunks in documents.values() for chunk in chunks]
+    expected = bm25_scores(query, [text for _, text in chunks])
+    expected_ids = {
+        chunk_id: score
+        for (chunk_id, _), score in zip(chunks, expected) if score > 0}
+    results = index.search(query, top_k=len(chunks) + 1)
+    self.assertEqual(
+        {node.node.node_id for node in results}, set(expected_ids))
+    for node in results:
+      self.assertAlmostEqual(node.score or 0.0, expected_ids[node.node_id])
+    self.assertEqual(
+        [node.score for node in results],
+        sorted((node.score for node in results), reverse=True))
+
+  def test_finds_exact_tokens(self) -> None:
+    index = InvertedIndex(self._path)
+    index.replace_document("doc", [
+        ("c1", "Travel policy for the team."),
+        ("c2", "Error AB-12 means the budget is over."),
+    ])
+    results = index.search("what is AB-12", top_k=1)
+    self.assertEqual([node.node.node_id for node in results], ["c2"])
+    self.assertEqual(results[0].node.ref_doc_id, "doc")
+
+  def test_replacing_a_document_drops_its_old_chunks(self) -> None:
+    index = InvertedIndex(self._path)
+    index.replace_document("doc", [("c1", "travel"), ("c2", "budget")])
+    index.replace_document("doc", [("c2", "budget"), ("c3", "security")])
+    self.assertEqual(index.search("travel", top_k=5), [])
+    self.assertEqual(
+        [node.node.node_id for node in index.search("security", top_k=5)],
+        ["c3"])
+
+  def test_scores_match_bm25_through_deletes_and_compactions(self) -> None:
+    rng = random.Random(0)
+    index = InvertedIndex(self._path)
+    documents: Dict[str, List[Tuple[str, str]]] = {}
+    for i in range(300):
+      doc_id = f"doc{rng.randrange(20)}"
+      chunks = [
+          (f"{doc_id}-{i}-{j}",
+           " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 12))))
+          for j in range(rng.randint(0, 4))]
+      index.replace_document(doc_id, chunks)
+      documents[doc_id] = chunks
+    for query in ["travel budget", "AB-12", "manager approval review"]:
+      self._assert_matches_bm25(index, documents, query)
+    # Tombstones never outnumber the live rows.
+    live = sum(len(chunks) for chunks in documents.values())
+    self.assertLessEqual(len(index._chunk_ids), 2 * live)
+
+  def test_reloads_from_its_log(self) -> None:
+    index = InvertedIndex(self._path)
+    documents: Dict[str, List[Tuple[str, str]]] = {}
+    for i in range(50):
+      doc_id = f"doc{i % 5}"
+      documents[doc_id] = [(f"{doc_id}-{i}", f"{_WORDS[i % len(_WORDS)]} {i}")]
+      index.replace_document(doc_id, documents[doc_id])
+
+    reloaded = InvertedIndex(self._path)
+    for query in ["policy", "security 49", "XK-99"]:
+      self._assert_matches_bm25(reloaded, documents, query)
+    # Superseded records are compacted away.
+    with open(self._path, encoding="utf-8") as f:
+      self.assertLessEqual(len(f.readlines()), 2 * len(documents))
+
+  def test_loads_the_legacy_format(self) -> None:
+    with open(self._path, "w", encoding="utf-8") as f:
+      f.write(json.dumps(["c1", "doc", "travel policy"]) + "\n")
+      f.write(json.dumps(["c2", "doc", "budget"]) + "\n")
+    index = InvertedIndex(self._path)
+    self.assertTrue(index.has_document("doc"))
+    self.assertEqual(
+        [node.node.node_id for node in index.search("budget", top_k=5)],
+        ["c2"])
+
+  def test_clear(self) -> None:
+    index = InvertedIndex(self._path)
+    index.replace_document("doc", [("c1", "travel")])
+    index.clear()
+    self.assertTrue(index.is_empty())
+    self.assertTrue(InvertedIndex(self._path).is_empty())
+
+
+class ReciprocalRankFusionTest(unittest.TestCase):
+
+  def test_favors_nodes_ranked_by_both(self) -> None:
+    fused = reciprocal_rank_fusion(
+        [[_node("a"), _node("b"), _node("c")], [_node("c"), _node("d")]],
+        top_k=3, k=60)
+    self.assertEqual([node.node.node_id for node in fused], ["c", "a", "b"])
+    self.assertAlmostEqual(fused[0].score or 0.0, 1 / 63 + 1 / 61)
+
+  def test_keeps_the_node_of_the_earliest_ranking(self) -> None:
+    first = NodeWithScore(node=TextNode(id_="a", text="first"))
+    second = NodeWithScore(node=TextNode(id_="a", text="second"))
+    fused = reciprocal_rank_fusion([[first], [second]], top_k=1)
+    self.assertEqual(fused[0].node.get_content(), "first")
+
+
+class HybridRetrieverTest(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self._dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self._dir.cleanup)
+    self._index = InvertedIndex(os.path.join(self._dir.name, "corpus.jsonl"))
+
+  def test_returns_the_vector_nodes_while_the_index_is_empty(self) -> None:
+    vector_nodes = [_node(f"v{i}", 1.0) for i in range(5)]
+    retriever = HybridRetriever(
+        _FixedRetriever(vector_nodes), self._index, similarity_top_k=2)
+    self.assertEqual(retriever.retrieve(QueryBundle("anything")), vector_nodes)
+
+  def test_fuses_lexical_matches(self) -> None:
+    self._index.replace_document("doc", [("code", "error XK-99")])
+    retriever = HybridRetriever(
+        _FixedRetriever([_node("v0", 1.0), _node("v1", 0.5)]),
+        self._index,
+        similarity_top_k=2)
+    self.assertEqual(
+        [node.node.node_id
+         for node in retriever.retrieve(QueryBundle("XK-99"))],
+        ["v0", "code"])
+
+
+if __name__ == "__main__":
+  unittest.main()
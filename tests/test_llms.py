@@ -0,0 +1,33 @@
+import unittest
+from unittest import mock
+from api.base_rag import with_completion_cache
+from api.llms import Gemini, PaLM
+
+
+def _model() -> mock.Mock:
+  return mock.Mock(input_token_limit=1000, output_token_limit=100)
+
+
+@mock.patch("api.llms.genaix.get_model", lambda model_name: _model())
+class CompletionCacheDefaultTest(unittest.TestCase):
+
+  def test_gemini_does_not_memoize_its_samples(self) -> None:
+    self.assertFalse(Gemini(model_name="models/gemini-pro").cache_completions)
+
+  def test_low_temperatures_memoize(self) -> None:
+    self.assertTrue(
+        Gemini(model_name="models/gemini-pro", temperature=0.0)
+        .cache_completions)
+    self.assertTrue(PaLM(model_name="models/text-bison-001").cache_completions)
+
+  def test_call_sites_opt_in(self) -> None:
+    llm = Gemini(model_name="models/gemini-pro")
+    cached = with_completion_cache(llm)
+    assert isinstance(cached, Gemini)
+    self.assertTrue(cached.cache_completions)
+    self.assertEqual(cached.temperature, llm.temperature)
+    self.assertFalse(llm.cache_completions)
+
+
+if __name__ == "__main__":
+  unittest.main()